@@ -1,7 +1,27 @@
+import argparse
+import contextlib
+import heapq
+import json
+import itertools
+import mmap
 import os
-import sys
+import re
+import shutil
+import sqlite3
+import struct
+import tempfile
+import time
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
-from frontend import TransactionSummary, TransactionSummaryKeys
+from frontend import BinaryTransactionSummaryFormat, ColumnarTransactionSummary, TransactionSummary, \
+    TransactionSummaryKeys
+
+try:
+    import numpy
+except ImportError:  # numpy is only needed for the batch engine
+    numpy = None
 
 '''
 Overall, the backend takes in the previous day’s master accounts file and then applies all of
@@ -12,99 +32,1803 @@ transactions is complete (this could be done using a script for example).
 '''
 
 
-# Takes in the merged transaction summary file and parses it's contents to build a TransactionSummary object to return.
-def parse_to_summary_file(file: str):
-    summary = TransactionSummary()
+# Transaction summary keys by the code written in summary files
+KEYS_BY_CODE = {key.value: key for key in TransactionSummaryKeys}
+
+
+# Looks up the TransactionSummaryKeys for a code read from a summary file, raising a ValueError for unknown codes
+def summary_key(code: str):
+    key = KEYS_BY_CODE.get(code)
+    return key if key is not None else TransactionSummaryKeys(code)
+
+
+# Lazily reads the merged transaction summary file, yielding one TransactionSummaryRow per line until the EOS
+# sentinel (or the end of the file) is reached. Only the current line is held in memory. Binary summary files are
+# read with BinaryTransactionSummaryFormat instead.
+def iter_summary_file(file: str):
+    if BinaryTransactionSummaryFormat.is_binary(file):
+        yield from BinaryTransactionSummaryFormat.iter_rows(file)
+        return
     with open(file, 'r') as fp:
         for line in fp:
             transaction_row = line.replace('\n', '').split(' ')
-            if transaction_row[0] == TransactionSummaryKeys.end_of_file:
-                return summary
-            summary.add_row(TransactionSummaryKeys(transaction_row[0]), transaction_row[1], transaction_row[2],
-                            transaction_row[3], ' '.join(transaction_row[4:]))
+            if transaction_row[0] == TransactionSummaryKeys.end_of_file.value:
+                return
+            yield summary_row(transaction_row)
+
+
+# Builds a TransactionSummaryRow from the space separated fields of a summary file line
+def summary_row(transaction_row):
+    return TransactionSummary.TransactionSummaryRow(summary_key(transaction_row[0]), transaction_row[1],
+                                                    transaction_row[2], transaction_row[3],
+                                                    ' '.join(transaction_row[4:]))
+
+
+# Takes in the merged transaction summary file and parses it's contents to build a TransactionSummary object to return.
+# With columnar=True the rows are parsed straight into the columns of a ColumnarTransactionSummary instead, which uses
+# several times less memory (see parse_summary_file_parallel).
+def parse_to_summary_file(file: str, columnar=False):
+    if columnar:
+        return parse_summary_file_parallel(file, workers=1)
+    summary = TransactionSummary()
+    summary.extend(iter_summary_file(file))
+    return summary
+
+
+# Default size of the pieces parse_summary_file_parallel splits a summary file into
+PARSE_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+# Finds where the rows of a memory mapped summary file end: the start of the first EOS line, or the end of the file
+def summary_end(mapped):
+    end_of_file = TransactionSummaryKeys.end_of_file.value.encode()
+    line_start = 0
+    while True:
+        after = line_start + len(end_of_file)
+        if mapped[line_start:after] == end_of_file and (after == len(mapped) or mapped[after:after + 1] in b' \n'):
+            return line_start
+        line_start = mapped.find(b'\n' + end_of_file, line_start) + 1
+        if line_start == 0:
+            return len(mapped)
+
+
+# Parses the bytes from start to end of a summary file (whole lines, without the EOS line) into a
+# ColumnarTransactionSummary. The file is memory mapped so only this range is read. Runs in a worker process when
+# parse_summary_file_parallel uses more than one.
+def parse_summary_chunk(file: str, start: int, end: int):
+    summary = ColumnarTransactionSummary()
+    if start == end:
+        return summary
+    with open(file, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        lines = mapped[start:end].split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+    type_codes = {code.encode(): summary.TYPE_CODES[key] for code, key in KEYS_BY_CODE.items()}
+    account_to_int = summary.account_to_int
+    # Bound once, as these are called for every line
+    add_type, add_to, add_cents = summary.types.append, summary.to_accounts.append, summary.cents.append
+    add_from, add_name = summary.from_accounts.append, summary.names.append
+    for line in lines:
+        transaction_row = line.split(b' ')
+        type_code = type_codes.get(transaction_row[0])
+        if type_code is None:
+            TransactionSummaryKeys(transaction_row[0].decode())  # raises the ValueError for the unknown code
+        add_type(type_code)
+        add_to(account_to_int(transaction_row[1]))
+        add_cents(int(transaction_row[2]))
+        add_from(account_to_int(transaction_row[3]))
+        add_name('***' if len(transaction_row) == 5 and transaction_row[4] == b'***'
+                 else b' '.join(transaction_row[4:]).decode())
+    return summary
+
+
+# Splits the rows of a (non-empty, text) merged transaction summary file before its EOS line into newline aligned chunks
+# of about chunk_size bytes. Returns the chunk boundaries, from 0 to the end of the rows.
+def summary_chunks(file: str, chunk_size=PARSE_CHUNK_SIZE):
+    with open(file, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return line_chunks(mapped, summary_end(mapped), chunk_size)
+
+
+# Splits the first end bytes of a memory mapped file into newline aligned chunks of about chunk_size bytes. Returns the
+# chunk boundaries, from 0 to end.
+def line_chunks(mapped, end: int, chunk_size: int):
+    bounds = [0]
+    while bounds[-1] < end:
+        newline = mapped.find(b'\n', bounds[-1] + chunk_size, end)
+        bounds.append(end if newline < 0 else newline + 1)
+    return bounds
+
+
+# Parses a merged transaction summary file into a ColumnarTransactionSummary using several processes. The file is
+# memory mapped to find the EOS line and to split the rows before it into newline aligned chunks of about chunk_size
+# bytes, which are parsed by parse_summary_chunk in a ProcessPoolExecutor and joined back together in file order.
+# With one worker (or a single chunk) everything is parsed in this process. Binary summary files are read directly.
+def parse_summary_file_parallel(file: str, workers=None, chunk_size=PARSE_CHUNK_SIZE):
+    if os.path.getsize(file) == 0:
+        return ColumnarTransactionSummary()
+    if BinaryTransactionSummaryFormat.is_binary(file):
+        # Already fixed width, so there is nothing to gain from splitting the work up
+        summary = ColumnarTransactionSummary()
+        for type_code, to, from_act, cents, name in BinaryTransactionSummaryFormat.iter_columns(file):
+            summary.types.append(type_code)
+            summary.to_accounts.append(to)
+            summary.from_accounts.append(from_act)
+            summary.cents.append(cents)
+            summary.names.append(name)
+        return summary
+    bounds = summary_chunks(file, chunk_size)
+    if workers == 1 or len(bounds) <= 2:
+        return parse_summary_chunk(file, 0, bounds[-1])
+
+    summary = ColumnarTransactionSummary()
+    with ProcessPoolExecutor(workers) as pool:
+        for chunk in pool.map(parse_summary_chunk, [file] * (len(bounds) - 1), bounds[:-1], bounds[1:]):
+            summary.types.extend(chunk.types)
+            summary.to_accounts.extend(chunk.to_accounts)
+            summary.cents.extend(chunk.cents)
+            summary.from_accounts.extend(chunk.from_accounts)
+            summary.names.extend(chunk.names)
     return summary
 
 
-# Takes in the old master accounts file and parses it's contents, making a dictionary of accounts which is returned
-def parse_master_account_file(file: str):
-    accounts = {}
+# Converts a transaction summary file between the text format and the binary format of BinaryTransactionSummaryFormat,
+# in whichever direction the source file needs
+def convert_summary_file(source: str, destination: str):
+    if BinaryTransactionSummaryFormat.is_binary(source):
+        summary = TransactionSummary(destination)
+        summary.extend(BinaryTransactionSummaryFormat.iter_rows(source))
+        summary.add_row(TransactionSummaryKeys.end_of_file)
+        with open(destination, 'w') as fp:
+            fp.write('\n'.join(map(lambda row: str(row), summary)))
+    else:
+        BinaryTransactionSummaryFormat.write(iter_summary_file(source), destination)
+
+
+# Bytes read and written at a time by merge_summary_files
+MERGE_BUFFER_SIZE = 1024 * 1024
+# The end of summary line every merged transaction summary file finishes with
+END_OF_SUMMARY = b'EOS 0000000 000 0000000 ***'
+
+
+# Sort key putting session summary files in session order: by the numbers in the file name, compared as numbers (so
+# transaction_10.txt comes after transaction_9.txt), then by name
+def session_order(file: str):
+    name = os.path.basename(file)
+    return [int(number) for number in re.findall(r'\d+', name)], name
+
+
+# Merges the transaction summary files of a day's sessions into one merged transaction summary file. The sessions are
+# put in session order (see session_order) whatever order the files are given in, and each session's rows stay in the
+# order they were entered, so the same files always give the same merged file. Text files are copied a buffer at a time
+# up to their EOS line, without splitting them into rows; binary files are converted.
+def merge_summary_files(summary_files, merged_file: str, buffer_size=MERGE_BUFFER_SIZE):
+    with open(merged_file + '.tmp', 'wb', buffering=buffer_size) as merged:
+        for file in sorted(summary_files, key=session_order):
+            if BinaryTransactionSummaryFormat.is_binary(file):
+                merged.writelines((str(row) + '\n').encode() for row in BinaryTransactionSummaryFormat.iter_rows(file))
+                continue
+            with open(file, 'rb', buffering=0) as session:
+                pending = b''  # the start of a line cut off at the end of the last read
+                while True:
+                    chunk = session.read(buffer_size)
+                    if not chunk:
+                        if pending and not pending.startswith(b'EOS'):
+                            merged.write(pending + b'\n')  # the last line had no newline
+                        break
+                    lines = pending + chunk  # always starts at the start of a line
+                    end = lines.rfind(b'\n') + 1
+                    lines, pending = lines[:end], lines[end:]
+                    if lines.startswith(b'EOS'):
+                        break
+                    eos = lines.find(b'\nEOS')
+                    if eos >= 0:
+                        merged.write(lines[:eos + 1])
+                        break
+                    merged.write(lines)
+        merged.write(END_OF_SUMMARY)
+    os.replace(merged_file + '.tmp', merged_file)
+
+
+class Account:
+    """
+    A single master account record. The balance is parsed to an int once when the master accounts file is loaded
+    and then updated in place as transactions are applied.
+    :param balance: The balance in cents
+    :param name: The account name
+    """
+    __slots__ = ('balance', 'name')
+
+    def __init__(self, balance: int, name: str) -> None:
+        self.balance: int = balance
+        self.name: str = name
+
+
+class AccountStore(dict):
+    """
+    The master accounts, as a dictionary of account number to Account. Transactions are applied through the methods
+    below so other stores can be swapped in for parse_backend. The numbers of accounts changed since loading are kept
+    in changed, so write_account_files only has to rewrite those.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.changed = set()
+
+    def add(self, number: str, balance: int, name: str) -> None:
+        self[number] = Account(balance, name)
+
+    def can_hold(self, number: str) -> bool:
+        return True
+
+    def balance(self, number: str) -> int:
+        return self[number].balance
+
+    def name(self, number: str) -> str:
+        return self[number].name
+
+    def credit(self, number: str, cents: int) -> None:
+        self[number].balance += cents
+        self.changed.add(number)
+
+    def debit(self, number: str, cents: int) -> None:
+        self[number].balance -= cents
+        self.changed.add(number)
+
+    def create(self, number: str, name: str) -> None:
+        self[number] = Account(0, name)
+        self.changed.add(number)
+
+    def delete(self, number: str) -> None:
+        del self[number]
+        self.changed.add(number)
+
+    def descending(self):
+        """
+        Iterates over the accounts in the order they are written to file
+        :return: (account number, balance, name) for each account, highest account number first
+        """
+        for number in sorted(self, reverse=True):
+            account = self[number]
+            yield number, account.balance, account.name
+
+
+class DirectAccountStore:
+    """
+    Master accounts kept in direct-address tables instead of a dictionary. Valid account numbers are exactly 7 digits
+    and never start with 0, so every account has a fixed slot at account_number - 1000000. Balances live in a
+    preallocated int64 array, a bitmap records which slots hold an account, and names are kept in a separate table.
+    Memory use is fixed (about 73MB) no matter how many accounts exist. Has the same methods as AccountStore.
+    """
+    FIRST_ACCOUNT: int = 1000000
+    SLOTS: int = 9000000
+
+    def __init__(self) -> None:
+        self.balances: array = array('q', [0]) * self.SLOTS
+        self.present: bytearray = bytearray((self.SLOTS + 7) // 8)
+        self.names = {}  # slot -> name
+        self.changed = set()  # account numbers changed since loading
+
+    def slot(self, number: str) -> int:
+        """
+        Finds the table slot for an account number
+        :param number: the account number string
+        :return: the slot, or -1 if the number can never be a valid account
+        """
+        if len(number) == 7 and number.isdigit() and number[0] != '0':
+            return int(number) - self.FIRST_ACCOUNT
+        return -1
+
+    def __contains__(self, number: str) -> bool:
+        slot = self.slot(number)
+        return slot >= 0 and self.present[slot >> 3] & (1 << (slot & 7)) != 0
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def can_hold(self, number: str) -> bool:
+        return self.slot(number) >= 0
+
+    def add(self, number: str, balance: int, name: str) -> None:
+        slot = self.slot(number)
+        if slot < 0:
+            raise ValueError('Account #: ' + number + ' is not a valid account number')
+        self.balances[slot] = balance
+        self.present[slot >> 3] |= 1 << (slot & 7)
+        self.names[slot] = name
+
+    def balance(self, number: str) -> int:
+        return self.balances[self.slot(number)]
+
+    def name(self, number: str) -> str:
+        return self.names[self.slot(number)]
+
+    def credit(self, number: str, cents: int) -> None:
+        self.balances[self.slot(number)] += cents
+        self.changed.add(number)
+
+    def debit(self, number: str, cents: int) -> None:
+        self.balances[self.slot(number)] -= cents
+        self.changed.add(number)
+
+    def create(self, number: str, name: str) -> None:
+        self.add(number, 0, name)
+        self.changed.add(number)
+
+    def delete(self, number: str) -> None:
+        slot = self.slot(number)
+        self.balances[slot] = 0
+        self.present[slot >> 3] &= ~(1 << (slot & 7)) & 0xff
+        del self.names[slot]
+        self.changed.add(number)
+
+    def descending(self):
+        """
+        Iterates over the accounts in the order they are written to file
+        :return: (account number, balance, name) for each account, highest account number first
+        """
+        balances = self.balances
+        names = self.names
+        for slot in sorted(names, reverse=True):
+            yield str(slot + self.FIRST_ACCOUNT), balances[slot], names[slot]
+
+
+# Account store classes that parse_backend can use, by the name given on the command line. The batch engine applies
+# the transactions with apply_summary_batch instead of apply_row.
+ENGINES = {
+    'dict': AccountStore,
+    'direct': DirectAccountStore,
+    'batch': DirectAccountStore,
+}
+
+
+# Takes in the old master accounts file and parses it's contents, making an AccountStore (or the given store class) of
+# accounts which is returned
+def parse_master_account_file(file: str, store_class=AccountStore):
+    accounts = store_class()
     with open(file, 'r') as fp:
         for line in fp:
             account_row = line.replace('\n', '').split(' ')
-            accounts[account_row[0]] = (account_row[1], ' '.join(account_row[2:]))  # number, balance, name
+            accounts.add(account_row[0], int(account_row[1]), ' '.join(account_row[2:]))  # number, balance, name
     return accounts
 
 
-# Writes the contents of the accounts dictionary (parameter) to the new master accounts file (filename passed in).
+# Writes the contents of the accounts store (parameter) to the new master accounts file (filename passed in).
 def write_master_account_file(file: str, accounts):
     with open(file, 'w') as fp:
         fp.writelines(
-            [key + " " + str(acct[0]) + " " + str(acct[1]) + "\n" for key, acct in reversed(sorted(accounts.items()))])
+            [number + " " + str(balance) + " " + name + "\n" for number, balance, name in accounts.descending()])
 
 
-# Writes the new accounts file
-def write_new_valid_accounts_file(accounts):
-    with open("valid_accounts.txt", 'w') as fp:
-        fp.writelines([key + "\n" for key, acct in reversed(sorted(accounts.items()))])
+# Writes the new accounts file (valid_accounts.txt unless another file is given)
+def write_new_valid_accounts_file(accounts, file="valid_accounts.txt"):
+    with open(file, 'w') as fp:
+        fp.writelines([number + "\n" for number, balance, name in accounts.descending()])
         fp.write('0000000\n')
 
 
-# Takes in the old master accounts file and merged transaction summary file, and calls the function to parse them.
-# Then, for each transaction, the transaction type is checked to determine the action needed to appropriately update
-# the master accounts. write_master_account_file is called, being passed the path to the old master accounts file, and
-# the contents to be written to the new master accounts file.
-def parse_backend(master_accounts_file, merged_transaction_summary_file):
-    transaction_summary = parse_to_summary_file(merged_transaction_summary_file)
-    master_accounts = parse_master_account_file(master_accounts_file)
-    for row in transaction_summary:
-        if row.transaction_type == TransactionSummaryKeys.deposit:
-            if row.to in master_accounts:
-                # Because tuples are immutable it must replace the whole value
-                master_accounts[row.to] = (int(master_accounts[row.to][0]) + int(row.cents), master_accounts[row.to][1])
-        elif row.transaction_type == TransactionSummaryKeys.withdraw:
-            if row.from_act in master_accounts:
-                if int(master_accounts[row.from_act][0]) >= int(row.cents):
-                    master_accounts[row.from_act] = (
-                        int(master_accounts[row.from_act][0]) - int(row.cents), master_accounts[row.from_act][1])
-                else:
-                    print("Error: withdrawing", row.cents, 'would cause a negative balance in account #:', row.from_act)
-        elif row.transaction_type == TransactionSummaryKeys.transfer:
-            if row.from_act in master_accounts and row.to in master_accounts:
-                if int(master_accounts[row.from_act][0]) >= int(row.cents):
-                    # Because tuples are immutable it must replace the whole value
-                    master_accounts[row.from_act] = (
-                        int(master_accounts[row.from_act][0]) - int(row.cents), master_accounts[row.from_act][1])
-                    # Because tuples are immutable it must replace the whole value
-                    master_accounts[row.to] = (
-                        int(master_accounts[row.to][0]) + int(row.cents), master_accounts[row.to][1])
+# Writes the new master accounts file and valid accounts file in a single pass, without sorting the accounts. The old
+# master accounts file (which accounts was loaded from, or source_file if given) is already sorted highest account
+# number first, so it is streamed and merged with the sorted, usually small, set of accounts changed since loading:
+# untouched lines are copied as they are, changed accounts are written from the store, deleted accounts are dropped and
+# created accounts are slotted into place. If the old file turns out not to be sorted the files are rewritten in full
+# instead. Both files are written to temporary files first and then moved into place. valid_accounts_file=None only
+# writes the master accounts file.
+def write_account_files(master_accounts_file: str, accounts, source_file=None, valid_accounts_file="valid_accounts.txt"):
+    master_temp = master_accounts_file + '.tmp'
+    valid_temp = valid_accounts_file + '.tmp' if valid_accounts_file is not None else os.devnull
+    changed = sorted(accounts.changed, reverse=True)
+    with open(source_file or master_accounts_file, 'r') as old_master, open(master_temp, 'w') as new_master, \
+            open(valid_temp, 'w') as new_valid:
+        def write_changed(number):
+            if number in accounts:
+                new_master.write(number + " " + str(accounts.balance(number)) + " " + accounts.name(number) + "\n")
+                new_valid.write(number + "\n")
+
+        position = 0
+        previous = None
+        in_order = True
+        for line in old_master:
+            number = line.split(' ', 1)[0]
+            if previous is not None and number >= previous:
+                in_order = False
+                break
+            previous = number
+            while position < len(changed) and changed[position] > number:
+                write_changed(changed[position])
+                position += 1
+            if position < len(changed) and changed[position] == number:
+                write_changed(number)
+                position += 1
+            else:
+                new_master.write(line if line.endswith('\n') else line + '\n')
+                new_valid.write(number + "\n")
+        if in_order:
+            for number in changed[position:]:
+                write_changed(number)
+            new_valid.write('0000000\n')
+    if in_order:
+        os.replace(master_temp, master_accounts_file)
+        if valid_accounts_file is not None:
+            os.replace(valid_temp, valid_accounts_file)
+    else:
+        os.remove(master_temp)
+        write_master_account_file(master_accounts_file, accounts)
+        if valid_accounts_file is not None:
+            os.remove(valid_temp)
+            write_new_valid_accounts_file(accounts, valid_accounts_file)
+    accounts.changed.clear()
+
+
+# Why apply_row rejected a transaction, counted by BackendStats
+OVERDRAFT = 'overdrafts'
+DUPLICATE_CREATE = 'duplicate_creates'
+FAILED_DELETE = 'failed_deletes'
+
+
+# Reports a withdraw or transfer that would overdraw its account, the way apply_row rejects it. Returns OVERDRAFT.
+def report_overdraft(row, report=print):
+    if row.transaction_type == TransactionSummaryKeys.withdraw:
+        report("Error: withdrawing", row.cents, 'would cause a negative balance in account #:', row.from_act)
+    else:
+        report("Error: transferring", row.cents, 'would cause a negative balance in account #:', row.from_act)
+    return OVERDRAFT
+
+
+# Applies a single transaction summary row to the master accounts store, printing an error if the transaction
+# can't be applied. report is called in place of print for the error, if given. Returns OVERDRAFT, DUPLICATE_CREATE or
+# FAILED_DELETE if the transaction was rejected with an error, None otherwise.
+def apply_row(master_accounts, row, report=print):
+    if row.transaction_type == TransactionSummaryKeys.deposit:
+        if row.to in master_accounts:
+            master_accounts.credit(row.to, int(row.cents))
+    elif row.transaction_type == TransactionSummaryKeys.withdraw:
+        if row.from_act in master_accounts:
+            cents = int(row.cents)
+            if master_accounts.balance(row.from_act) >= cents:
+                master_accounts.debit(row.from_act, cents)
+            else:
+                return report_overdraft(row, report)
+    elif row.transaction_type == TransactionSummaryKeys.transfer:
+        if row.from_act in master_accounts and row.to in master_accounts:
+            cents = int(row.cents)
+            if master_accounts.balance(row.from_act) >= cents:
+                master_accounts.debit(row.from_act, cents)
+                master_accounts.credit(row.to, cents)
+            else:
+                return report_overdraft(row, report)
+    elif row.transaction_type == TransactionSummaryKeys.createacct:
+        if row.to not in master_accounts:
+            # Add new account to list
+            master_accounts.create(row.to, row.name)
+        else:
+            report('Error: account #:', row.to, 'already exists')
+            return DUPLICATE_CREATE
+    elif row.transaction_type == TransactionSummaryKeys.deleteacct:
+        if row.to in master_accounts:
+            if row.name == master_accounts.name(row.to):
+                if master_accounts.balance(row.to) == 0:
+                    master_accounts.delete(row.to)
                 else:
-                    print("Error: transferring", row.cents, 'would cause a negative balance in account #:',row.from_act)
-        elif row.transaction_type == TransactionSummaryKeys.createacct:
-            if row.to not in master_accounts:
-                # Add new account to list
-                master_accounts[row.to] = (0, row.name)
+                    report("Can't delete account #:", row.to, "with a non-zero balance")
+                    return FAILED_DELETE
             else:
-                print('Error: account #:', row.to, 'already exists')
-        elif row.transaction_type == TransactionSummaryKeys.deleteacct:
-            if row.to in master_accounts:
-                if row.name == master_accounts[row.to][1]:
-                    if int(master_accounts[row.to][0]) == 0:
-                        del master_accounts[row.to]
+                report("Account name'", row.name, "'didn't match account number")
+                return FAILED_DELETE
+
+
+# Most rows the batch engine checks at once
+BATCH_WINDOW = 65536
+# Windows shorter than this are applied row by row, where numpy's per call overhead would cost more than it saves
+BATCH_MIN_RUN = 128
+
+
+# Converts a column of account numbers to DirectAccountStore slots, with -1 for numbers that can't be accounts
+def account_slots(column):
+    numbers = numpy.frombuffer(column, dtype=numpy.dtype(column.typecode)).astype(numpy.int64)
+    slots = numbers - DirectAccountStore.FIRST_ACCOUNT
+    slots[(slots < 0) | (slots >= DirectAccountStore.SLOTS)] = -1
+    return slots
+
+
+# Checks which slots currently hold an account, using the store's presence bitmap
+def slots_present(present, slots):
+    valid = slots >= 0
+    safe_slots = numpy.where(valid, slots, 0)
+    return valid & ((present[safe_slots >> 3] >> (safe_slots & 7)) & 1).astype(bool)
+
+
+# Finds where a batch window has to end so that no deposit, withdraw or transfer in it comes after a create or delete
+# of one of its accounts (in the same window). Returns high, or the first row that would. Whether a row has to start a
+# new window only depends on the rows before it, so windows of growing size are checked until one has such a row.
+def window_end(low, high, create_or_delete, to_slots, from_slots):
+    size = BATCH_MIN_RUN
+    while True:
+        size = min(size * 2, high - low)
+        end = first_conflict(low, low + size, create_or_delete, to_slots, from_slots)
+        if end < low + size or low + size == high:
+            return end
+
+
+# Checks the rows from low to high for the first deposit, withdraw or transfer that comes after a create or delete of
+# one of its accounts. Returns its row, or high if there isn't one.
+def first_conflict(low, high, create_or_delete, to_slots, from_slots):
+    changes = numpy.flatnonzero(create_or_delete[low:high]) + low
+    change_slots = to_slots[changes]
+    changes, change_slots = changes[change_slots >= 0], change_slots[change_slots >= 0]
+    if not len(changes):
+        return high
+    order = numpy.argsort(change_slots, kind='stable')
+    changed_slots, first = numpy.unique(change_slots[order], return_index=True)
+    first_change = changes[order][first]  # the first create or delete of each account in the window
+    rows = numpy.arange(low, high)
+    conflict = numpy.zeros(high - low, dtype=bool)
+    for slots in (to_slots[low:high], from_slots[low:high]):
+        at = numpy.searchsorted(changed_slots, slots).clip(max=len(changed_slots) - 1)
+        conflict |= (changed_slots[at] == slots) & (rows > first_change[at])
+    conflicts = numpy.flatnonzero(conflict & ~create_or_delete[low:high])
+    return low + int(conflicts[0]) if len(conflicts) else high
+
+
+# Applies every row of a ColumnarTransactionSummary to a DirectAccountStore with vectorized numpy operations, giving the
+# same result as calling apply_row on each row in order. The summary is taken a window at a time, cut short (by
+# window_end) before any deposit, withdraw or transfer that follows a create or delete of its account, so within a
+# window the deposits, withdraws and transfers only see accounts that exist at its start; short windows are applied
+# with apply_row. Every balance change in a window is sorted by account and file order, and a per account running total
+# shows which withdraws and transfers would overdraw their account. The first of those in file order is rejected for
+# certain (everything before it is fine), and rejecting it only changes the running totals of its own accounts, so just
+# those accounts are checked again, from the rejected row on; a heap of each account's first overdraft gives the next
+# one to reject. Once none are left, the accepted changes are added to the balances at once, and then the rejected rows
+# are reported and the creates and deletes applied with apply_row, in file order. stats (a BackendStats), if given,
+# counts the rejected rows.
+def apply_summary_batch(master_accounts, summary, stats=None):
+    if numpy is None:
+        raise ImportError('The batch engine requires numpy')
+    codes = ColumnarTransactionSummary.TYPE_CODES
+    types = numpy.frombuffer(summary.types, dtype=numpy.int8)
+    cents = numpy.frombuffer(summary.cents, dtype=numpy.int64)
+    to_slots = account_slots(summary.to_accounts)
+    from_slots = account_slots(summary.from_accounts)
+    balances = numpy.frombuffer(master_accounts.balances, dtype=numpy.int64)
+    present = numpy.frombuffer(master_accounts.present, dtype=numpy.uint8)
+    create_or_delete = (types == codes[TransactionSummaryKeys.createacct]) | \
+        (types == codes[TransactionSummaryKeys.deleteacct])
+
+    low = 0
+    while low < len(types):
+        high = window_end(low, min(len(types), low + BATCH_WINDOW), create_or_delete, to_slots, from_slots)
+        if high - low < BATCH_MIN_RUN:
+            for index in range(low, high):
+                outcome = apply_row(master_accounts, summary.row(index))
+                if stats is not None:
+                    stats.count_outcome(outcome)
+            low = high
+            continue
+        window_types = types[low:high]
+        window_cents = cents[low:high]
+        window_to = to_slots[low:high]
+        window_from = from_slots[low:high]
+        sequence = numpy.arange(low, high)
+        to_ok = slots_present(present, window_to)
+        from_ok = slots_present(present, window_from)
+        transfer = (window_types == codes[TransactionSummaryKeys.transfer]) & to_ok & from_ok
+        debit = ((window_types == codes[TransactionSummaryKeys.withdraw]) & from_ok) | transfer
+        credit = ((window_types == codes[TransactionSummaryKeys.deposit]) & to_ok) | transfer
+
+        accounts = numpy.concatenate((window_from[debit], window_to[credit]))
+        deltas = numpy.concatenate((-window_cents[debit], window_cents[credit]))
+        sequences = numpy.concatenate((sequence[debit], sequence[credit]))
+        is_debit = numpy.concatenate((numpy.ones(numpy.count_nonzero(debit), dtype=bool),
+                                      numpy.zeros(numpy.count_nonzero(credit), dtype=bool)))
+        # By account, then file order, with a transfer's debit checked before its credit
+        order = numpy.lexsort((~is_debit, sequences, accounts))
+        accounts, deltas, sequences, is_debit = accounts[order], deltas[order], sequences[order], is_debit[order]
+
+        group_start = numpy.ones(len(accounts), dtype=bool)
+        group_start[1:] = accounts[1:] != accounts[:-1]
+        first_in_group = numpy.flatnonzero(group_start)
+        group = numpy.cumsum(group_start) - 1
+        group_end = numpy.append(first_in_group[1:], len(accounts))
+        running = numpy.cumsum(deltas)
+        running += balances[accounts] - (running[first_in_group] - deltas[first_in_group])[group]
+
+        overdrawn = is_debit & (running < 0)
+        active = numpy.ones(len(accounts), dtype=bool)
+        rejected = []
+        if overdrawn.any():
+            # Where each row's debit and credit ended up in the sorted changes
+            debit_at = numpy.full(high - low, -1, dtype=numpy.int64)
+            credit_at = numpy.full(high - low, -1, dtype=numpy.int64)
+            debit_at[sequences[is_debit] - low] = numpy.flatnonzero(is_debit)
+            credit_at[sequences[~is_debit] - low] = numpy.flatnonzero(~is_debit)
+            groups, first = numpy.unique(group[overdrawn], return_index=True)
+            first_overdraft = dict(zip(groups.tolist(), sequences[overdrawn][first].tolist()))
+            candidates = [(sequence_number, account_group) for account_group, sequence_number
+                          in first_overdraft.items()]
+            heapq.heapify(candidates)
+            while candidates:
+                sequence_number, account_group = heapq.heappop(candidates)
+                if first_overdraft.get(account_group) != sequence_number:
+                    continue  # its account has been checked again since
+                rejected.append(sequence_number)
+                for position in (int(debit_at[sequence_number - low]), int(credit_at[sequence_number - low])):
+                    if position < 0:
+                        continue
+                    active[position] = False
+                    account_group = int(group[position])
+                    end = int(group_end[account_group])
+                    before = running[position] - deltas[position]
+                    running[position:end] = before + numpy.cumsum(numpy.where(active[position:end],
+                                                                              deltas[position:end], 0))
+                    still_overdrawn = numpy.flatnonzero(active[position:end] & is_debit[position:end]
+                                                        & (running[position:end] < 0))
+                    if len(still_overdrawn):
+                        first_overdraft[account_group] = int(sequences[position + still_overdrawn[0]])
+                        heapq.heappush(candidates, (first_overdraft[account_group], account_group))
                     else:
-                        print("Can't delete account #:", row.to, "with a non-zero balance")
-                else:
-                    print("Account name'", row.name, "'didn't match account number")
-    write_master_account_file(master_accounts_file, master_accounts)
-    write_new_valid_accounts_file(master_accounts)
+                        first_overdraft.pop(account_group, None)
+            numpy.add.at(balances, accounts[active], deltas[active])
+        else:
+            numpy.add.at(balances, accounts, deltas)
+        for index in heapq.merge(rejected, (numpy.flatnonzero(create_or_delete[low:high]) + low).tolist()):
+            if create_or_delete[index]:
+                outcome = apply_row(master_accounts, summary.row(index))
+            else:
+                outcome = report_overdraft(summary.row(index))
+            if stats is not None:
+                stats.count_outcome(outcome)
+        low = high
+    # Every account a deposit, withdraw or transfer could have changed (creates and deletes are tracked by apply_row)
+    touched = numpy.unique(numpy.concatenate((to_slots, from_slots)))
+    master_accounts.changed.update(str(slot + DirectAccountStore.FIRST_ACCOUNT) for slot in touched[touched >= 0].tolist())
+
+
+# The account numbers a transaction summary row reads or changes
+def row_accounts(row):
+    if row.transaction_type == TransactionSummaryKeys.transfer:
+        return row.from_act, row.to
+    if row.transaction_type == TransactionSummaryKeys.withdraw:
+        return row.from_act,
+    return row.to,
+
+
+# Rows each transfer is taken to bring to its shard when parse_backend_sharded estimates how many rows a group of linked
+# accounts has (the transfer itself and the other rows of its accounts)
+SHARD_ROWS_PER_TRANSFER = 4
+
+
+# Finds how many rows the bytes from start to end of a merged transaction summary file hold, and the accounts of its
+# transfers as an array of from, to account number pairs (transfers with an account number that can't exist are left
+# out, as they are never applied). Raises ValueError for an unknown transaction code. Runs in a worker process.
+def scan_transfers(file: str, start: int, end: int):
+    pairs = array('l')
+    if start == end:
+        return 0, pairs
+    with open(file, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        lines = mapped[start:end].split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+    codes = {code.encode() for code in KEYS_BY_CODE}
+    transfer = TransactionSummaryKeys.transfer.value.encode()
+    account_to_int = ColumnarTransactionSummary.account_to_int
+    for line in lines:
+        fields = line.split(b' ', 4)
+        if fields[0] == transfer:
+            from_act, to = account_to_int(fields[3]), account_to_int(fields[1])
+            if from_act >= 0 and to >= 0:
+                pairs.append(from_act)
+                pairs.append(to)
+        elif fields[0] not in codes:
+            TransactionSummaryKeys(fields[0].decode())  # raises the ValueError for the unknown code
+    return len(lines), pairs
+
+
+# Decides which shard the accounts linked by transfers go to. Accounts linked by a transfer, directly or through other
+# accounts, have to be in the same shard so no transaction ever needs another shard's balances; the groups are found
+# with a union-find over the transfers and handed to the least loaded shard, largest first, by their estimated rows
+# (see SHARD_ROWS_PER_TRANSFER). Every other account goes to shard account number % shards. Returns a dictionary of
+# account number to shard for the linked accounts, or None if the largest group alone would be more than a shard's
+# share of the rows, in which case sharding can't help.
+def plan_shards(pairs, rows: int, shards: int):
+    parent = {}
+
+    def find(number):
+        root = number
+        while parent[root] != root:
+            root = parent[root]
+        while parent[number] != root:
+            parent[number], number = root, parent[number]
+        return root
+
+    for from_act, to in zip(pairs[::2], pairs[1::2]):
+        first, second = find(parent.setdefault(from_act, from_act)), find(parent.setdefault(to, to))
+        if first != second:
+            parent[max(first, second)] = min(first, second)
+
+    group_transfers = Counter(map(find, pairs[::2]))
+    rows_per_transfer = min(rows / max(1, len(pairs) // 2), SHARD_ROWS_PER_TRANSFER)
+    loads = [(0, shard) for shard in range(shards)]
+    group_shards = {}
+    for root, transfers in group_transfers.most_common():
+        if not group_shards and transfers * rows_per_transfer > rows / shards:
+            return None
+        load, shard = heapq.heappop(loads)
+        group_shards[root] = shard
+        heapq.heappush(loads, (load + transfers * rows_per_transfer, shard))
+    return {number: group_shards[find(number)] for number in parent}
+
+
+# Finds the shard of an account number (bytes) in parse_backend_sharded: the one plan_shards gave it if it is linked to
+# others by transfers, otherwise account number % shards. Numbers that can't be accounts go to shard 0.
+def shard_of(number: bytes, shards: int, transfer_shards) -> int:
+    account = ColumnarTransactionSummary.account_to_int(number)
+    return transfer_shards.get(account, account % shards) if account >= 0 else 0
+
+
+# Splits the lines from start to end of a file between the shards, writing each shard's lines (in file order) to
+# <prefix>_<shard>.txt. For the master accounts file (first_row=None) a line belongs to the shard of its account and
+# the lines are written as they are; also returns the first and last account numbers, or None if the lines aren't
+# sorted. For the merged transaction summary file a row belongs to the shard of the account it takes money from (or its
+# only account), and each line is written after its row index, counting from first_row. Runs in a worker process.
+def route_lines(file: str, start: int, end: int, prefix: str, shards: int, transfer_shards, first_row=None):
+    with open(file, 'rb') as fp:
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if end > start else b''
+        lines = mapped[start:end].split(b'\n')
+        if isinstance(mapped, mmap.mmap):
+            mapped.close()
+    if not lines[-1]:
+        lines.pop()
+    routed = [[] for _ in range(shards)]
+    if first_row is None:
+        numbers = [line.split(b' ', 1)[0] for line in lines]
+        if any(higher <= lower for higher, lower in zip(numbers, numbers[1:])):
+            return None
+        for number, line in zip(numbers, lines):
+            routed[shard_of(number, shards, transfer_shards)].append(line)
+        result = (numbers[0], numbers[-1]) if numbers else ()
+    else:
+        takes_from = (TransactionSummaryKeys.transfer.value.encode(), TransactionSummaryKeys.withdraw.value.encode())
+        for index, line in enumerate(lines, first_row):
+            fields = line.split(b' ', 4)
+            shard = shard_of(fields[3] if fields[0] in takes_from else fields[1], shards, transfer_shards)
+            routed[shard].append(str(index).encode() + b' ' + line)
+        result = ()
+    for shard, shard_lines in enumerate(routed):
+        with open(prefix + '_' + str(shard) + '.txt', 'wb') as fp:
+            fp.writelines(line + b'\n' for line in shard_lines)
+    return result
+
+
+# Applies one shard's part of a day in a worker process: reads the shard's accounts and rows from the files route_lines
+# wrote for each chunk (in chunk order, so in file order) and applies the rows in order. Errors are collected with the
+# index of the row that caused them rather than printed, so they can be printed in file order afterwards. Returns the
+# shard's changed accounts, as (account number, balance, name) with None for the balance and name of a deleted account,
+# and the errors.
+def apply_shard(master_prefixes, summary_prefixes, shard: int):
+    accounts = AccountStore()
+    for prefix in master_prefixes:
+        with open(prefix + '_' + str(shard) + '.txt', 'r') as fp:
+            for line in fp:
+                account_row = line[:-1].split(' ')
+                accounts.add(account_row[0], int(account_row[1]), ' '.join(account_row[2:]))
+    messages = []
+    for prefix in summary_prefixes:
+        with open(prefix + '_' + str(shard) + '.txt', 'r') as fp:
+            for line in fp:
+                transaction_row = line[:-1].split(' ')
+                index = int(transaction_row[0])
+                apply_row(accounts, summary_row(transaction_row[1:]),
+                          lambda *message, index=index: messages.append((index, message)))
+    return [(number, accounts.balance(number), accounts.name(number)) if number in accounts else (number, None, None)
+            for number in accounts.changed], messages
+
+
+# Parallel version of parse_backend, in a ProcessPoolExecutor of shards workers:
+# - The merged transaction summary is scanned in chunks for transfers (scan_transfers), and the accounts they link are
+#   given shards with plan_shards.
+# - Chunks of the master accounts file and the summary are split between the shards on disk (route_lines).
+# - Each worker applies its own shard's rows to its own accounts (apply_shard).
+# No rows or accounts are parsed or pickled in this process, and each line is only handled by one worker in each step.
+# Only the changed accounts come back; the errors are printed in file order and both account files are written as
+# usual with write_account_files, so the output matches parse_backend. Binary summary files, days where one group of
+# linked accounts would hold more than a shard's share of the rows, and master accounts files that aren't sorted are
+# run with parse_backend instead.
+def parse_backend_sharded(master_accounts_file, merged_transaction_summary_file, shards):
+    if os.path.getsize(merged_transaction_summary_file) == 0 or \
+            BinaryTransactionSummaryFormat.is_binary(merged_transaction_summary_file):
+        parse_backend(master_accounts_file, merged_transaction_summary_file)
+        return
+    summary_bounds = summary_chunks(merged_transaction_summary_file,
+                                    max(1 << 16, -(-os.path.getsize(merged_transaction_summary_file) // shards)))
+    master_size = os.path.getsize(master_accounts_file)
+    if master_size:
+        with open(master_accounts_file, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            master_bounds = line_chunks(mapped, master_size, max(1 << 16, -(-master_size // shards)))
+    else:
+        master_bounds = [0]
+    chunks = len(summary_bounds) - 1
+    results = None
+    with ProcessPoolExecutor(shards) as pool, tempfile.TemporaryDirectory() as work_dir:
+        row_counts = [0]
+        pairs = array('l')
+        for chunk_rows, chunk_pairs in pool.map(scan_transfers, [merged_transaction_summary_file] * chunks,
+                                                summary_bounds[:-1], summary_bounds[1:]):
+            row_counts.append(row_counts[-1] + chunk_rows)
+            pairs.extend(chunk_pairs)
+        transfer_shards = plan_shards(pairs, row_counts[-1], shards)
+        del pairs
+        if transfer_shards is not None:
+            master_prefixes = [os.path.join(work_dir, 'master_' + str(chunk)) for chunk in range(len(master_bounds) - 1)]
+            summary_prefixes = [os.path.join(work_dir, 'summary_' + str(chunk)) for chunk in range(chunks)]
+            files = [master_accounts_file] * len(master_prefixes) + [merged_transaction_summary_file] * chunks
+            routed = list(pool.map(route_lines, files, master_bounds[:-1] + summary_bounds[:-1],
+                                   master_bounds[1:] + summary_bounds[1:], master_prefixes + summary_prefixes,
+                                   [shards] * len(files), [transfer_shards] * len(files),
+                                   [None] * len(master_prefixes) + row_counts[:-1]))
+            ends = [number for chunk_ends in routed[:len(master_prefixes)] if chunk_ends for number in chunk_ends]
+            if None not in routed and all(higher > lower for higher, lower in zip(ends[1::2], ends[2::2])):
+                results = list(pool.map(apply_shard, [master_prefixes] * shards, [summary_prefixes] * shards,
+                                        range(shards)))
+    if results is None:
+        parse_backend(master_accounts_file, merged_transaction_summary_file)
+        return
+
+    # Only the changed accounts are needed to write the new files, the rest are copied from the old master accounts file
+    changed_accounts = AccountStore()
+    messages = []
+    for changed, shard_messages in results:
+        for number, balance, name in changed:
+            if balance is not None:
+                changed_accounts.add(number, balance, name)
+            changed_accounts.changed.add(number)
+        messages.extend(shard_messages)
+    for index, message in sorted(messages, key=lambda indexed_message: indexed_message[0]):
+        print(*message)
+    write_account_files(master_accounts_file, changed_accounts)
+
+
+class BackendStats:
+    """
+    Phase timings and counters for a parse_backend run (--stats): how long each phase took, the rows of each
+    transaction type, and the rows rejected as overdrafts, duplicate creates and failed deletes. parse_backend only
+    does the extra per row work when it is given one of these.
+    """
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.phases = []  # (name, start, seconds), start relative to self.start
+        self.rows = {}  # transaction code -> number of rows
+        self.rejected = {OVERDRAFT: 0, DUPLICATE_CREATE: 0, FAILED_DELETE: 0}
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """
+        Times the code run inside the with block as a phase
+        :param name: the phase name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, start - self.start, time.perf_counter() - start))
+
+    def count(self, transaction_type, outcome) -> None:
+        """
+        Counts a row applied with apply_row
+        :param transaction_type: the row's TransactionSummaryKeys
+        :param outcome: what apply_row returned for it
+        """
+        self.rows[transaction_type.value] = self.rows.get(transaction_type.value, 0) + 1
+        if outcome is not None:
+            self.rejected[outcome] += 1
+
+    def count_outcome(self, outcome) -> None:
+        """
+        Counts what apply_row returned for a row whose type was already counted (with count_types)
+        :param outcome: what apply_row returned
+        """
+        if outcome is not None:
+            self.rejected[outcome] += 1
+
+    def count_types(self, summary) -> None:
+        """
+        Counts the rows of each type in a ColumnarTransactionSummary
+        :param summary: the summary
+        """
+        for code, rows in Counter(summary.types).items():
+            key = ColumnarTransactionSummary.TYPES[code]
+            self.rows[key.value] = self.rows.get(key.value, 0) + rows
+
+    def to_dict(self) -> dict:
+        """
+        :return: the stats as a dictionary of plain values, as written by write
+        """
+        stats = {'total_seconds': sum(seconds for name, start, seconds in self.phases),
+                 'phases': {name: seconds for name, start, seconds in self.phases},
+                 'rows': dict(self.rows)}
+        stats.update(self.rejected)
+        return stats
+
+    def write(self, file: str) -> None:
+        """
+        Writes the stats to a JSON file
+        :param file: the file to write
+        """
+        with open(file, 'w') as fp:
+            json.dump(self.to_dict(), fp, indent=2)
+            fp.write('\n')
+
+    def write_trace(self, file: str) -> None:
+        """
+        Writes the phases as a Chrome trace event file (for chrome://tracing or Perfetto), with the counters as counter
+        events at the end
+        :param file: the file to write
+        """
+        events = [{'name': name, 'cat': 'backend', 'ph': 'X', 'ts': start * 1e6, 'dur': seconds * 1e6,
+                   'pid': os.getpid(), 'tid': 0} for name, start, seconds in self.phases]
+        end = max((start + seconds for name, start, seconds in self.phases), default=0) * 1e6
+        events.append({'name': 'rows', 'ph': 'C', 'ts': end, 'pid': os.getpid(), 'args': dict(self.rows)})
+        events.append({'name': 'rejected', 'ph': 'C', 'ts': end, 'pid': os.getpid(), 'args': dict(self.rejected)})
+        with open(file, 'w') as fp:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
+
+
+# Stands in for BackendStats.phase when parse_backend isn't collecting stats
+@contextlib.contextmanager
+def no_phase(name: str):
+    yield
+
+
+# Takes in the old master accounts file and merged transaction summary file. The master accounts are loaded, then the
+# merged transaction summary is streamed one row at a time and each transaction is applied as soon as it is read, so
+# memory use doesn't grow with the length of the summary file. write_account_files is called, being passed the path to
+# the old master accounts file, and the accounts to be written to the new master accounts file. engine picks the
+# account store from ENGINES. The batch engine loads the whole summary into columns, using parse_workers processes,
+# and applies it with apply_summary_batch instead. If stats (a BackendStats) is given, the phases are timed and the rows
+# counted into it.
+def parse_backend(master_accounts_file, merged_transaction_summary_file, engine='dict', parse_workers=1, stats=None):
+    phase = stats.phase if stats is not None else no_phase
+    with phase('load master'):
+        master_accounts = parse_master_account_file(master_accounts_file, ENGINES[engine])
+    if engine == 'batch':
+        with phase('parse summary'):
+            summary = parse_summary_file_parallel(merged_transaction_summary_file, workers=parse_workers)
+        if stats is not None:
+            stats.count_types(summary)
+        with phase('apply'):
+            apply_summary_batch(master_accounts, summary, stats)
+    else:
+        with phase('parse summary + apply'):
+            if stats is None:
+                for row in iter_summary_file(merged_transaction_summary_file):
+                    apply_row(master_accounts, row)
+            else:
+                for row in iter_summary_file(merged_transaction_summary_file):
+                    stats.count(row.transaction_type, apply_row(master_accounts, row))
+    with phase('write'):
+        write_account_files(master_accounts_file, master_accounts)
+
+
+# In-memory version of parse_backend, for callers that already hold the day's transactions (such as daily.py). Applies
+# the TransactionSummaryRows in rows, in order, without going through a merged transaction summary file.
+def parse_backend_rows(master_accounts_file, rows, engine='dict'):
+    master_accounts = parse_master_account_file(master_accounts_file, ENGINES[engine])
+    if engine == 'batch':
+        summary = ColumnarTransactionSummary()
+        for row in rows:
+            summary.add_row(row.transaction_type, row.to, row.cents, row.from_act, row.name)
+        apply_summary_batch(master_accounts, summary)
+    else:
+        for row in rows:
+            apply_row(master_accounts, row)
+    write_account_files(master_accounts_file, master_accounts)
+
+
+# Binary searches a master accounts file (memory mapped, sorted highest account number first) for an account. Returns
+# (start, end) byte offsets: start is where the account's line is, or would be inserted, and end is just past the
+# account's line (including its newline), or None if the account isn't in the file.
+def find_master_record(mapped, number: bytes):
+    low, high = 0, len(mapped)
+    # low is always the start of a line, and every line before it is for a higher account number
+    while low < high:
+        line_start = max(low, mapped.rfind(b'\n', low, (low + high) // 2) + 1)
+        line_end = mapped.find(b'\n', line_start)
+        line_end = len(mapped) if line_end < 0 else line_end
+        key_end = mapped.find(b' ', line_start, line_end)
+        if mapped[line_start:line_end if key_end < 0 else key_end] > number:
+            low = line_end + 1
+        else:
+            high = line_start
+    low = min(low, len(mapped))
+    line_end = mapped.find(b'\n', low)
+    line_end = len(mapped) if line_end < 0 else line_end
+    if mapped[low:line_end].split(b' ', 1)[0] == number:
+        return low, min(line_end + 1, len(mapped))
+    return low, None
+
+
+# Size of the pieces untouched parts of the master accounts file are copied in
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+# Writes a copy of a sorted account file (memory mapped) to out with some of its lines replaced. records are
+# (account number, start, end) from find_master_record, highest account number first: the line from start to end (if
+# end isn't None) is replaced with line(account number), or dropped if that is None. The byte ranges between the
+# records are copied unchanged, COPY_CHUNK_SIZE at a time.
+def splice_records(mapped, records, line, out):
+    position = 0
+    last_byte = b'\n'
+
+    def copy_to(stop):
+        nonlocal position, last_byte
+        while position < stop:
+            chunk = mapped[position:min(stop, position + COPY_CHUNK_SIZE)]
+            out.write(chunk)
+            position += len(chunk)
+            last_byte = chunk[-1:]
+        if last_byte != b'\n':  # the old file didn't end with a newline
+            out.write(b'\n')
+            last_byte = b'\n'
+
+    for number, start, end in records:
+        copy_to(start)
+        new_line = line(number)
+        if new_line is not None:
+            out.write(new_line.encode())
+        if end is not None:
+            position = end
+    copy_to(len(mapped))
+
+
+# The master accounts file line for an account, or None if it isn't in the store
+def master_line(accounts, number):
+    if number not in accounts:
+        return None
+    return number + " " + str(accounts.balance(number)) + " " + accounts.name(number) + "\n"
+
+
+# Rewrites a sorted account file (the master accounts file or valid accounts file) with the lines for the given
+# account numbers replaced by line(account number), or dropped if that is None. Each line is found by binary search
+# with find_master_record, so only the lines that change are looked at; the rest of the file is copied as it is. The
+# new file is written to a temporary file and moved into place.
+def splice_account_file(file: str, numbers, line):
+    with open(file, 'rb') as fp:
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(file) else b''
+    try:
+        records = [(number,) + find_master_record(mapped, number.encode()) for number in sorted(numbers, reverse=True)]
+        with open(file + '.tmp', 'wb') as new_file:
+            splice_records(mapped, records, line, new_file)
+    finally:
+        if isinstance(mapped, mmap.mmap):
+            mapped.close()
+    os.replace(file + '.tmp', file)
+
+
+# The account number of the line starting at start in a memory mapped account file
+def line_number(mapped, start: int) -> bytes:
+    line_end = mapped.find(b'\n', start)
+    return mapped[start:len(mapped) if line_end < 0 else line_end].split(b' ', 1)[0]
+
+
+# Checks that a record found by find_master_record is where it should be: the line before it is for a higher account
+# number, and the line after it (or the line it would be inserted before) for a lower one
+def record_in_order(mapped, number: bytes, start: int, end) -> bool:
+    if start > 0 and line_number(mapped, mapped.rfind(b'\n', 0, start - 1) + 1) <= number:
+        return False
+    following = start if end is None else end
+    return following >= len(mapped) or line_number(mapped, following) < number
+
+
+# Sparse version of parse_backend for days that only touch a few accounts. The merged transaction summary is read once
+# to collect the account numbers it refers to, and only those accounts are found (by binary search with
+# find_master_record) and loaded from the master accounts file, which must be sorted the way the backend writes it.
+# The file isn't read in full to check that: each record the search lands on is checked against the lines on either
+# side of it (record_in_order), and if any is out of place the binary search can't be trusted, so the day is run with
+# parse_backend instead before anything is applied. The transactions are then applied as usual, and the new master
+# accounts file is written by copying the byte ranges between the touched accounts unchanged and writing the touched
+# accounts from the store (splice_records). The valid accounts file is made from the new master accounts file a
+# COPY_CHUNK_SIZE block at a time, cutting each line down to its account number with one regex substitution per block.
+def parse_backend_sparse(master_accounts_file, merged_transaction_summary_file):
+    numbers = set()
+    for row in iter_summary_file(merged_transaction_summary_file):
+        numbers.update(row_accounts(row))
+
+    master_accounts = AccountStore()
+    with open(master_accounts_file, 'rb') as fp:
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(master_accounts_file) else b''
+    try:
+        records = []  # (account number, start, end) for every number the transactions refer to
+        for number in sorted(numbers, reverse=True):
+            start, end = find_master_record(mapped, number.encode())
+            if not record_in_order(mapped, number.encode(), start, end):
+                break
+            if end is not None:
+                account_row = mapped[start:end].decode().replace('\n', '').split(' ')
+                master_accounts.add(number, int(account_row[1]), ' '.join(account_row[2:]))
+            records.append((number, start, end))
+        else:
+            for row in iter_summary_file(merged_transaction_summary_file):
+                apply_row(master_accounts, row)
+            with open(master_accounts_file + '.tmp', 'wb') as new_master:
+                splice_records(mapped, records, lambda number: master_line(master_accounts, number), new_master)
+    finally:
+        if isinstance(mapped, mmap.mmap):
+            mapped.close()
+    if len(records) < len(numbers):
+        parse_backend(master_accounts_file, merged_transaction_summary_file)
+        return
+
+    with open(master_accounts_file + '.tmp', 'rb') as new_master, open("valid_accounts.txt.tmp", 'wb') as valid:
+        while True:
+            chunk = new_master.read(COPY_CHUNK_SIZE) + new_master.readline()
+            if not chunk:
+                break
+            valid.write(re.sub(rb'(?m) [^\n]*', b'', chunk))
+        valid.write(b'0000000\n')
+    os.replace(master_accounts_file + '.tmp', master_accounts_file)
+    os.replace("valid_accounts.txt.tmp", "valid_accounts.txt")
+
+
+# Rough number of bytes a transaction takes up while it is being sorted by parse_backend_out_of_core
+SORT_ROW_BYTES = 256
+# Most sorted runs parse_backend_out_of_core merges at once, to stay well under the open file limit
+MERGE_FAN_IN = 256
+# Rough number of bytes parse_backend_out_of_core keeps in memory for each account involved in a transfer
+TRANSFER_ACCOUNT_BYTES = 256
+
+
+# Writes rows to a new temporary file in dir as a sorted run, highest account number first and in file order within
+# an account. Each row is a (account number, row index, row text) tuple.
+def write_sorted_run(rows, dir):
+    rows.sort(key=lambda row: row[1])
+    rows.sort(key=lambda row: row[0], reverse=True)
+    run_fd, run_file = tempfile.mkstemp(dir=dir, suffix='.run')
+    with os.fdopen(run_fd, 'w') as fp:
+        fp.writelines(number + ' ' + str(index) + ' ' + text + '\n' for number, index, text in rows)
+    return run_file
+
+
+# Reads back a sorted run written by write_sorted_run (or merge_sorted_runs), as (account number, row index, row text)
+def iter_sorted_run(run_file):
+    with open(run_file, 'r') as fp:
+        for line in fp:
+            number, index, text = line[:-1].split(' ', 2)
+            yield number, int(index), text
+
+
+# Merges sorted runs into one iterator in the same order, highest account number first then file order
+def merge_sorted_runs(run_files):
+    return heapq.merge(*map(iter_sorted_run, run_files), key=lambda row: (row[0], -row[1]), reverse=True)
+
+
+# Merges sorted runs MERGE_FAN_IN at a time into new runs in dir until there are no more than MERGE_FAN_IN left, so
+# merge_sorted_runs never has too many files open. Returns the remaining runs.
+def reduce_sorted_runs(run_files, dir):
+    while len(run_files) > MERGE_FAN_IN:
+        merged_fd, merged_file = tempfile.mkstemp(dir=dir, suffix='.run')
+        with os.fdopen(merged_fd, 'w') as fp:
+            fp.writelines(number + ' ' + str(index) + ' ' + text + '\n'
+                          for number, index, text in merge_sorted_runs(run_files[:MERGE_FAN_IN]))
+        for run_file in run_files[:MERGE_FAN_IN]:
+            os.remove(run_file)
+        run_files = run_files[MERGE_FAN_IN:] + [merged_file]
+    return run_files
+
+
+class SqliteAccountSet:
+    """
+    A set of account numbers kept in a table of an SQLite database instead of in memory, for the sets
+    parse_backend_out_of_core can't fit in its memory limit. Has the set methods it uses; iterating gives the numbers
+    highest first.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, table: str) -> None:
+        self.connection = connection
+        self.table = table
+        connection.execute('CREATE TABLE ' + table + ' (number TEXT PRIMARY KEY) WITHOUT ROWID')
+
+    def add(self, number: str) -> None:
+        self.connection.execute('INSERT OR IGNORE INTO ' + self.table + ' VALUES (?)', (number,))
+
+    def update(self, numbers) -> None:
+        self.connection.executemany('INSERT OR IGNORE INTO ' + self.table + ' VALUES (?)',
+                                    ((number,) for number in numbers))
+
+    def __contains__(self, number: str) -> bool:
+        return self.connection.execute('SELECT 1 FROM ' + self.table + ' WHERE number = ?',
+                                       (number,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM ' + self.table).fetchone()[0]
+
+    def __iter__(self):
+        cursor = self.connection.execute('SELECT number FROM ' + self.table + ' ORDER BY number DESC')
+        return (number for number, in cursor)
+
+
+class SqliteAccountStore:
+    """
+    Master accounts kept in a table of an SQLite database instead of in memory, with the same methods as AccountStore.
+    The numbers of the accounts changed since loading are kept in an SqliteAccountSet.
+    """
+
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        self.connection = connection
+        connection.execute('CREATE TABLE accounts '
+                           '(number TEXT PRIMARY KEY, balance INTEGER NOT NULL, name TEXT NOT NULL) WITHOUT ROWID')
+        self.changed = SqliteAccountSet(connection, 'changed')
+
+    def __contains__(self, number: str) -> bool:
+        return self.connection.execute('SELECT 1 FROM accounts WHERE number = ?', (number,)).fetchone() is not None
+
+    def add(self, number: str, balance: int, name: str) -> None:
+        self.connection.execute('INSERT OR REPLACE INTO accounts VALUES (?, ?, ?)', (number, balance, name))
+
+    def balance(self, number: str) -> int:
+        return self.connection.execute('SELECT balance FROM accounts WHERE number = ?', (number,)).fetchone()[0]
+
+    def name(self, number: str) -> str:
+        return self.connection.execute('SELECT name FROM accounts WHERE number = ?', (number,)).fetchone()[0]
+
+    def credit(self, number: str, cents: int) -> None:
+        self.connection.execute('UPDATE accounts SET balance = balance + ? WHERE number = ?', (cents, number))
+        self.changed.add(number)
+
+    def debit(self, number: str, cents: int) -> None:
+        self.credit(number, -cents)
+
+    def create(self, number: str, name: str) -> None:
+        self.add(number, 0, name)
+        self.changed.add(number)
+
+    def delete(self, number: str) -> None:
+        self.connection.execute('DELETE FROM accounts WHERE number = ?', (number,))
+        self.changed.add(number)
+
+
+# Out-of-core version of parse_backend for ledgers that don't fit in memory. Neither the master accounts nor the
+# merged transaction summary are loaded whole, so memory use is set by memory_limit (in bytes) instead of their size:
+# - The summary is read once to find every account involved in a transfer.
+# - It is read again, and the transactions for all other accounts are spilled into sorted runs on disk, keyed by
+#   account and row index. Transactions touching a transfer account are kept, in file order, in a separate file.
+# - The transfer accounts are looked up in the master accounts file (with find_master_record) and that file of
+#   transactions is applied to them in order. These accounts only ever interact with each other, so this small ordered
+#   pass gives the same result as the full run.
+# - The master accounts file is merge-joined against the merged runs, applying each remaining account's transactions
+#   in file order on its own, and the new master accounts and valid accounts files are streamed out.
+# Errors are spilled to sorted runs too, keyed by row index, and merged to print them in file order at the end. The
+# master accounts file must be sorted the way the backend writes it, otherwise ValueError is raised before anything is
+# written. The transfer accounts may use up to half of memory_limit, and the sorted runs get what they leave; if the
+# transfers involve more accounts than that, the transfer accounts and their store are kept in an SQLite database in
+# the work directory instead (SqliteAccountSet and SqliteAccountStore), with its page cache held to half of
+# memory_limit.
+def parse_backend_out_of_core(master_accounts_file, merged_transaction_summary_file, memory_limit, temp_dir=None):
+    max_transfer_accounts = memory_limit // 2 // TRANSFER_ACCOUNT_BYTES
+    with tempfile.TemporaryDirectory(dir=temp_dir) as work_dir:
+        connection = None  # the database for the transfer accounts, if they don't fit in memory
+        try:
+            transfer_accounts = set()
+            for row in iter_summary_file(merged_transaction_summary_file):
+                if row.transaction_type == TransactionSummaryKeys.transfer:
+                    transfer_accounts.update((row.from_act, row.to))
+                    if connection is None and len(transfer_accounts) > max_transfer_accounts:
+                        connection = sqlite3.connect(os.path.join(work_dir, 'transfers.db'))
+                        connection.execute('PRAGMA journal_mode=OFF')
+                        connection.execute('PRAGMA synchronous=OFF')
+                        connection.execute('PRAGMA cache_size=' + str(-max(1, memory_limit // 2 // 1024)))
+                        in_memory, transfer_accounts = transfer_accounts, SqliteAccountSet(connection, 'transfers')
+                        transfer_accounts.update(in_memory)
+                        del in_memory
+            run_rows = max(1, (memory_limit - min(len(transfer_accounts), max_transfer_accounts) *
+                               TRANSFER_ACCOUNT_BYTES) // SORT_ROW_BYTES)
+
+            message_runs = []
+            messages = []  # (row index, message) waiting to be spilled
+
+            def report_for(index):
+                def report(*message):
+                    messages.append(('', index, ' '.join(map(str, message))))
+                    if len(messages) >= run_rows:
+                        message_runs.append(write_sorted_run(messages, work_dir))
+                        messages.clear()
+                return report
+
+            run_files = []
+            buffer = []
+            transfer_file = os.path.join(work_dir, 'transfers.txt')
+            with open(transfer_file, 'w') as transfers:
+                for index, row in enumerate(iter_summary_file(merged_transaction_summary_file)):
+                    number = row_accounts(row)[0]
+                    if number in transfer_accounts:
+                        transfers.write(str(index) + ' ' + str(row) + '\n')
+                        continue
+                    buffer.append((number, index, str(row)))
+                    if len(buffer) >= run_rows:
+                        run_files.append(write_sorted_run(buffer, work_dir))
+                        buffer = []
+            if buffer:
+                run_files.append(write_sorted_run(buffer, work_dir))
+            del buffer
+            run_files = reduce_sorted_runs(run_files, work_dir)
+
+            # The ordered pass over the transfer accounts
+            transfer_store = AccountStore() if connection is None else SqliteAccountStore(connection)
+            with open(master_accounts_file, 'rb') as fp:
+                mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(master_accounts_file) \
+                    else b''
+            try:
+                for number in transfer_accounts:
+                    start, end = find_master_record(mapped, number.encode())
+                    if end is not None:
+                        account_row = mapped[start:end].decode().replace('\n', '').split(' ')
+                        transfer_store.add(number, int(account_row[1]), ' '.join(account_row[2:]))
+            finally:
+                if isinstance(mapped, mmap.mmap):
+                    mapped.close()
+            with open(transfer_file, 'r') as transfers:
+                for line in transfers:
+                    index, text = line[:-1].split(' ', 1)
+                    apply_row(transfer_store, summary_row(text.split(' ')), report_for(int(index)))
+
+            # Merge-join the transfer accounts, the master accounts file and the sorted runs, highest account number
+            # first. For each account the transfer account marker comes first, then its master line, then its rows.
+            def master_lines():
+                previous = None
+                with open(master_accounts_file, 'r') as fp:
+                    for line in fp:
+                        number = line.split(' ', 1)[0]
+                        if previous is not None and number >= previous:
+                            raise ValueError(master_accounts_file + ' is not sorted by account number')
+                        previous = number
+                        yield number, 1, line if line.endswith('\n') else line + '\n'
+
+            descending_transfer_accounts = sorted(transfer_accounts, reverse=True) if connection is None \
+                else transfer_accounts
+            sources = heapq.merge(((number, 0, None) for number in descending_transfer_accounts),
+                                  master_lines(),
+                                  ((number, 2, (index, text)) for number, index, text in merge_sorted_runs(run_files)),
+                                  key=lambda item: item[0], reverse=True)
+            with open(master_accounts_file + '.tmp', 'w') as new_master, \
+                    open("valid_accounts.txt.tmp", 'w') as valid:
+                for number, items in itertools.groupby(sources, key=lambda item: item[0]):
+                    store = None
+                    line = None
+                    for item_number, source, payload in items:
+                        if source == 0:
+                            store = transfer_store
+                        elif source == 1:
+                            line = payload
+                            if store is None:
+                                store = AccountStore()
+                                account_row = line.replace('\n', '').split(' ')
+                                store.add(number, int(account_row[1]), ' '.join(account_row[2:]))
+                        else:
+                            if store is None:
+                                store = AccountStore()
+                            index, text = payload
+                            apply_row(store, summary_row(text.split(' ')), report_for(index))
+                    if number in store:
+                        if number in store.changed or line is None:
+                            new_master.write(number + " " + str(store.balance(number)) + " " + store.name(number) +
+                                             "\n")
+                        else:
+                            new_master.write(line)
+                        valid.write(number + "\n")
+                valid.write('0000000\n')
+        except BaseException:
+            for file in (master_accounts_file + '.tmp', "valid_accounts.txt.tmp"):
+                if os.path.exists(file):
+                    os.remove(file)
+            raise
+        finally:
+            if connection is not None:
+                connection.close()
+        os.replace(master_accounts_file + '.tmp', master_accounts_file)
+        os.replace("valid_accounts.txt.tmp", "valid_accounts.txt")
+        if messages:
+            message_runs.append(write_sorted_run(messages, work_dir))
+        for number, index, message in merge_sorted_runs(reduce_sorted_runs(message_runs, work_dir)):
+            print(message)
+
+
+# Iterates over the rows of a merged transaction summary file from a position, without reading the rows before it.
+# A position is a byte offset into a text file, or a row index into a binary one (whose records are fixed width).
+# Yields (row, position of the next row) for each row up to the end of the summary.
+def iter_summary_file_from(file: str, position: int):
+    if BinaryTransactionSummaryFormat.is_binary(file):
+        for position, row in enumerate(BinaryTransactionSummaryFormat.iter_rows(file, position), position + 1):
+            yield row, position
+        return
+    with open(file, 'rb') as fp:
+        fp.seek(position)
+        for line in fp:
+            position += len(line)
+            transaction_row = line.decode().replace('\n', '').split(' ')
+            if transaction_row[0] == TransactionSummaryKeys.end_of_file.value:
+                return
+            yield summary_row(transaction_row), position
+
+
+# Journaled version of parse_backend, which can pick up where it left off after a crash instead of reprocessing the
+# whole merged transaction summary. journal_dir holds:
+# - input.txt: the merged transaction summary file the journal belongs to
+# - snapshot_<n>_<position>.txt: the master accounts after the first n rows, in the master accounts file format, where
+#   position is where row n starts in the summary file (see iter_summary_file_from)
+# - journal_<n>.log: every row applied after snapshot n, one "<row index> <position of the next row> <row>" line each
+# Each row is appended to the journal before it is applied, and the journal is flushed to disk every sync_every rows.
+# Every snapshot_every rows a new snapshot is written (by merging the changes into the previous one) and a new journal
+# started. A final snapshot is written before the master accounts file is replaced; once both account files are
+# written journal_dir is renamed to journal_dir.done in one step and then removed, so a crash part way through removing
+# it can't leave a journal that would apply the day again. Recovery loads the latest snapshot (the master accounts file
+# itself stands in for snapshot 0), replays its journal without printing errors again, and carries on from the position
+# of the row after the last one journaled, without reading the rows before it. A line cut short by the crash is cut off
+# the journal before anything more is appended to it.
+def parse_backend_journaled(master_accounts_file, merged_transaction_summary_file, journal_dir, engine='dict',
+                            snapshot_every=1000000, sync_every=1000):
+    journal_dir = os.path.normpath(journal_dir)
+    if os.path.exists(journal_dir + '.done'):
+        shutil.rmtree(journal_dir + '.done')  # a finished day that crashed while its journal was being removed
+    os.makedirs(journal_dir, exist_ok=True)
+    input_file = os.path.join(journal_dir, 'input.txt')
+    source = os.path.abspath(merged_transaction_summary_file) + ' ' + \
+        str(os.path.getsize(merged_transaction_summary_file))
+    if os.path.exists(input_file):
+        with open(input_file, 'r') as fp:
+            if fp.read() != source:
+                raise ValueError('Journal in ' + journal_dir + ' belongs to another transaction summary file')
+    else:
+        with open(input_file, 'w') as fp:
+            fp.write(source)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    snapshots = [tuple(map(int, file[len('snapshot_'):-len('.txt')].split('_'))) for file in os.listdir(journal_dir)
+                 if file.startswith('snapshot_') and file.endswith('.txt')]
+    snapshot_rows, snapshot_position = max(snapshots, default=(0, 0))
+    snapshot_file = os.path.join(journal_dir, 'snapshot_' + str(snapshot_rows) + '_' + str(snapshot_position) +
+                                 '.txt') if snapshots else master_accounts_file
+    master_accounts = parse_master_account_file(snapshot_file, ENGINES[engine])
+    index, position = snapshot_rows, snapshot_position  # the next row to apply
+
+    journal_file = os.path.join(journal_dir, 'journal_' + str(snapshot_rows) + '.log')
+    if os.path.exists(journal_file):
+        with open(journal_file, 'rb+') as fp:
+            complete = 0  # bytes up to the end of the last complete line
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    break  # the last line didn't finish being written
+                complete += len(line)
+                transaction_row = line[:-1].decode().split(' ')
+                apply_row(master_accounts, summary_row(transaction_row[2:]), lambda *message: None)
+                index, position = int(transaction_row[0]) + 1, int(transaction_row[1])
+            if complete != fp.tell():
+                fp.truncate(complete)
+                fp.flush()
+                os.fsync(fp.fileno())
+
+    def take_snapshot():
+        nonlocal snapshot_file, snapshot_rows, journal, journal_file
+        journal.flush()
+        os.fsync(journal.fileno())
+        journal.close()
+        new_snapshot = os.path.join(journal_dir, 'snapshot_' + str(index) + '_' + str(position) + '.txt')
+        write_account_files(new_snapshot, master_accounts, source_file=snapshot_file, valid_accounts_file=None)
+        with open(new_snapshot, 'r') as fp:
+            os.fsync(fp.fileno())
+        for file in os.listdir(journal_dir):
+            if file != os.path.basename(new_snapshot) and file.startswith(('snapshot_', 'journal_')):
+                os.remove(os.path.join(journal_dir, file))
+        snapshot_file = new_snapshot
+        snapshot_rows = index
+        journal_file = os.path.join(journal_dir, 'journal_' + str(index) + '.log')
+        journal = open(journal_file, 'a')
+
+    journal = open(journal_file, 'a')
+    try:
+        for row, next_position in iter_summary_file_from(merged_transaction_summary_file, position):
+            journal.write(str(index) + ' ' + str(next_position) + ' ' + str(row) + '\n')
+            index, position = index + 1, next_position
+            if index % sync_every == 0:
+                journal.flush()
+                os.fsync(journal.fileno())
+            apply_row(master_accounts, row)
+            if index % snapshot_every == 0:
+                take_snapshot()
+        if snapshot_rows != index or snapshot_file == master_accounts_file:
+            take_snapshot()
+    finally:
+        journal.close()
+
+    # The final snapshot is the new master accounts file, copy it into place along with the valid accounts
+    write_account_files(master_accounts_file + '.new', master_accounts, source_file=snapshot_file)
+    os.replace(master_accounts_file + '.new', master_accounts_file)
+    os.replace(journal_dir, journal_dir + '.done')
+    shutil.rmtree(journal_dir + '.done')
+
+
+# Rows read and applied at once by parse_backend_sqlite
+SQLITE_BATCH = 10000
+# Most parameters put in one SQL statement (older SQLite builds allow 999)
+SQLITE_MAX_PARAMETERS = 900
+
+
+# Opens (creating if needed) a SQLite ledger for parse_backend_sqlite, in WAL mode. The master accounts live in the
+# accounts table, keyed by account number, and every applied transaction summary row is kept in the history table.
+# A new database is filled from master_accounts_file if one is given.
+def open_sqlite_ledger(db_file, master_accounts_file=None):
+    connection = sqlite3.connect(db_file)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    if connection.execute('PRAGMA user_version').fetchone()[0] == 0:
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS accounts '
+                               '(number TEXT PRIMARY KEY, balance INTEGER NOT NULL, name TEXT NOT NULL) WITHOUT ROWID')
+            connection.execute('CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY, summary_file TEXT, '
+                               'line INTEGER, type TEXT, to_account TEXT, cents INTEGER, from_account TEXT, name TEXT)')
+            connection.execute('CREATE INDEX IF NOT EXISTS history_to ON history (to_account)')
+            connection.execute('CREATE INDEX IF NOT EXISTS history_from ON history (from_account)')
+            if master_accounts_file is not None:
+                with open(master_accounts_file, 'r') as fp:
+                    connection.executemany('INSERT INTO accounts VALUES (?, ?, ?)', (
+                        (account_row[0], int(account_row[1]), ' '.join(account_row[2:]))
+                        for account_row in (line.replace('\n', '').split(' ') for line in fp)))
+            connection.execute('PRAGMA user_version = 1')
+    return connection
+
+
+# Loads the accounts with the given numbers from the ledger into an AccountStore
+def load_sqlite_accounts(connection, numbers):
+    accounts = AccountStore()
+    numbers = list(numbers)
+    for start in range(0, len(numbers), SQLITE_MAX_PARAMETERS):
+        chunk = numbers[start:start + SQLITE_MAX_PARAMETERS]
+        for number, balance, name in connection.execute(
+                'SELECT number, balance, name FROM accounts WHERE number IN (' + ','.join('?' * len(chunk)) + ')',
+                chunk):
+            accounts.add(number, balance, name)
+    return accounts
+
+
+# Writes the master accounts file and valid accounts file from the ledger, in the same format as the text backend
+def export_sqlite_ledger(connection, master_accounts_file, valid_accounts_file="valid_accounts.txt"):
+    with open(master_accounts_file + '.tmp', 'w') as new_master, open(valid_accounts_file + '.tmp', 'w') as new_valid:
+        for number, balance, name in connection.execute('SELECT number, balance, name FROM accounts '
+                                                        'ORDER BY number DESC'):
+            new_master.write(number + " " + str(balance) + " " + name + "\n")
+            new_valid.write(number + "\n")
+        new_valid.write('0000000\n')
+    os.replace(master_accounts_file + '.tmp', master_accounts_file)
+    os.replace(valid_accounts_file + '.tmp', valid_accounts_file)
+
+
+# SQLite version of parse_backend. The merged transaction summary is applied to the ledger in db_file in batches of
+# SQLITE_BATCH rows: the accounts a batch refers to are loaded into an AccountStore, the rows are applied with
+# apply_row, and the changed accounts and the rows themselves are written back with executemany. The whole file is
+# applied in one database transaction, so a failed run leaves the ledger as it was. The master accounts file is used to
+# fill a new database and is then rewritten from the ledger, along with the valid accounts file.
+def parse_backend_sqlite(db_file, master_accounts_file, merged_transaction_summary_file):
+    connection = open_sqlite_ledger(db_file, master_accounts_file)
+    try:
+        with connection:
+            rows = iter_summary_file(merged_transaction_summary_file)
+            line = 0
+            while True:
+                batch = list(itertools.islice(rows, SQLITE_BATCH))
+                if not batch:
+                    break
+                accounts = load_sqlite_accounts(connection, {number for row in batch for number in row_accounts(row)})
+                for row in batch:
+                    apply_row(accounts, row)
+                connection.executemany('INSERT OR REPLACE INTO accounts VALUES (?, ?, ?)', [
+                    (number, accounts.balance(number), accounts.name(number))
+                    for number in accounts.changed if number in accounts])
+                connection.executemany('DELETE FROM accounts WHERE number = ?', [
+                    (number,) for number in accounts.changed if number not in accounts])
+                connection.executemany('INSERT INTO history (summary_file, line, type, to_account, cents, from_account, '
+                                       'name) VALUES (?, ?, ?, ?, ?, ?, ?)', [
+                                           (merged_transaction_summary_file, line + index, row.transaction_type.value,
+                                            row.to, int(row.cents), row.from_act, row.name)
+                                           for index, row in enumerate(batch)])
+                line += len(batch)
+        export_sqlite_ledger(connection, master_accounts_file)
+    finally:
+        connection.close()
+
+
+# Summary files in a drop directory that serve_backend has finished with, as (subdirectory, files)
+SERVE_PROCESSED = 'processed'
+SERVE_FAILED = 'failed'
+
+
+# Checks that apply_row can apply a transaction summary row to the master accounts store, raising ValueError if its
+# amount isn't a whole number of cents or it creates an account the store can't hold. Returns the row.
+def checked_row(row, master_accounts):
+    if row.transaction_type in (TransactionSummaryKeys.deposit, TransactionSummaryKeys.withdraw,
+                                TransactionSummaryKeys.transfer) and int(row.cents) < 0:
+        raise ValueError('negative amount: ' + str(row.cents))
+    if row.transaction_type == TransactionSummaryKeys.createacct and not master_accounts.can_hold(row.to):
+        raise ValueError('Account #: ' + row.to + ' is not a valid account number')
+    return row
+
+
+# Long-running version of parse_backend. The master accounts are loaded once and kept in memory while drop_dir is
+# polled (with stat, every poll_interval seconds) for new merged transaction summary files. Both account files are
+# written once at the start with write_account_files, so they are sorted and match. A file is applied once its size and
+# modification time are the same on two polls in a row, so one that is still being written is left alone; files are
+# applied in name order. After each file the master accounts file is republished with splice_account_file, which only
+# looks at the lines of the accounts the file changed and copies the rest of the file as it is, and the file is moved to
+# drop_dir/processed. The valid accounts file is only republished (the same way) if an account was created or deleted.
+# Both files are moved into place atomically. A file that can't be read, or has a row apply_row couldn't apply to the
+# accounts (see checked_row), is moved to drop_dir/failed without touching the accounts. Hidden and .tmp files are
+# ignored, so writers can create files under those names and rename them when they are done. Runs until interrupted,
+# or until max_files files have been applied.
+def serve_backend(master_accounts_file, drop_dir, engine='dict', poll_interval=1.0, max_files=None):
+    master_accounts = parse_master_account_file(master_accounts_file, ENGINES[engine])
+    write_account_files(master_accounts_file, master_accounts)
+    for subdirectory in (SERVE_PROCESSED, SERVE_FAILED):
+        os.makedirs(os.path.join(drop_dir, subdirectory), exist_ok=True)
+    seen = {}  # file name -> (size, modification time) on the last poll
+    applied = 0
+    try:
+        while max_files is None or applied < max_files:
+            current = {}
+            for entry in os.scandir(drop_dir):
+                if entry.is_file() and not entry.name.startswith('.') and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    current[entry.name] = (stat.st_size, stat.st_mtime_ns)
+            ready = sorted(name for name, stat in current.items() if seen.get(name) == stat)
+            seen = current
+            for name in ready:
+                path = os.path.join(drop_dir, name)
+                try:
+                    rows = [checked_row(row, master_accounts) for row in iter_summary_file(path)]
+                except (OSError, ValueError, IndexError, struct.error) as e:
+                    print('Error: could not read', path + ':', e)
+                    os.replace(path, os.path.join(drop_dir, SERVE_FAILED, name))
+                    continue
+                created_or_deleted = set()
+                for row in rows:
+                    if apply_row(master_accounts, row) is None and row.transaction_type in (
+                            TransactionSummaryKeys.createacct, TransactionSummaryKeys.deleteacct):
+                        created_or_deleted.add(row.to)
+                splice_account_file(master_accounts_file, master_accounts.changed,
+                                    lambda number: master_line(master_accounts, number))
+                if created_or_deleted:
+                    splice_account_file('valid_accounts.txt', created_or_deleted,
+                                        lambda number: number + '\n' if number in master_accounts else None)
+                master_accounts.changed.clear()
+                os.replace(path, os.path.join(drop_dir, SERVE_PROCESSED, name))
+                del seen[name]
+                applied += 1
+                if max_files is not None and applied >= max_files:
+                    break
+            else:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        pass
+
+
+# Parses a size in bytes for --memory-limit, with an optional K, M or G suffix (e.g. 512M)
+def parse_size(size):
+    multiplier = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}.get(size[-1:].upper(), 1)
+    try:
+        value = int(size[:-1] if multiplier > 1 else size) * multiplier
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid size: ' + size)
+    if value < 1:
+        raise argparse.ArgumentTypeError('invalid size: ' + size)
+    return value
 
 
 # Calls parse_backend, passing in the paths to the merged transaction summary file and the old master accounts file.
 def main():
-    parse_backend(os.path.normpath(sys.argv[1]), os.path.normpath(sys.argv[2]))
+    parser = argparse.ArgumentParser(prog='backend', description='Applies a merged transaction summary file to the '
+                                                                 'master accounts file')
+    parser.add_argument('master_accounts_file', nargs='?')
+    parser.add_argument('merged_transaction_summary_file', nargs='?')
+    parser.add_argument('--convert-summary', nargs=2, metavar=('SOURCE', 'DESTINATION'),
+                        help='convert a transaction summary file between the text and binary formats and exit')
+    parser.add_argument('--merge-summaries', nargs='+', metavar=('MERGED', 'SUMMARY'),
+                        help="merge the sessions' transaction summary files into MERGED, in session order, and exit")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='dict',
+                        help='how the master accounts are stored while transactions are applied')
+    parser.add_argument('--shards', type=int,
+                        help='apply the transactions in this many worker processes, split by account')
+    parser.add_argument('--parse-workers', type=int, default=1,
+                        help='parse the merged transaction summary in this many worker processes (batch engine)')
+    parser.add_argument('--sparse', action='store_true',
+                        help="only load the accounts the day's transactions refer to")
+    parser.add_argument('--journal', metavar='DIR',
+                        help='journal applied transactions in DIR so an interrupted run can be resumed')
+    parser.add_argument('--snapshot-every', type=int, default=1000000,
+                        help='snapshot the master accounts after this many transactions (with --journal)')
+    parser.add_argument('--sync-every', type=int, default=1000,
+                        help='flush the journal to disk after this many transactions (with --journal)')
+    parser.add_argument('--sqlite', metavar='DB',
+                        help='keep the master accounts and transaction history in the SQLite database DB (created '
+                             'from the master accounts file if needed) and export the text files from it')
+    parser.add_argument('--serve', metavar='DIR',
+                        help='keep the master accounts in memory and apply merged transaction summary files as they '
+                             'are dropped into DIR')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='seconds between checks of the drop directory (with --serve)')
+    parser.add_argument('--stats', metavar='FILE',
+                        help='write phase timings and row counters to FILE as JSON')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write the phase timings to FILE as a Chrome trace event file')
+    parser.add_argument('--memory-limit', type=parse_size, metavar='SIZE',
+                        help='apply the transactions out of core in about SIZE bytes of memory (e.g. 512M), sorting '
+                             'them on disk; the accounts involved in transfers are kept in an SQLite database on '
+                             'disk if they need more than half of SIZE')
+    args = parser.parse_args()
+    if (args.stats is not None or args.trace is not None) and (
+            args.convert_summary is not None or args.merge_summaries is not None or args.serve is not None or
+            args.sqlite is not None or args.memory_limit is not None or args.sparse or args.journal is not None or
+            args.shards is not None):
+        parser.error('--stats and --trace can only be used with the default mode of the backend')
+    if args.convert_summary is not None:
+        convert_summary_file(*map(os.path.normpath, args.convert_summary))
+        return
+    if args.merge_summaries is not None:
+        merge_summary_files(list(map(os.path.normpath, args.merge_summaries[1:])),
+                            os.path.normpath(args.merge_summaries[0]))
+        return
+    if args.serve is not None:
+        if args.master_accounts_file is None or args.merged_transaction_summary_file is not None:
+            parser.error('--serve takes the master accounts file only')
+        if args.engine == 'batch' or args.shards is not None or args.journal is not None or args.sparse or \
+                args.memory_limit is not None or args.sqlite is not None:
+            parser.error('--serve can only be used with the dict or direct engine')
+        if args.poll_interval < 0:
+            parser.error('--poll-interval must not be negative')
+        serve_backend(os.path.normpath(args.master_accounts_file), args.serve, engine=args.engine,
+                      poll_interval=args.poll_interval)
+        return
+    if args.merged_transaction_summary_file is None:
+        parser.error('the master accounts file and merged transaction summary file are required')
+    if args.engine == 'batch' and numpy is None:
+        parser.error('the batch engine requires numpy')
+    if args.parse_workers < 1:
+        parser.error('--parse-workers must be at least 1')
+    master_accounts_file = os.path.normpath(args.master_accounts_file)
+    merged_transaction_summary_file = os.path.normpath(args.merged_transaction_summary_file)
+    if args.sqlite is not None:
+        if args.engine != 'dict' or args.shards is not None or args.journal is not None or args.sparse or \
+                args.memory_limit is not None:
+            parser.error('--sqlite can only be used with the dict engine')
+        parse_backend_sqlite(args.sqlite, master_accounts_file, merged_transaction_summary_file)
+    elif args.memory_limit is not None:
+        if args.engine != 'dict' or args.shards is not None or args.journal is not None or args.sparse:
+            parser.error('--memory-limit can only be used with the dict engine')
+        try:
+            parse_backend_out_of_core(master_accounts_file, merged_transaction_summary_file, args.memory_limit)
+        except ValueError as e:
+            parser.exit(1, 'Error: ' + str(e) + '\n')
+    elif args.sparse:
+        if args.engine != 'dict' or args.shards is not None or args.journal is not None:
+            parser.error('--sparse can only be used with the dict engine')
+        parse_backend_sparse(master_accounts_file, merged_transaction_summary_file)
+    elif args.journal is not None:
+        if args.engine == 'batch' or args.shards is not None:
+            parser.error('--journal can only be used with the dict or direct engine')
+        if args.snapshot_every < 1 or args.sync_every < 1:
+            parser.error('--snapshot-every and --sync-every must be at least 1')
+        parse_backend_journaled(master_accounts_file, merged_transaction_summary_file, args.journal,
+                                engine=args.engine, snapshot_every=args.snapshot_every, sync_every=args.sync_every)
+    elif args.shards is not None:
+        if args.shards < 1:
+            parser.error('--shards must be at least 1')
+        if args.engine != 'dict':
+            parser.error('--shards can only be used with the dict engine')
+        parse_backend_sharded(master_accounts_file, merged_transaction_summary_file, args.shards)
+    else:
+        stats = BackendStats() if args.stats is not None or args.trace is not None else None
+        parse_backend(master_accounts_file, merged_transaction_summary_file, engine=args.engine,
+                      parse_workers=args.parse_workers, stats=stats)
+        if args.stats is not None:
+            stats.write(args.stats)
+        if args.trace is not None:
+            stats.write_trace(args.trace)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print('Invalid usage, must be of the format "backend master_accounts_file.txt merged_transaction_summary.txt"')
-        exit(1)
     main()
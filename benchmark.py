@@ -0,0 +1,276 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import workload
+from frontend import FrontEndInstance
+
+'''
+Benchmarks for the Quinterac front end and back end. Each benchmark prints a small table so runs at different sizes
+can be compared side by side. These are not run as part of the test suite.
+'''
+
+
+def write_valid_accounts_file(file: str, account_numbers) -> None:
+    """
+    Writes a valid accounts file in the same format the back end produces
+    :param file: the file to write to
+    :param account_numbers: the account numbers to write
+    """
+    with open(file, 'w') as fp:
+        fp.writelines(number + '\n' for number in account_numbers)
+        fp.write('0000000\n')
+
+
+def bench_account_lookup(sizes, lookups: int = 100000, seed: int = 0) -> None:
+    """
+    Times loading a valid accounts file and validating account numbers against it through
+    FrontEndInstance.get_account_number_in_list, for each accounts file size
+    :param sizes: the numbers of valid accounts to benchmark
+    :param lookups: the number of account numbers validated per size
+    :param seed: seed for the random account numbers
+    """
+    rng = random.Random(seed)
+    print('{:>10} {:>12} {:>14}'.format('accounts', 'load (s)', 'lookup (us)'))
+    for size in sizes:
+        account_numbers = [str(number) for number in rng.sample(range(1000000, 10000000), size)]
+        temp_fd, temp_file = tempfile.mkstemp()
+        write_valid_accounts_file(temp_file, account_numbers)
+        instance = FrontEndInstance(temp_file, os.devnull)
+
+        start = time.perf_counter()
+        instance.accounts_list = instance.load_accounts(temp_file)
+        load_time = time.perf_counter() - start
+
+        # Validate a mix of existing accounts through the same path the prompts use
+        stdin = sys.stdin
+        sys.stdin = io.StringIO('\n'.join(rng.choice(account_numbers) for _ in range(lookups)))
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                for _ in range(lookups):
+                    instance.run(instance.get_account_number_in_list())
+                lookup_time = time.perf_counter() - start
+        finally:
+            sys.stdin = stdin
+        print('{:>10} {:>12.4f} {:>14.3f}'.format(size, load_time, lookup_time / lookups * 1e6))
+        os.close(temp_fd)
+        os.remove(temp_file)
+
+
+def generate_sessions(account_numbers, sessions: int, commands: int = 20, agent_share: float = 0.2,
+                      seed: int = 0):
+    """
+    Generates scripted front end sessions, mostly ATM ("machine") with some agent sessions. Each session works on a few
+    accounts in long runs of deposits, withdraws and transfers, so ATM sessions keep running into their daily limits;
+    agents also create and delete accounts. A few inputs are mistyped (unknown accounts, amounts over the single
+    transaction limit) and corrected. The generator follows the daily limits the same way the front end does, so every
+    script lines up with the prompts it will get and ends logged out.
+    :param account_numbers: the valid account numbers
+    :param sessions: the number of sessions
+    :param commands: the number of transaction commands per session
+    :param agent_share: the fraction of agent sessions
+    :param seed: seed for the random sessions
+    :return: list of scripts, one list of input lines per session
+    """
+    rng = random.Random(seed)
+    valid = set(account_numbers)
+    limits = {  # (single transaction limit, daily limit) for machine sessions
+        'deposit': (FrontEndInstance.MAX_DEPOSIT_ATM_ONCE, FrontEndInstance.MAX_DEPOSIT_ATM_DAILY),
+        'withdraw': (FrontEndInstance.MAX_WITHDRAW_ATM_ONCE, FrontEndInstance.MAX_WITHDRAW_ATM_DAILY),
+        'transfer': (FrontEndInstance.MAX_TRANSFER_ATM_ONCE, FrontEndInstance.MAX_TRANSFER_ATM_ONCE),
+    }
+    scripts = []
+    for _ in range(sessions):
+        agent = rng.random() < agent_share
+        script = ['login', 'agent' if agent else 'machine']
+        accounts = rng.sample(account_numbers, min(3, len(account_numbers)))
+        totals = {}  # daily totals per (command, account), as tracked by the session's TransactionSummary
+
+        def account() -> str:
+            if rng.random() < 0.05:
+                script.append('0000001')  # not found, asked again
+            return rng.choice(accounts)
+
+        issued = 0
+        while issued < commands:
+            command = rng.choice(['deposit', 'withdraw', 'transfer', 'createacct', 'deleteacct'] if agent
+                                 else ['deposit', 'withdraw', 'transfer'])
+            # Long runs of the same command, to build up the daily totals
+            for _ in range(min(rng.randint(1, 8) if command in limits else 1, commands - issued)):
+                issued += 1
+                script.append(command)
+                if command == 'createacct':
+                    number = str(rng.randint(1000000, 9999999))
+                    while number in valid:
+                        number = str(rng.randint(1000000, 9999999))
+                    script += [number, 'New acct']
+                    continue
+                if command == 'deleteacct':
+                    script += [account(), 'Old acct']
+                    continue
+                from_account = account()
+                script.append(from_account)
+                if command == 'transfer':
+                    script.append(account())
+                single, daily = limits[command]
+                if agent:
+                    single, daily = FrontEndInstance.MAX_DEPOSIT_TELLER_ONCE, None
+                if rng.random() < 0.05:
+                    script.append(str(single + 1))  # over the single transaction limit, asked again
+                cents = rng.randint(1, min(single, 1000000))
+                script.append(str(cents))
+                if daily is not None:
+                    total = totals.get((command, from_account), 0)
+                    if total + cents > daily:
+                        script.append('q')  # over the daily limit, give up
+                    else:
+                        totals[(command, from_account)] = total + cents
+        scripts.append(script + ['logout'])
+    return scripts
+
+
+def bench_frontend_sessions(sizes, sessions: int = 10000, commands: int = 20, agent_share: float = 0.2,
+                            seed: int = 0) -> None:
+    """
+    Replays generated sessions (see generate_sessions) through FrontEndInstance with scripted input, the way batch
+    mode does, against a valid accounts file of each size, and times each command from its "Command:" prompt to the
+    next one
+    :param sizes: the numbers of valid accounts to benchmark
+    :param sessions: the number of sessions replayed per size
+    :param commands: the number of transaction commands per session
+    :param agent_share: the fraction of agent sessions
+    :param seed: seed for the accounts and sessions
+    """
+    print('{:>10} {:>12} {:>12} {:>10} {:>10}'.format('accounts', 'sessions/s', 'commands/s', 'p50 (us)', 'p99 (us)'))
+    rng = random.Random(seed)
+    for size in sizes:
+        account_numbers = [str(number) for number in rng.sample(range(1000000, 10000000), size)]
+        scripts = generate_sessions(account_numbers, sessions, commands, agent_share, seed)
+        temp_fd, temp_file = tempfile.mkstemp()
+        write_valid_accounts_file(temp_file, account_numbers)
+        accounts = FrontEndInstance.load_accounts(temp_file)
+        latencies = []
+        messages = []
+        transactions = []
+        lines = iter(())
+        last_prompt = None
+
+        def input_fn(prompt: str = '') -> str:
+            nonlocal last_prompt
+            if prompt == FrontEndInstance.input_command:
+                now = time.perf_counter()
+                if last_prompt is not None:
+                    latencies.append(now - last_prompt)
+                last_prompt = now
+            return next(lines)
+
+        start = time.perf_counter()
+        for script in scripts:
+            lines = iter(script)
+            last_prompt = None
+            FrontEndInstance(temp_file, None, input_fn, lambda *values: messages.append(values), accounts,
+                             transactions).front_end_loop()
+            latencies.append(time.perf_counter() - last_prompt)  # the logout
+        elapsed = time.perf_counter() - start
+        os.close(temp_fd)
+        os.remove(temp_file)
+        if messages.count((FrontEndInstance.successful_logout,)) != sessions or \
+                (FrontEndInstance.error_unrecognized_command,) in messages:
+            raise RuntimeError('generated sessions got out of step with the front end')
+        latencies.sort()
+        print('{:>10} {:>12.0f} {:>12.0f} {:>10.1f} {:>10.1f}'.format(
+            size, sessions / elapsed, len(latencies) / elapsed, latencies[len(latencies) // 2] * 1e6,
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e6))
+
+
+def time_backend_phases(master_accounts_file: str, merged_transaction_summary_file: str, engine: str = 'dict') -> None:
+    """
+    Runs backend.parse_backend with a BackendStats and prints its phase times, row count and overdrafts, with the peak
+    RSS, as JSON on the last line of output. Run in a fresh process by bench_backend so the peak RSS is the back end's alone.
+    :param master_accounts_file: the master accounts file
+    :param merged_transaction_summary_file: the merged transaction summary file
+    :param engine: the back end engine (see backend.ENGINES)
+    """
+    import resource
+    import backend
+    stats = backend.BackendStats()
+    backend.parse_backend(master_accounts_file, merged_transaction_summary_file, engine=engine, stats=stats)
+    print(json.dumps({'phases': stats.to_dict()['phases'], 'rows': sum(stats.rows.values()),
+                      'overdrafts': stats.rejected.get(backend.OVERDRAFT, 0),
+                      'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+
+def bench_backend(sizes, rows_per_account: float = 1.0, engine: str = 'dict', mix=None, hot_share: float = 0.0,
+                  seed: int = 0) -> None:
+    """
+    Generates a master accounts file and merged transaction summary for each size (see workload.py) and times the
+    back end on them, each run in its own process
+    :param sizes: the numbers of accounts to benchmark (at most workload.MAX_ACCOUNTS)
+    :param rows_per_account: transactions generated per account
+    :param engine: the back end engine (see backend.ENGINES)
+    :param mix: relative weights of the transaction codes, workload.DEFAULT_MIX if not given
+    :param hot_share: the fraction of the transactions that go to the hottest 1% of accounts
+    :param seed: seed for the generated files
+    """
+    print('{:>10} {:>10} {:>10} {:>10} {:>12} {:>10}  {}'.format('accounts', 'rows', 'overdrafts', 'total (s)', 'rows/s',
+                                                                 'RSS (MB)', 'phases (s)'))
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            master_accounts_file = os.path.join(temp_dir, 'master_accounts.txt')
+            merged_transaction_summary_file = os.path.join(temp_dir, 'merged.txt')
+            numbers = workload.generate_master_accounts(master_accounts_file, min(size, workload.MAX_ACCOUNTS), seed)
+            workload.generate_summary(merged_transaction_summary_file, numbers, int(size * rows_per_account), mix,
+                                      hot_share=hot_share, seed=seed)
+            del numbers
+            # Run in the temporary folder, since the back end writes valid_accounts.txt to the working directory
+            output = subprocess.run(
+                [sys.executable, '-c', 'import sys, benchmark; benchmark.time_backend_phases(*sys.argv[1:])',
+                 master_accounts_file, merged_transaction_summary_file, engine],
+                cwd=temp_dir, env=env, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        total = sum(result['phases'].values())
+        print('{:>10} {:>10} {:>10} {:>10.3f} {:>12.0f} {:>10.1f}  {}'.format(
+            size, result['rows'], result['overdrafts'], total, result['rows'] / total if total else 0,
+            result['peak_rss_kb'] / 1024,
+            ', '.join(phase + ' ' + '{:.3f}'.format(seconds) for phase, seconds in result['phases'].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Quinterac benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    lookup = subparsers.add_parser('lookup', help='valid account lookups in the front end')
+    lookup.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    lookup.add_argument('--lookups', type=int, default=100000)
+    sessions_parser = subparsers.add_parser('sessions', help='front end session throughput and command latency')
+    sessions_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    sessions_parser.add_argument('--sessions', type=int, default=10000)
+    sessions_parser.add_argument('--commands', type=int, default=20, help='transaction commands per session')
+    sessions_parser.add_argument('--agent-share', type=float, default=0.2)
+    backend_parser = subparsers.add_parser('backend', help='the back end on generated days (see workload.py)')
+    backend_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    backend_parser.add_argument('--rows-per-account', type=float, default=1.0)
+    backend_parser.add_argument('--engine', choices=['dict', 'direct', 'batch'], default='dict')
+    backend_parser.add_argument('--mix', type=workload.parse_mix, default=workload.DEFAULT_MIX)
+    backend_parser.add_argument('--hot-share', type=float, default=0.0)
+    args = parser.parse_args()
+    if args.benchmark == 'lookup':
+        bench_account_lookup(args.sizes, args.lookups)
+    elif args.benchmark == 'sessions':
+        bench_frontend_sessions(args.sizes, args.sessions, args.commands, args.agent_share)
+    elif args.benchmark == 'backend':
+        bench_backend(args.sizes, args.rows_per_account, args.engine, args.mix, args.hot_share)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
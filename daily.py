@@ -1,42 +1,169 @@
-import glob
+import argparse
+import io
+import itertools
 import os
-import sys
-import tempfile
+import queue
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 import backend
 import frontend
 
+# Valid accounts loaded by this (worker) process, by valid accounts file, so each worker only loads them once
+worker_accounts = {}
 
-# simulates 3 separate sessions for 1 day
-def main(number_of_sessions=3):
+
+# simulates 3 separate sessions for 1 day. The sessions' transactions are passed straight to the backend in memory,
+# in session order; archive_file is the path to also write them to as a merged transaction summary file, if any.
+def main(number_of_sessions=3, archive_file=None):
+    transactions = []
     for i in range(number_of_sessions):  # run the front end instance 3 times with appropriate inputs
-        # prepare program parameters
-        sys.argv = [
-            'frontend.py',
-            'valid_accounts.txt',
-            'new_transactions/transaction_' + str(i) + '.txt']
-        frontend.main()
-    temp_fd, temp_file = tempfile.mkstemp()
-    merged_transaction_file = temp_file
-    transaction_files = glob.glob("new_transactions/*.txt")  # list of transaction summary files
-    with open(merged_transaction_file, 'w') as wf:  # create merged txn summary file
-        for file in transaction_files:
-            with open(file, 'r') as tf:
-                for line in tf:
-                    if line != 'EOS 0000000 000 0000000 ***':
-                        wf.write(line)
-        wf.write('EOS 0000000 000 0000000 ***')
-    for transaction in transaction_files:
-        os.remove(transaction)
-    # run backend with updated files
-    sys.argv = [
-        'backend.py',
-        'master_accounts.txt',
-        merged_transaction_file]
-    backend.main()
-    os.close(temp_fd)
-    os.remove(temp_file)
+        frontend.FrontEndInstance('valid_accounts.txt', None, summary_sink=transactions).front_end_loop()
+    apply_day(transactions, archive_file)
+
+
+# Writes the archive copy of the day's transactions if asked to, and runs the backend with them
+def apply_day(transactions, archive_file=None):
+    if archive_file is not None:
+        archive = frontend.TransactionSummary(archive_file)
+        archive.extend(transactions)
+        archive.to_file()
+    # run backend with the day's transactions
+    backend.parse_backend_rows('master_accounts.txt', transactions)
+
+
+# Runs one terminal's command script (a file name or list of lines) in batch mode, in a worker process. Returns the
+# transactions of its sessions and its terminal output.
+def run_script(valid_accounts_file, script):
+    if valid_accounts_file not in worker_accounts:
+        worker_accounts[valid_accounts_file] = frontend.FrontEndInstance.load_accounts(valid_accounts_file)
+    transactions = []
+    output = io.StringIO()
+    frontend.run_batch(script, valid_accounts_file, accounts=worker_accounts[valid_accounts_file], output=output,
+                       summary_sink=transactions)
+    return transactions, output.getvalue()
+
+
+# Parallel version of main: runs each terminal's command script (see frontend.run_batch) at the same time in a pool of
+# worker processes (one per core by default). Whatever order the scripts finish in, their transactions are passed to
+# the backend in the order the scripts were given, and their terminal output is printed in that order too.
+def run_day(scripts, workers=None, archive_file=None):
+    workers = workers or os.cpu_count() or 1
+    transactions = []
+    with ProcessPoolExecutor(workers) as pool:
+        for script_transactions, output in pool.map(run_script, ['valid_accounts.txt'] * len(scripts), scripts,
+                                                    chunksize=max(1, len(scripts) // (workers * 4))):
+            transactions.extend(script_transactions)
+            print(output, end='')
+    apply_day(transactions, archive_file)
+
+
+# Put on apply_sessions' queue instead of the final None when a script fails, so the day isn't written
+ABORT_DAY = 'abort'
+
+
+# Applies the scripts' transactions to the master accounts as they arrive on finished (queue of (script number,
+# (transactions, output)) and a final None), in script order: a script that finishes early is held until the ones
+# before it have been applied. Returns once every script has been applied and the account files have been written.
+# If ABORT_DAY arrives instead of None, it returns without writing the account files and removes the archive, leaving
+# the day to be run again from the start like run_day does.
+def apply_sessions(finished, archive_file=None):
+    master_accounts = backend.parse_master_account_file('master_accounts.txt')
+    waiting = {}  # finished scripts that can't be applied until an earlier one is
+    next_script = 0
+    archive = open(archive_file, 'w') if archive_file is not None else None
+    aborted = False
+    try:
+        while True:
+            item = finished.get()
+            if item is None:
+                break
+            if item == ABORT_DAY:
+                aborted = True
+                break
+            waiting[item[0]] = item[1]
+            while next_script in waiting:
+                transactions, output = waiting.pop(next_script)
+                print(output, end='')
+                for row in transactions:
+                    backend.apply_row(master_accounts, row)
+                if archive is not None:
+                    archive.writelines(str(row) + '\n' for row in transactions)
+                next_script += 1
+        if archive is not None and not aborted:
+            archive.write('EOS 0000000 000 0000000 ***')
+    finally:
+        if archive is not None:
+            archive.close()
+    if aborted:
+        if archive is not None:
+            os.remove(archive_file)
+        return
+    backend.write_account_files('master_accounts.txt', master_accounts)
+
+
+# Pipelined version of run_day. The backend doesn't wait for the whole day: each script's transactions are handed
+# through a bounded queue (of queue_size scripts) to a backend thread as soon as the script finishes, and applied right
+# away in script order, so the backend works while the front end sessions are still running. At the end only the
+# master accounts and valid accounts files are left to write. The account files and archive come out the same as with
+# run_day; each script's terminal output is printed just before it is applied, so the backend's errors come straight
+# after the output of the script that caused them instead of after all the front end output. Scripts are only submitted
+# to the pool up to queue_size past the first one that hasn't finished, so a slow script can't leave the pool and the
+# backend holding the results of every script after it. If a script fails, its error is raised and, as with run_day,
+# the account files are left as they were.
+def run_day_pipelined(scripts, workers=None, archive_file=None, queue_size=64):
+    workers = workers or os.cpu_count() or 1
+    finished = queue.Queue(queue_size)
+    with ThreadPoolExecutor(1) as backend_worker, ProcessPoolExecutor(workers) as pool:
+        applied = backend_worker.submit(apply_sessions, finished, archive_file)
+
+        def hand_over(item):
+            while True:  # wait for room in the queue, unless the backend thread has stopped
+                try:
+                    return finished.put(item, timeout=0.1)
+                except queue.Full:
+                    if applied.done():
+                        applied.result()  # raises whatever stopped it
+                        return
+
+        try:
+            to_submit = enumerate(scripts)
+            running = {}  # future -> script number
+            finished_scripts = set()  # finished scripts after next_script
+            next_script = 0  # the first script that hasn't finished
+            submitted = 0
+            while True:
+                for number, script in itertools.islice(to_submit, max(0, next_script + queue_size - submitted)):
+                    running[pool.submit(run_script, 'valid_accounts.txt', script)] = number
+                    submitted += 1
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    number = running.pop(future)
+                    hand_over((number, future.result()))
+                    finished_scripts.add(number)
+                while next_script in finished_scripts:
+                    finished_scripts.remove(next_script)
+                    next_script += 1
+        except BaseException:
+            hand_over(ABORT_DAY)
+            raise
+        hand_over(None)
+        applied.result()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(prog='daily', description='Runs a day of front end sessions and the backend. '
+                                                               'With no scripts the sessions are read from stdin.')
+    parser.add_argument('scripts', nargs='*', help="command scripts to run in parallel, one per terminal")
+    parser.add_argument('--workers', type=int, help='number of worker processes (one per core by default)')
+    parser.add_argument('--archive', metavar='FILE', help="also write the day's merged transaction summary to FILE")
+    parser.add_argument('--pipeline', action='store_true',
+                        help='apply each script to the master accounts as soon as it finishes')
+    args = parser.parse_args()
+    if args.scripts and args.pipeline:
+        run_day_pipelined(args.scripts, args.workers, args.archive)
+    elif args.scripts:
+        run_day(args.scripts, args.workers, args.archive)
+    else:
+        main(archive_file=args.archive)
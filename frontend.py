@@ -1,8 +1,11 @@
 import enum
+import mmap
 import os.path
 import re
+import struct
 import sys
-from typing import List
+from array import array
+from typing import Callable, Dict, Generator, List, Optional, Set, Tuple
 
 
 class TransactionSummaryKeys(enum.Enum):
@@ -22,11 +25,18 @@ class TransactionSummary(list):
     """
     Object to represent a transaction summary, has functionality to write to file
     :param summary_file: The file which will be written to
+    :param sink: A list the rows are added to by to_file instead of writing summary_file, to pass them on in memory
     """
 
-    def __init__(self, summary_file=None) -> None:
+    # Transaction types whose daily limit is tracked against the from account rather than the to account
+    FROM_ACCOUNT_TYPES: Tuple[TransactionSummaryKeys, ...] = (TransactionSummaryKeys.transfer, TransactionSummaryKeys.withdraw)
+
+    def __init__(self, summary_file=None, sink: list = None) -> None:
         super().__init__()
         self.summary_file = summary_file
+        self.sink = sink
+        # Running total of cents per (transaction type, account), kept up to date by add_row
+        self.daily_totals: Dict[Tuple[TransactionSummaryKeys, str], int] = {}
 
     class TransactionSummaryRow:
         """
@@ -37,7 +47,7 @@ class TransactionSummary(list):
         :param from_act: The account to send from
         :param name: the account name
         """
-
+        __slots__ = ('transaction_type', 'to', 'cents', 'from_act', 'name')
 
         # TransactionSummaryRow
         def __init__(self, transaction_type: TransactionSummaryKeys, to: str, cents: str,
@@ -67,41 +77,249 @@ class TransactionSummary(list):
         :param name: the account name
         """
         self.append(self.TransactionSummaryRow(transaction_type, to, cents, from_act, name))
+        # Transfers and withdraws count against the from account, everything else against the to account
+        if transaction_type in self.FROM_ACCOUNT_TYPES:
+            key = (transaction_type, from_act)
+        else:
+            key = (transaction_type, to)
+        self.daily_totals[key] = self.daily_totals.get(key, 0) + int(cents)
 
     def total_within_daily_limit(self, output_key: TransactionSummaryKeys,
                                  account_number: str, amount: int, limit: int) -> bool:
         """
-        Check if a transaction is within the current daily limit, by summing the interactions of the same type on
-        the specific account
+        Check if a transaction is within the current daily limit, using the running total of the interactions of the
+        same type on the specific account
         :param output_key: The transactionType
         :param account_number: The account number to check against
         :param amount: The amount of cents to add/transfer/withdraw
         :param limit: The limit for that type of transaction
         :return: Returns true if transaction within daily limit
         """
-        # If transfer or withdraw match the from account
-        if (output_key == TransactionSummaryKeys.transfer
-                or output_key == TransactionSummaryKeys.withdraw):
-            transactions_to_sum = filter(
-                lambda row: row.transaction_type == output_key and account_number == row.from_act, self)
-        # Otherwise look at the to account
+        return self.daily_totals.get((output_key, account_number), 0) <= (limit - amount)
+
+    def to_file(self, binary: bool = False) -> None:
+        """
+        Writes the transaction summary to file (or adds its rows to the sink) and clears it
+        :param binary: write the fixed width binary format (see BinaryTransactionSummaryFormat) instead of text
+        """
+        if self.sink is not None:
+            self.sink.extend(self)
+            self.clear()
+            self.daily_totals.clear()
+            return
+        if os.path.dirname(self.summary_file):
+            os.makedirs(os.path.dirname(self.summary_file), exist_ok=True)  # make all folders and file if necessary
+        if binary:
+            BinaryTransactionSummaryFormat.write(self, self.summary_file)
         else:
-            transactions_to_sum = filter(
-                lambda row: row.transaction_type == output_key and account_number == row.to, self)
+            self.add_row(TransactionSummaryKeys.end_of_file)
+            with open(self.summary_file, 'w') as fp:
+                fp.write('\n'.join(map(lambda row: str(row), self)))
+        self.clear()
+        self.daily_totals.clear()
+
+
+class ColumnarTransactionSummary:
+    """
+    Compact transaction summary that stores each field in its own typed column instead of keeping a row object per
+    transaction. Iterating yields TransactionSummaryRow objects, so it can be used anywhere a TransactionSummary is
+    read, and to_file writes the same text format.
+    :param summary_file: The file which will be written to
+    """
+
+    # Transaction types by their one byte code in the types column
+    TYPES: Tuple[TransactionSummaryKeys, ...] = tuple(TransactionSummaryKeys)
+    TYPE_CODES: Dict[TransactionSummaryKeys, int] = {key: code for code, key in enumerate(TYPES)}
+    # Stored in place of account fields that aren't 7 digits (these can never match a real account)
+    NO_ACCOUNT: int = -1
+    NO_ACCOUNT_STR: str = '*******'
+
+    def __init__(self, summary_file=None) -> None:
+        self.summary_file = summary_file
+        self.types: array = array('b')
+        self.to_accounts: array = array('l')
+        self.cents: array = array('q')
+        self.from_accounts: array = array('l')
+        self.names: List[str] = []
+
+    @staticmethod
+    def account_to_int(account: str) -> int:
+        """
+        Converts an account field to its column value
+        :param account: the account number string
+        :return: the account number or NO_ACCOUNT if it isn't 7 digits
+        """
+        return int(account) if len(account) == 7 and account.isdigit() else ColumnarTransactionSummary.NO_ACCOUNT
+
+    @staticmethod
+    def account_to_str(account: int) -> str:
+        """
+        Converts an account column value back to the 7 digit string used in summary files
+        :param account: the account column value
+        :return: the account number string
+        """
+        return '%07d' % account if account >= 0 else ColumnarTransactionSummary.NO_ACCOUNT_STR
+
+    def add_row(self, transaction_type: TransactionSummaryKeys, to: str = '0000000',
+                cents: str = '000',
+                from_act: str = '0000000', name: str = '***') -> None:
+        """
+        Method to add a new row to the transaction summary
+        :param transaction_type: The transactionType
+        :param to: The account to send to
+        :param cents: The cents to write to
+        :param from_act: The account to send from
+        :param name: the account name
+        """
+        self.types.append(self.TYPE_CODES[transaction_type])
+        self.to_accounts.append(self.account_to_int(to))
+        self.cents.append(int(cents))
+        self.from_accounts.append(self.account_to_int(from_act))
+        # Share the placeholder name between rows rather than keeping a copy per row
+        self.names.append('***' if name == '***' else name)
+
+    def __len__(self) -> int:
+        return len(self.types)
+
+    def row(self, index: int) -> TransactionSummary.TransactionSummaryRow:
+        """
+        Builds the row at a position in the summary
+        :param index: the position of the row
+        :return: the row as a TransactionSummaryRow
+        """
+        cents = self.cents[index]
+        return TransactionSummary.TransactionSummaryRow(self.TYPES[self.types[index]],
+                                                        self.account_to_str(self.to_accounts[index]),
+                                                        str(cents) if cents else '000',
+                                                        self.account_to_str(self.from_accounts[index]),
+                                                        self.names[index])
+
+    def __iter__(self):
+        types = self.TYPES
+        account_to_str = self.account_to_str
+        for type_code, to, cents, from_act, name in zip(self.types, self.to_accounts, self.cents,
+                                                        self.from_accounts, self.names):
+            yield TransactionSummary.TransactionSummaryRow(types[type_code], account_to_str(to),
+                                                           str(cents) if cents else '000',
+                                                           account_to_str(from_act), name)
 
-        return sum(map(lambda row: int(row.cents), transactions_to_sum)) <= (limit - amount)
+    def clear(self) -> None:
+        """
+        Removes every row from the summary
+        """
+        del self.types[:], self.to_accounts[:], self.cents[:], self.from_accounts[:], self.names[:]
 
-    def to_file(self) -> None:
+    def to_file(self, binary: bool = False) -> None:
         """
         Writes the transaction summary to file and clears it
+        :param binary: write the fixed width binary format (see BinaryTransactionSummaryFormat) instead of text
         """
-        self.add_row(TransactionSummaryKeys.end_of_file)
-        os.makedirs(os.path.dirname(self.summary_file), exist_ok=True)  # make all folders and file if necessary
-        with open(self.summary_file, 'w') as fp:
-            fp.write('\n'.join(map(lambda row: str(row), self)))
+        if os.path.dirname(self.summary_file):
+            os.makedirs(os.path.dirname(self.summary_file), exist_ok=True)  # make all folders and file if necessary
+        if binary:
+            BinaryTransactionSummaryFormat.write(self, self.summary_file)
+        else:
+            self.add_row(TransactionSummaryKeys.end_of_file)
+            with open(self.summary_file, 'w') as fp:
+                fp.write('\n'.join(map(lambda row: str(row), self)))
         self.clear()
 
 
+class BinaryTransactionSummaryFormat:
+    """
+    Fixed width binary transaction summary file format, which can be read back without re-tokenizing every line.
+    Little endian, laid out as:
+    - header: magic b'QTSB', format version (uint8), row count (uint64)
+    - one record per row: type code (uint8, ColumnarTransactionSummary.TYPE_CODES), to account (int32), from account
+      (int32), cents (int64). Accounts that aren't 7 digits are stored as ColumnarTransactionSummary.NO_ACCOUNT
+    - name offset table: row count + 1 uint64 offsets into the names block, name i is names[offset[i]:offset[i + 1]]
+    - names block: the utf-8 account names
+    There is no EOS row, the row count marks the end of the summary.
+    """
+    MAGIC: bytes = b'QTSB'
+    VERSION: int = 1
+    HEADER: struct.Struct = struct.Struct('<4sBQ')
+    RECORD: struct.Struct = struct.Struct('<Biiq')
+    OFFSET: struct.Struct = struct.Struct('<Q')
+
+    @staticmethod
+    def is_binary(file: str) -> bool:
+        """
+        Checks whether a summary file is in the binary format
+        :param file: the summary file
+        :return: True if the file starts with the binary format's magic bytes
+        """
+        with open(file, 'rb') as fp:
+            return fp.read(len(BinaryTransactionSummaryFormat.MAGIC)) == BinaryTransactionSummaryFormat.MAGIC
+
+    @staticmethod
+    def write(rows, file: str) -> None:
+        """
+        Writes transaction summary rows to a binary summary file, skipping any EOS rows
+        :param rows: the TransactionSummaryRows to write
+        :param file: the file to write to
+        """
+        form = BinaryTransactionSummaryFormat
+        type_codes = ColumnarTransactionSummary.TYPE_CODES
+        account_to_int = ColumnarTransactionSummary.account_to_int
+        rows = [row for row in rows if row.transaction_type != TransactionSummaryKeys.end_of_file]
+        names = [row.name.encode() for row in rows]
+        with open(file, 'wb') as fp:
+            fp.write(form.HEADER.pack(form.MAGIC, form.VERSION, len(rows)))
+            fp.writelines(form.RECORD.pack(type_codes[row.transaction_type], account_to_int(row.to),
+                                           account_to_int(row.from_act), int(row.cents)) for row in rows)
+            offset = 0
+            fp.write(form.OFFSET.pack(offset))
+            for name in names:
+                offset += len(name)
+                fp.write(form.OFFSET.pack(offset))
+            fp.writelines(names)
+
+    @staticmethod
+    def iter_columns(file: str, start: int = 0):
+        """
+        Reads a binary summary file. The file is memory mapped and the records are unpacked straight out of the
+        mapping through a memoryview, so nothing but the names is copied.
+        :param file: the binary summary file to read
+        :param start: the index of the first row to read, the rows before it are skipped without being unpacked
+        :return: an iterator of (type code, to account, from account, cents, name) tuples, in file order
+        """
+        form = BinaryTransactionSummaryFormat
+        with open(file, 'rb') as fp:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        # The mapping isn't closed explicitly, the views below still point into it until the reader is discarded
+        view = memoryview(mapped)
+        magic, version, count = form.HEADER.unpack_from(view)
+        if magic != form.MAGIC or version != form.VERSION:
+            raise ValueError(file + ' is not a version ' + str(form.VERSION) + ' binary transaction summary')
+        records_end = form.HEADER.size + count * form.RECORD.size
+        offsets_end = records_end + (count + 1) * form.OFFSET.size
+        start = min(start, count)
+        offsets = form.OFFSET.iter_unpack(view[records_end + start * form.OFFSET.size:offsets_end])
+        names = view[offsets_end:]
+        name_start, = next(offsets)
+        for (type_code, to, from_act, cents), (name_end,) in zip(
+                form.RECORD.iter_unpack(view[form.HEADER.size + start * form.RECORD.size:records_end]), offsets):
+            name = names[name_start:name_end]
+            yield type_code, to, from_act, cents, '***' if name == b'***' else str(name, 'utf-8')
+            name_start = name_end
+
+    @staticmethod
+    def iter_rows(file: str, start: int = 0):
+        """
+        Reads a binary summary file as TransactionSummaryRows
+        :param file: the binary summary file to read
+        :param start: the index of the first row to read
+        :return: an iterator of the rows, in file order
+        """
+        types = ColumnarTransactionSummary.TYPES
+        account_to_str = ColumnarTransactionSummary.account_to_str
+        for type_code, to, from_act, cents, name in BinaryTransactionSummaryFormat.iter_columns(file, start):
+            yield TransactionSummary.TransactionSummaryRow(types[type_code], account_to_str(to),
+                                                           str(cents) if cents else '000',
+                                                           account_to_str(from_act), name)
+
+
 class FrontEndInstance:
     """
     This is a class to represent an instance of the front end.
@@ -111,14 +329,24 @@ class FrontEndInstance:
 
     :param accounts_file: The file that this instance will read accounts from
     :param transaction_summary_file: The file that will be written to once logout is inputted
+    :param input_fn: called with a prompt to read each line of user input (input by default)
+    :param output_fn: called with each message for the user (print by default)
+    :param accounts: valid accounts already loaded (and possibly shared with other instances), used at login instead
+                     of reading accounts_file. The set is never modified.
+    :param summary_sink: a list the transactions are added to at logout instead of writing transaction_summary_file
     """
 
-    def __init__(self, accounts_file: str, transaction_summary_file: str) -> None:
+    def __init__(self, accounts_file: str, transaction_summary_file: str,
+                 input_fn: Callable[[str], str] = input, output_fn: Callable[..., None] = print,
+                 accounts: Set[str] = None, summary_sink: list = None) -> None:
 
         self.accounts_file: str = accounts_file
         self.user_status: self.UserState = self.UserState('idle')
-        self.transaction_summary: TransactionSummary = TransactionSummary(transaction_summary_file)
-        self.accounts_list: List[str] = []
+        self.transaction_summary: TransactionSummary = TransactionSummary(transaction_summary_file, summary_sink)
+        self.accounts_list: Set[str] = set()
+        self.input_fn: Callable[[str], str] = input_fn
+        self.output_fn: Callable[..., None] = output_fn
+        self.accounts: Set[str] = accounts
 
     # Const max values that are relevant to this class and should be easy to find
     MAX_DEPOSIT_ATM_ONCE: int = 200000
@@ -239,72 +467,105 @@ class FrontEndInstance:
         """
         return 'Error: must be less than or equal to ' + max_value + ' cents'
 
+    @staticmethod
+    def load_accounts(accounts_file: str) -> Set[str]:
+        """
+        Loads the valid accounts file into a set so account lookups don't depend on the number of accounts
+        :param accounts_file: the valid accounts file to read
+        :return: set of valid account numbers, without the 0000000 terminator
+        """
+        with open(accounts_file) as fp:
+            accounts = set(fp.read().splitlines())
+        accounts.discard('0000000')
+        return accounts
+
     def front_end_loop(self) -> None:
         """
-        Method called by constructor to loop through user input and handle appropriately
+        Method called by constructor to loop through user input and handle appropriately, reading each line of input
+        with input_fn
+        """
+        self.run(self.session())
+
+    def run(self, steps: Generator[str, str, Optional[str]]) -> Optional[str]:
+        """
+        Runs a session (or one of its prompts) to the end, answering each prompt it yields with input_fn
+        :param steps: the generator from session or one of the methods that prompt for input
+        :return: what the generator returns
+        """
+        try:
+            prompt = next(steps)
+            while True:
+                prompt = steps.send(self.input_fn(prompt))
+        except StopIteration as stop:
+            return stop.value
+
+    def session(self) -> Generator[str, str, None]:
         """
-        print(FrontEndInstance.first_launch_message)
+        The front end loop as a generator, so the caller decides how input is read: each prompt is yielded, and the line
+        the user enters in reply is sent back in. Ends after logout or quit. The methods below that prompt for input
+        work the same way and are run with yield from.
+        """
+        self.output_fn(FrontEndInstance.first_launch_message)
         while True:
-            user_command = input(FrontEndInstance.input_command)
+            user_command = yield FrontEndInstance.input_command
             try:
                 parsed_command = self.Commands(user_command.lower().strip())
                 if parsed_command == self.Commands.quit:
                     return
                 # Prevent all other commands but login before logging in
                 elif self.user_status == self.UserState.idle and parsed_command != self.Commands.login:
-                    print(FrontEndInstance.not_logged_in_message)
+                    self.output_fn(FrontEndInstance.not_logged_in_message)
                 # login
                 elif parsed_command == self.Commands.login:
-                    self.login()
+                    yield from self.login()
                 # logout
                 elif parsed_command == self.Commands.logout:
                     if self.logout():
                         return
                 # createacct
                 elif parsed_command == self.Commands.createacct:
-                    self.create_account()
+                    yield from self.create_account()
                 # deleteacct
                 elif parsed_command == self.Commands.deleteacct:
-                    self.delete_account()
+                    yield from self.delete_account()
                 # deposit
                 elif parsed_command == self.Commands.deposit:
-                    self.deposit()
+                    yield from self.deposit()
                 # withdraw
                 elif parsed_command == self.Commands.withdraw:
-                    self.withdraw()
+                    yield from self.withdraw()
                 # transfer
                 elif parsed_command == self.Commands.transfer:
-                    self.transfer()
+                    yield from self.transfer()
                 elif parsed_command == self.Commands.help:
-                    print(self.HELP_TEXT)
+                    self.output_fn(self.HELP_TEXT)
             except ValueError:
-                print(FrontEndInstance.error_unrecognized_command)
+                self.output_fn(FrontEndInstance.error_unrecognized_command)
 
-    def login(self) -> None:
+    def login(self) -> Generator[str, str, None]:
         """
         Method allowing users to log into a user state (atm or teller)
         Returns true if the user entered exit
         """
         if self.user_status != self.UserState.idle:  # if already signed in
-            print(FrontEndInstance.error_logged_in_login)
+            self.output_fn(FrontEndInstance.error_logged_in_login)
             return
         while True:
-            user_input = input(self.LOGIN_MESSAGE)
+            user_input = yield self.LOGIN_MESSAGE
             try:
                 parsed_login = self.UserState(user_input.lower().strip())
                 if parsed_login == self.UserState.atm or parsed_login == self.UserState.agent:  # Input is atm or agent
                     self.user_status = parsed_login
-                    with open(self.accounts_file) as fp:
-                        self.accounts_list = fp.read().splitlines()  # Load the accounts
-                        if '0000000' in self.accounts_list: self.accounts_list.remove('0000000')
-                    print(FrontEndInstance.successful_login(parsed_login))
+                    self.accounts_list = self.accounts if self.accounts is not None \
+                        else self.load_accounts(self.accounts_file)
+                    self.output_fn(FrontEndInstance.successful_login(parsed_login))
                     return
             except ValueError:
                 if user_input == self.Commands.cancel.value:  # If cancel command inputted
                     return
                 elif user_input == self.Commands.quit.value:
                     return
-                print(FrontEndInstance.unrecognized_login_command(user_input))
+                self.output_fn(FrontEndInstance.unrecognized_login_command(user_input))
                 continue
 
     def logout(self) -> bool:
@@ -312,68 +573,68 @@ class FrontEndInstance:
         Method allowing users to log out of a user state
         """
         if self.user_status == self.UserState.idle:  # If user not logged in
-            print(FrontEndInstance.error_logged_out_logout_message)
+            self.output_fn(FrontEndInstance.error_logged_out_logout_message)
             return False
         self.transaction_summary.to_file()  # Write the transaction to summary file
-        self.accounts_list.clear()  # Clear the accounts list (login populates it again if logged in again)
+        self.accounts_list = set()  # Drop the accounts list (login populates it again if logged in again)
         self.user_status = self.UserState.idle  # Actually set the session to logged out
-        print(FrontEndInstance.successful_logout)
+        self.output_fn(FrontEndInstance.successful_logout)
         return True
 
-    def create_account(self) -> None:
+    def create_account(self) -> Generator[str, str, None]:
         """
         Method allowing users to create an account
         """
         if self.user_status != self.UserState.agent:  # If user not in agent state
-            print(self.missing_user_state_for_command(self.UserState.agent, self.Commands.createacct))
+            self.output_fn(self.missing_user_state_for_command(self.UserState.agent, self.Commands.createacct))
             return
         while True:
-            account_number = self.get_valid_account_number()
+            account_number = yield from self.get_valid_account_number()
             if account_number is None:  # If cancel command
                 return
             if account_number in self.accounts_list:
-                print(FrontEndInstance.error_account_number_already_exists)
+                self.output_fn(FrontEndInstance.error_account_number_already_exists)
                 continue
             break
-        account_name = self.get_valid_account_name()
+        account_name = yield from self.get_valid_account_name()
         if account_name is None:  # If cancel command
             return
         self.transaction_summary.add_row(
             TransactionSummaryKeys.createacct,
             to=account_number, name=account_name)
-        print(FrontEndInstance.successful_create)
+        self.output_fn(FrontEndInstance.successful_create)
 
-    def delete_account(self) -> None:
+    def delete_account(self) -> Generator[str, str, None]:
         """
         Method allowing users to delete accounts
         """
         if self.user_status != self.UserState.agent:  # If user not in agent state
-            print(self.missing_user_state_for_command(self.UserState.agent, self.Commands.deleteacct))
+            self.output_fn(self.missing_user_state_for_command(self.UserState.agent, self.Commands.deleteacct))
             return
-        account_number = self.get_account_number_in_list()
+        account_number = yield from self.get_account_number_in_list()
         if account_number is None:  # If cancel command inputted
             return
-        account_name = self.get_valid_account_name()
+        account_name = yield from self.get_valid_account_name()
         if account_name is None:  # If cancel command inputted
             return
         self.transaction_summary.add_row(
             TransactionSummaryKeys.deleteacct,
             to=account_number, name=account_name)
-        print(FrontEndInstance.successful_delete)
+        self.output_fn(FrontEndInstance.successful_delete)
 
-    def deposit(self) -> None:
+    def deposit(self) -> Generator[str, str, None]:
         """
         Method allowing users to deposit an amount of money into an account
         """
         if self.user_status == self.UserState.idle:  # If user not logged in
-            print(FrontEndInstance.must_be_signed_in_for_command(self.Commands.deposit))
+            self.output_fn(FrontEndInstance.must_be_signed_in_for_command(self.Commands.deposit))
             return
-        account_number = self.get_account_number_in_list()
+        account_number = yield from self.get_account_number_in_list()
         if account_number is None:
             return
         while True:
             # Check number less than max single transaction
-            cents = FrontEndInstance.get_valid_numeric_amount(
+            cents = yield from self.get_valid_numeric_amount(
                 self.MAX_DEPOSIT_ATM_ONCE if self.user_status == self.UserState.atm else self.MAX_DEPOSIT_TELLER_ONCE)
             if cents is None:  # If cancel command inputted
                 return
@@ -387,24 +648,24 @@ class FrontEndInstance:
                 self.transaction_summary.add_row(
                     TransactionSummaryKeys.deposit,
                     to=account_number, cents=cents)
-                print(FrontEndInstance.successful_deposit)
+                self.output_fn(FrontEndInstance.successful_deposit)
                 return
             else:
-                print(FrontEndInstance.error_deposit_over_max)
+                self.output_fn(FrontEndInstance.error_deposit_over_max)
 
-    def withdraw(self) -> None:
+    def withdraw(self) -> Generator[str, str, None]:
         """
         Method allowing users to withdraw an amount of money from an account
         """
         if self.user_status == self.UserState.idle:  # If user not logged in
-            print(FrontEndInstance.must_be_signed_in_for_command(self.Commands.withdraw))
+            self.output_fn(FrontEndInstance.must_be_signed_in_for_command(self.Commands.withdraw))
             return
-        account_number = self.get_account_number_in_list()
+        account_number = yield from self.get_account_number_in_list()
         if account_number is None:
             return
         while True:
             # Get number less than max single transaction
-            cents = FrontEndInstance.get_valid_numeric_amount(
+            cents = yield from self.get_valid_numeric_amount(
                 self.MAX_WITHDRAW_ATM_ONCE if self.user_status == self.UserState.atm
                 else self.MAX_WITHDRAW_AGENT_ONCE)
             if cents is None:  # If cancel command inputted
@@ -419,30 +680,30 @@ class FrontEndInstance:
                 self.transaction_summary.add_row(
                     TransactionSummaryKeys.withdraw,
                     cents=cents, from_act=account_number)
-                print(FrontEndInstance.successful_withdraw)
+                self.output_fn(FrontEndInstance.successful_withdraw)
                 return
             else:
-                print(FrontEndInstance.error_withdraw_over_max)
+                self.output_fn(FrontEndInstance.error_withdraw_over_max)
 
-    def transfer(self) -> None:
+    def transfer(self) -> Generator[str, str, None]:
         """
         Method allowing users to transfer money between accounts
         """
         if self.user_status == self.UserState.idle:
-            print(FrontEndInstance.must_be_signed_in_for_command(self.Commands.withdraw))
+            self.output_fn(FrontEndInstance.must_be_signed_in_for_command(self.Commands.withdraw))
             return
 
-        from_account = self.get_account_number_in_list(self.input_from)
+        from_account = yield from self.get_account_number_in_list(self.input_from)
         if from_account is None:
             return
 
-        to_account = self.get_account_number_in_list(self.input_to)
+        to_account = yield from self.get_account_number_in_list(self.input_to)
         if to_account is None:
             return
 
         while True:
             # Check number less than max single transaction
-            cents = self.get_valid_numeric_amount(
+            cents = yield from self.get_valid_numeric_amount(
                 self.MAX_TRANSFER_ATM_ONCE if self.user_status == self.UserState.atm else self.MAX_TRANSFER_AGENT_ONCE)
             if cents is None:  # If cancel command inputted
                 return
@@ -455,10 +716,10 @@ class FrontEndInstance:
                 self.transaction_summary.add_row(
                     TransactionSummaryKeys.transfer,
                     to_account, cents, from_account)
-                print(FrontEndInstance.successful_transfer)
+                self.output_fn(FrontEndInstance.successful_transfer)
                 return
             else:
-                print(FrontEndInstance.error_transfer_over_max)
+                self.output_fn(FrontEndInstance.error_transfer_over_max)
 
     @staticmethod
     def valid_account_name(name: str) -> bool:
@@ -478,80 +739,155 @@ class FrontEndInstance:
         """
         return number is not None and re.search(r'^[1-9][0-9]{6}$', number) is not None
 
-    @staticmethod
-    def get_valid_account_number() -> str or None:
+    def get_valid_account_number(self) -> Generator[str, str, Optional[str]]:
         """
         Gets a syntactically correct account number
         :return: Account number or None if cancel command inputted
         """
         while True:
-            account_number = input(FrontEndInstance.input_account_number)
+            account_number = yield FrontEndInstance.input_account_number
             if FrontEndInstance.valid_account_number(account_number):
                 return account_number
             elif account_number == FrontEndInstance.Commands.cancel.value:
                 return None
             else:
-                print(FrontEndInstance.invalid_account_number)
+                self.output_fn(FrontEndInstance.invalid_account_number)
 
-    def get_account_number_in_list(self, prompt=input_account_number) -> str or None:
+    def get_account_number_in_list(self, prompt=input_account_number) -> Generator[str, str, Optional[str]]:
         """
         Gets a valid account number, validating against the accounts_list
         :param prompt: the user prompt to provide the user
         :return: The account number or None if exit command inputted
         """
         while True:
-            account_number = input(prompt)
+            account_number = yield prompt
             if account_number in self.accounts_list:
                 return account_number
             elif account_number == self.Commands.cancel.value:
                 return None
             else:
-                print(FrontEndInstance.error_account_not_found)
+                self.output_fn(FrontEndInstance.error_account_not_found)
 
-    @staticmethod
-    def get_valid_account_name() -> str or None:
+    def get_valid_account_name(self) -> Generator[str, str, Optional[str]]:
         """
         Gets a syntactically correct account name
         :return: a valid account name from user input or None if exit command inputted
         """
         while True:
-            account_name = input(FrontEndInstance.input_account_name)
+            account_name = yield FrontEndInstance.input_account_name
             if FrontEndInstance.valid_account_name(account_name):
                 return account_name
             elif account_name == FrontEndInstance.Commands.cancel.value:
                 return None
             else:
-                print(FrontEndInstance.invalid_account_name)
+                self.output_fn(FrontEndInstance.invalid_account_name)
 
-    @staticmethod
-    def get_valid_numeric_amount(max_value: int) -> str or None:
+    def get_valid_numeric_amount(self, max_value: int) -> Generator[str, str, Optional[str]]:
         """
         Get valid numeric string representing an amount of cents
         :param max_value: The max amount of cents to accept
         :return: a valid cents amount less than or equal to max value or None if exit command provided
         """
         while True:
-            cents = input(FrontEndInstance.input_cents).replace(',', '')
+            cents = (yield FrontEndInstance.input_cents).replace(',', '')
             try:
                 cents_int = int(cents)
                 if cents_int <= 0:
-                    print(FrontEndInstance.error_numeric_not_positive)
+                    self.output_fn(FrontEndInstance.error_numeric_not_positive)
                 elif cents_int <= max_value:
                     return str(cents_int)
                 else:
-                    print(FrontEndInstance.error_cents_less_than_or_equal(str(max_value)))
+                    self.output_fn(FrontEndInstance.error_cents_less_than_or_equal(str(max_value)))
             except ValueError:
                 if cents == FrontEndInstance.Commands.cancel.value:
                     return None
-                print(FrontEndInstance.parse_number_error)
+                self.output_fn(FrontEndInstance.parse_number_error)
+
+
+def session_summary_file(summary_file: str, session: int) -> str:
+    """
+    Names the transaction summary file of one session of a batch script, so every session gets its own file
+    :param summary_file: the summary file name, with {} standing for the session number. Without {}, the first
+                         session writes to summary_file itself and session n to summary_file with _n added before the
+                         extension (summary.txt, summary_1.txt, summary_2.txt, ...)
+    :param session: the session number, from 0
+    :return: the session's transaction summary file
+    """
+    if '{}' in summary_file:
+        return summary_file.replace('{}', str(session))
+    if session == 0:
+        return summary_file
+    root, extension = os.path.splitext(summary_file)
+    return root + '_' + str(session) + extension
+
+
+def run_batch(script, accounts_file: str, summary_file: str = None, accounts: Set[str] = None, output=None,
+              summary_sink: list = None) -> int:
+    """
+    Runs a script of front end commands through FrontEndInstance without prompting, for replays and load tests.
+    The script holds the same lines a user would type, for any number of sessions one after another (each session
+    ends at logout or quit, like the command line front end). Prompts aren't written, and the other messages are
+    buffered and written out once at the end instead of printed one at a time.
+    :param script: the commands file to run, or an iterable of command lines
+    :param accounts_file: the valid accounts file, loaded once for the whole script unless accounts is given
+    :param summary_file: the transaction summary file for each session, see session_summary_file
+    :param accounts: valid accounts already loaded, shared by every session
+    :param output: where the messages are written at the end (sys.stdout by default)
+    :param summary_sink: a list every session's transactions are added to, in session order, instead of writing
+                         summary files
+    :return: the number of sessions run
+    """
+    if isinstance(script, str):
+        with open(script) as fp:
+            return run_batch(fp, accounts_file, summary_file, accounts, output, summary_sink)
+    if accounts is None:
+        accounts = FrontEndInstance.load_accounts(accounts_file)
+    lines = iter(script)
+    pending: List[str] = []  # a line read ahead to check the script hasn't ended
+    messages: List[str] = []
+
+    def input_fn(prompt: str = '') -> str:
+        if pending:
+            return pending.pop()
+        try:
+            return next(lines).rstrip('\r\n')
+        except StopIteration:
+            raise EOFError  # the same as input() at the end of stdin
+
+    def output_fn(*values) -> None:
+        messages.append(' '.join(map(str, values)))
+
+    sessions = 0
+    try:
+        while True:
+            try:
+                pending.append(input_fn())
+            except EOFError:
+                break
+            try:
+                session_file = session_summary_file(summary_file, sessions) if summary_file is not None else None
+                FrontEndInstance(accounts_file, session_file, input_fn, output_fn, accounts, summary_sink).front_end_loop()
+            except EOFError:  # the script ended partway through a session
+                break
+            finally:
+                sessions += 1
+    finally:
+        if messages:
+            (output or sys.stdout).write('\n'.join(messages) + '\n')
+    return sessions
 
 
 def main():
+    if len(sys.argv) == 4:
+        run_batch(os.path.normpath(sys.argv[3]), os.path.normpath(sys.argv[1]), os.path.normpath(sys.argv[2]))
+        return
     FrontEndInstance(os.path.normpath(sys.argv[1]), os.path.normpath(sys.argv[2])).front_end_loop()
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print('Invalid usage, must be of the format "frontend accounts_file.txt transaction_summary.txt"')
+    if len(sys.argv) not in (3, 4):
+        print('Invalid usage, must be of the format "frontend accounts_file.txt transaction_summary.txt '
+              '[commands_script.txt]". With a commands script, {} in the transaction summary file name is replaced by '
+              'the session number; without {}, sessions after the first get _1, _2, ... added before the extension')
         exit(1)
     main()
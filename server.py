@@ -0,0 +1,156 @@
+import argparse
+import asyncio
+import os
+import re
+import sys
+from typing import Set
+
+from frontend import FrontEndInstance
+
+'''
+Serves many front end sessions at once over TCP or a Unix socket, so a fleet of ATMs doesn't need one front end process
+per terminal. Each connection gets its own FrontEndInstance with the same commands and messages as the command line
+front end, reading a line of input at a time from the socket.
+'''
+
+
+class FrontEndServer:
+    """
+    Runs FrontEndInstance sessions for socket connections.
+    The valid accounts file is loaded once and shared (read only) by every session. Each session's state machine is
+    FrontEndInstance.session, driven from the event loop: its prompts are written to the connection and each line read
+    from it is sent back in, so a session waiting for input only holds its generator and its connection, not a thread.
+    Session n writes its transaction summary to summary_dir/transaction_<n>.txt. Sessions are
+    numbered on from the highest transaction_<n>.txt already in summary_dir, so a restarted server doesn't overwrite
+    summaries that haven't been merged yet.
+
+    :param accounts_file: The valid accounts file shared by all sessions
+    :param summary_dir: The folder the sessions' transaction summary files are written to
+    :param max_sessions: The most sessions served at once, later connections are told they are waiting and wait for a
+                         session to end
+    :param loop: The event loop to serve on (the current event loop by default)
+    """
+
+    def __init__(self, accounts_file: str, summary_dir: str, max_sessions: int = 64,
+                 loop: asyncio.AbstractEventLoop = None) -> None:
+        self.accounts_file: str = accounts_file
+        self.summary_dir: str = summary_dir
+        self.accounts = FrontEndInstance.load_accounts(accounts_file)
+        self.max_sessions: int = max_sessions
+        self.loop: asyncio.AbstractEventLoop = loop or asyncio.get_event_loop()
+        self.free_sessions: asyncio.Semaphore = asyncio.Semaphore(max_sessions, loop=self.loop) \
+            if sys.version_info < (3, 10) else asyncio.Semaphore(max_sessions)
+        self.session_count: int = self.first_session()
+        self.readers: Set[asyncio.StreamReader] = set()  # the connections of the sessions running or waiting now
+        self.finished: Set[asyncio.Future] = set()  # set when each session running or waiting now has ended
+
+    def first_session(self) -> int:
+        """
+        Finds the number of the first session, after the summary files already in summary_dir
+        :return: one more than the highest session number in summary_dir, or 0 if there are none
+        """
+        if not os.path.isdir(self.summary_dir):
+            return 0
+        sessions = [int(match.group(1)) for match in map(re.compile(r'transaction_(\d+)\.txt$').match,
+                                                         os.listdir(self.summary_dir)) if match]
+        return max(sessions, default=-1) + 1
+
+    def summary_file(self, session: int) -> str:
+        """
+        Makes the transaction summary file name for a session
+        :param session: the session number, in connection order from 0
+        :return: the file the session writes to at logout
+        """
+        return os.path.join(self.summary_dir, 'transaction_' + str(session) + '.txt')
+
+    async def handle_session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Runs a front end session for one connection, closing it when the session ends or the client disconnects
+        :param reader: the connection's input
+        :param writer: the connection's output
+        """
+        session = self.session_count
+        self.session_count += 1
+        if len(self.readers) >= self.max_sessions:
+            writer.write(b'All terminals are busy, please wait\n')
+        self.readers.add(reader)
+        finished = self.loop.create_future()
+        self.finished.add(finished)
+
+        def output_fn(*values) -> None:
+            writer.write((' '.join(map(str, values)) + '\n').encode())
+
+        try:
+            async with self.free_sessions:
+                instance = FrontEndInstance(self.accounts_file, self.summary_file(session), output_fn=output_fn,
+                                            accounts=self.accounts)
+                steps = instance.session()
+                prompt = next(steps)
+                while True:
+                    writer.write(prompt.encode())
+                    await writer.drain()
+                    line = await reader.readline()
+                    if not line:  # the client disconnected
+                        break
+                    prompt = steps.send(line.decode().rstrip('\r\n'))
+        except StopIteration:  # the session ended at logout or quit
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.readers.discard(reader)
+            self.finished.discard(finished)
+            finished.set_result(None)
+            writer.close()
+
+    async def stop(self) -> None:
+        """
+        Ends the running and waiting sessions as if their clients had disconnected (so nothing is written for sessions
+        that haven't logged out) and waits for them to finish
+        """
+        for reader in self.readers:
+            reader.feed_eof()
+        await asyncio.gather(*self.finished)
+
+    async def start(self, host: str = None, port: int = None, path: str = None) -> asyncio.AbstractServer:
+        """
+        Starts listening for connections
+        :param host: the host to listen on over TCP
+        :param port: the port to listen on over TCP (0 picks a free port)
+        :param path: the Unix socket to listen on instead of TCP
+        :return: the listening server
+        """
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle_session, path)
+        return await asyncio.start_server(self.handle_session, host, port)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='server', description='Serves front end sessions over TCP or a Unix socket')
+    parser.add_argument('accounts_file')
+    parser.add_argument('summary_dir', help='folder for the transaction summary file of each session')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8327)
+    parser.add_argument('--unix', metavar='PATH', help='listen on a Unix socket instead of TCP')
+    parser.add_argument('--max-sessions', type=int, default=64, help='most sessions served at once')
+    args = parser.parse_args()
+    if args.max_sessions < 1:
+        parser.error('--max-sessions must be at least 1')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    front_end_server = FrontEndServer(os.path.normpath(args.accounts_file), os.path.normpath(args.summary_dir),
+                                      args.max_sessions, loop)
+    server = loop.run_until_complete(front_end_server.start(args.host, args.port, args.unix))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.run_until_complete(front_end_server.stop())
+        loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
+import io
 import os
+import random
 import sys
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from importlib import reload
 
+import pytest
+
 import backend as app
 
 path = os.path.dirname(os.path.abspath(__file__))
@@ -69,12 +74,689 @@ def test_withdraw_P4(capsys):
            )
 
 
+def test_deposit_p1(capsys):
+    helper(capsys,
+           merged_transaction_summary=['DEP 1234567 250 0000000 ***', 'DEP 7654321 250 0000000 ***',
+                                       'EOS 0000000 000 0000000 ***'],
+           master_accounts_list=['1234567 1000 nam'],
+           expected_output_master_accounts_file=['1234567 1250 nam'],
+           expected_tail_of_terminal_output=[],
+           expected_valid_accounts_file=['1234567', '0000000']
+           )
+
+
+def test_transfer_p1(capsys):
+    helper(capsys,
+           merged_transaction_summary=['XFR 1234567 400 7654321 ***', 'XFR 1234567 700 7654321 ***',
+                                       'EOS 0000000 000 0000000 ***'],
+           master_accounts_list=['7654321 1000 from acct', '1234567 5 to acct'],
+           expected_output_master_accounts_file=['7654321 600 from acct', '1234567 405 to acct'],
+           expected_tail_of_terminal_output=[
+               'Error: transferring 700 would cause a negative balance in account #: 7654321'],
+           expected_valid_accounts_file=['7654321', '1234567', '0000000']
+           )
+
+
+def test_delete_p1(capsys):
+    helper(capsys,
+           merged_transaction_summary=['DEL 7654321 000 0000000 rich', 'DEL 1234567 000 0000000 wrong',
+                                       'DEL 1234567 000 0000000 empty', 'EOS 0000000 000 0000000 ***'],
+           master_accounts_list=['7654321 10 rich', '1234567 0 empty'],
+           expected_output_master_accounts_file=['7654321 10 rich'],
+           expected_tail_of_terminal_output=["Can't delete account #: 7654321 with a non-zero balance",
+                                             "Account name' wrong 'didn't match account number"],
+           expected_valid_accounts_file=['7654321', '0000000']
+           )
+
+
+def test_direct_engine(capsys):
+    helper(capsys,
+           merged_transaction_summary=['NEW 2000000 000 0000000 new acct', 'DEP 2000000 900 0000000 ***',
+                                       'XFR 1234567 400 2000000 ***', 'XFR 1234567 700 2000000 ***',
+                                       'WDR 0000000 5 nam ***', 'DEL 7654321 000 0000000 empty',
+                                       'NEW 1234567 000 0000000 dup', 'EOS 0000000 000 0000000 ***'],
+           master_accounts_list=['7654321 0 empty', '1234567 5 to acct'],
+           expected_output_master_accounts_file=['2000000 500 new acct', '1234567 405 to acct'],
+           expected_tail_of_terminal_output=[
+               'Error: transferring 700 would cause a negative balance in account #: 2000000',
+               'Error: account #: 1234567 already exists'],
+           expected_valid_accounts_file=['2000000', '1234567', '0000000'],
+           extra_args=['--engine', 'direct']
+           )
+
+
+def random_day(rng, account_count, row_count):
+    """Makes a master accounts list and a merged transaction summary with lots of overdrafts, creates and deletes"""
+    numbers = [str(number) for number in rng.sample(range(1000000, 1000000 + account_count * 2), account_count * 2)]
+    existing = numbers[:account_count]
+    master_accounts_list = [number + ' ' + str(rng.choice([0, rng.randint(0, 5000)])) + ' acct ' + number
+                            for number in sorted(existing, reverse=True)]
+
+    def pick():
+        return rng.choice(numbers) if rng.random() < 0.97 else rng.choice(['0000000', '0123456', 'nam'])
+
+    rows = []
+    for _ in range(row_count):
+        kind = rng.choices(['DEP', 'WDR', 'XFR', 'NEW', 'DEL'], [30, 30, 30, 5, 5])[0]
+        cents = str(rng.randint(1, 3000))
+        if kind == 'DEP':
+            rows.append('DEP ' + pick() + ' ' + cents + ' 0000000 ***')
+        elif kind == 'WDR':
+            rows.append('WDR 0000000 ' + cents + ' ' + pick() + ' ***')
+        elif kind == 'XFR':
+            from_act = pick()
+            to = from_act if rng.random() < 0.05 else pick()
+            rows.append('XFR ' + to + ' ' + cents + ' ' + from_act + ' ***')
+        else:
+            # The direct address engines can only hold valid account numbers, which the front end guarantees
+            number = rng.choice(numbers)
+            rows.append(kind + ' ' + number + ' 000 0000000 acct ' + (number if rng.random() < 0.8 else 'other'))
+    rows.append('EOS 0000000 000 0000000 ***')
+    return master_accounts_list, rows
+
+
+def run_engine(capsys, master_accounts_list, merged_transaction_summary, engine='dict', run=None):
+    """Runs parse_backend (or run) in the current directory and returns the output files and terminal output"""
+    with open('master_accounts.txt', 'w') as wf:
+        wf.write('\n'.join(master_accounts_list))
+    with open('merged.txt', 'w') as wf:
+        wf.write('\n'.join(merged_transaction_summary))
+    capsys.readouterr()
+    if run is None:
+        app.parse_backend('master_accounts.txt', 'merged.txt', engine=engine)
+    else:
+        run('master_accounts.txt', 'merged.txt')
+    with open('master_accounts.txt', 'rb') as master, open('valid_accounts.txt', 'rb') as valid:
+        return master.read(), valid.read(), capsys.readouterr().out
+
+
+def test_batch_engine_matches_serial(capsys, tmp_path, monkeypatch):
+    pytest.importorskip('numpy')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app, 'BATCH_WINDOW', 64)
+    monkeypatch.setattr(app, 'BATCH_MIN_RUN', 4)
+    rng = random.Random(327)
+    for _ in range(5):
+        master_accounts_list, rows = random_day(rng, 60, 2000)
+        expected = run_engine(capsys, master_accounts_list, rows, 'dict')
+        assert run_engine(capsys, master_accounts_list, rows, 'batch') == expected
+        assert run_engine(capsys, master_accounts_list, rows, 'direct') == expected
+
+
+def test_batch_engine_with_many_overdrafts(capsys, tmp_path, monkeypatch):
+    import workload
+    pytest.importorskip('numpy')
+    monkeypatch.chdir(tmp_path)
+    # Thousands of overdrafts, many of them in long runs on the hot accounts
+    for mix, hot_share in (({'WDR': 1}, 0.0), ({'WDR': 6, 'XFR': 3, 'DEP': 1}, 0.5), (None, 0.2)):
+        numbers = workload.generate_master_accounts('generated.txt', 2000, seed=7)
+        workload.generate_summary('merged_generated.txt', numbers, 20000, mix, hot_share=hot_share, seed=7)
+        with open('generated.txt') as master, open('merged_generated.txt') as merged:
+            master_accounts_list, rows = master.read().splitlines(), merged.read().splitlines()
+        expected = run_engine(capsys, master_accounts_list, rows, 'dict')
+        assert expected[2].count('negative balance') > 200
+        assert run_engine(capsys, master_accounts_list, rows, 'batch') == expected
+
+
+def test_sharded_backend_matches_serial(capsys, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(8)
+    # random_day links nearly every account through transfers, so its days run with parse_backend; these days only have
+    # a few transfers and are really split into shards
+    numbers = [str(number) for number in range(1000000, 1000300)]
+
+    def few_transfers_row(index):
+        if index % 10 == 0:
+            return ['NEW 2000000 000 0000000 new', 'DEL 2000000 000 0000000 new',
+                    'DEL ' + rng.choice(numbers) + ' 000 0000000 acct'][index // 10 % 3]
+        if index % 10 == 5:
+            return 'XFR ' + rng.choice(numbers) + ' ' + str(rng.randint(1, 300)) + ' ' + rng.choice(numbers) + ' ***'
+        return rng.choice(['DEP ' + rng.choice(numbers) + ' ' + str(rng.randint(1, 300)) + ' 0000000 ***',
+                           'WDR 0000000 ' + str(rng.randint(1, 300)) + ' ' + rng.choice(numbers) + ' ***'])
+
+    few_transfers = (sorted((number + ' ' + str(rng.randint(0, 500)) + ' acct ' + number for number in numbers),
+                            reverse=True),
+                     [few_transfers_row(index) for index in range(1000)] + ['EOS 0000000 000 0000000 ***'])
+    for shards in (1, 3):
+        for master_accounts_list, rows in (random_day(rng, 60, 2000), few_transfers):
+            expected = run_engine(capsys, master_accounts_list, rows)
+            assert run_engine(capsys, master_accounts_list, rows,
+                              run=lambda master, merged: app.parse_backend_sharded(master, merged, shards)) == expected
+
+
+def test_shards_option(capsys):
+    helper(capsys,
+           merged_transaction_summary=['XFR 1234567 400 7654321 ***', 'WDR 0000000 700 7654321 ***',
+                                       'DEP 2000000 10 0000000 ***', 'EOS 0000000 000 0000000 ***'],
+           master_accounts_list=['7654321 1000 from acct', '2000000 0 other', '1234567 5 to acct'],
+           expected_output_master_accounts_file=['7654321 600 from acct', '2000000 10 other', '1234567 405 to acct'],
+           expected_tail_of_terminal_output=[
+               'Error: withdrawing 700 would cause a negative balance in account #: 7654321'],
+           expected_valid_accounts_file=['7654321', '2000000', '1234567', '0000000'],
+           extra_args=['--shards', '2']
+           )
+
+
+def test_plan_shards_keeps_transfers_together():
+    pairs = app.array('l', [1000001, 1000002, 1000002, 1000004, 1000006, 1000007])
+    transfer_shards = app.plan_shards(pairs, 100, 4)
+    assert sorted(transfer_shards) == [1000001, 1000002, 1000004, 1000006, 1000007]
+    assert transfer_shards[1000001] == transfer_shards[1000002] == transfer_shards[1000004]
+    assert transfer_shards[1000006] == transfer_shards[1000007] != transfer_shards[1000001]
+    # One group of linked accounts with most of the day's rows can't be split up
+    assert app.plan_shards(pairs, 10, 4) is None
+
+
+def test_parallel_parser_matches_serial(tmp_path):
+    rng = random.Random(9)
+    master_accounts_list, rows = random_day(rng, 60, 3000)
+    merged = str(tmp_path / 'merged.txt')
+    for tail in (['DEP 1234567 100 0000000 ***'], []):
+        with open(merged, 'w') as wf:
+            wf.write('\n'.join(rows + tail))
+        expected = app.ColumnarTransactionSummary()
+        for row in app.iter_summary_file(merged):
+            expected.add_row(row.transaction_type, row.to, row.cents, row.from_act, row.name)
+        expected = [str(row) for row in expected]
+        for workers in (1, 3):
+            summary = app.parse_summary_file_parallel(merged, workers=workers, chunk_size=1000)
+            assert [str(row) for row in summary] == expected
+    with open(merged, 'w') as wf:
+        wf.write('\n'.join(rows[:-1]) + '\n')
+    assert len(app.parse_summary_file_parallel(merged, workers=2, chunk_size=1000)) == len(rows) - 1
+    with open(merged, 'w') as wf:
+        wf.write('EOS 0000000 000 0000000 ***\nDEP 1234567 100 0000000 ***')
+    assert len(app.parse_summary_file_parallel(merged)) == 0
+
+
+def test_binary_summary_round_trip(capsys, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(10)
+    master_accounts_list, rows = random_day(rng, 60, 1000)
+    rows = [row.replace(' nam ', ' 0000000 ') for row in rows]
+    expected = run_engine(capsys, master_accounts_list, rows)
+    sys.argv = ['backend.py', '--convert-summary', 'merged.txt', 'merged.bin']
+    app.main()
+    assert app.BinaryTransactionSummaryFormat.is_binary('merged.bin')
+    assert [str(row) for row in app.iter_summary_file('merged.bin')] == rows[:-1]
+    assert [str(row) for row in app.parse_summary_file_parallel('merged.bin')] == rows[:-1]
+    sys.argv = ['backend.py', '--convert-summary', 'merged.bin', 'converted.txt']
+    app.main()
+    with open('converted.txt') as converted:
+        assert converted.read() == '\n'.join(rows)
+
+    with open('master_accounts.txt', 'w') as wf:
+        wf.write('\n'.join(master_accounts_list))
+    capsys.readouterr()
+    app.parse_backend('master_accounts.txt', 'merged.bin')
+    with open('master_accounts.txt', 'rb') as master, open('valid_accounts.txt', 'rb') as valid:
+        assert (master.read(), valid.read(), capsys.readouterr().out) == expected
+
+
+def test_incremental_write(capsys):
+    helper(capsys,
+           merged_transaction_summary=['NEW 5000000 000 0000000 middle', 'DEL 3000000 000 0000000 gone',
+                                       'NEW 9000000 000 0000000 first', 'DEP 1000000 5 0000000 ***',
+                                       'EOS 0000000 000 0000000 ***'],
+           master_accounts_list=['8000000 10 a', '6000000 20 b', '3000000 0 gone', '2000000 30 c', '1000000 0 d'],
+           expected_output_master_accounts_file=['9000000 0 first', '8000000 10 a', '6000000 20 b',
+                                                 '5000000 0 middle', '2000000 30 c', '1000000 5 d'],
+           expected_tail_of_terminal_output=[],
+           expected_valid_accounts_file=['9000000', '8000000', '6000000', '5000000', '2000000', '1000000', '0000000']
+           )
+
+
+def test_unsorted_master_file(capsys):
+    helper(capsys,
+           merged_transaction_summary=['DEP 1234567 5 0000000 ***', 'EOS 0000000 000 0000000 ***'],
+           master_accounts_list=['1234567 0 a', '7654321 0 b'],
+           expected_output_master_accounts_file=['7654321 0 b', '1234567 5 a'],
+           expected_tail_of_terminal_output=[],
+           expected_valid_accounts_file=['7654321', '1234567', '0000000']
+           )
+
+
+def test_journaled_backend_recovers(capsys, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(12)
+    master_accounts_list, rows = random_day(rng, 60, 2000)
+    expected = run_engine(capsys, master_accounts_list, rows)[:2]
+
+    def journaled(master, merged):
+        app.parse_backend_journaled(master, merged, 'journal', snapshot_every=500, sync_every=7)
+
+    # Crash part way through, after a couple of snapshots
+    apply_row = app.apply_row
+    applied = []
+    crash_at = [1234]
+
+    def crashing_apply_row(*args):
+        applied.append(1)
+        if len(applied) == crash_at[0]:
+            raise KeyboardInterrupt
+        apply_row(*args)
+
+    monkeypatch.setattr(app, 'apply_row', crashing_apply_row)
+    with pytest.raises(KeyboardInterrupt):
+        run_engine(capsys, master_accounts_list, rows, run=journaled)
+    # Snapshots are named after the row count and the byte offset of the next row, which resuming seeks to
+    position = sum(len(row) + 1 for row in rows[:1000])
+    assert sorted(os.listdir('journal')) == ['input.txt', 'journal_1000.log', 'snapshot_1000_' + str(position) + '.txt']
+    with open('master_accounts.txt') as master:
+        assert master.read() == '\n'.join(master_accounts_list)
+
+    # Crash again while resuming, after the first crash left a line half written at the end of the journal
+    with open(os.path.join('journal', 'journal_1000.log'), 'rb+') as journal:
+        journal.truncate(os.path.getsize(os.path.join('journal', 'journal_1000.log')) - 5)
+    applied.clear()
+    crash_at[0] = 500  # replaying the journal's 233 complete rows counts too
+    with pytest.raises(KeyboardInterrupt):
+        journaled('master_accounts.txt', 'merged.txt')
+    with open(os.path.join('journal', 'journal_1000.log')) as journal:
+        lines = journal.read().split('\n')
+    assert lines[-1] == '' and [int(line.split(' ')[0]) for line in lines[:-1]] == list(range(1000, len(lines) + 999))
+
+    # Resuming only replays the journal and the rows after it, the rows before the snapshot aren't even parsed
+    monkeypatch.setattr(app, 'apply_row', apply_row)
+    summary_row = app.summary_row
+    parsed = []
+    monkeypatch.setattr(app, 'summary_row', lambda transaction_row: parsed.append(1) or summary_row(transaction_row))
+    journaled('master_accounts.txt', 'merged.txt')
+    monkeypatch.setattr(app, 'summary_row', summary_row)
+    assert len(parsed) == 1000
+    with open('master_accounts.txt', 'rb') as master, open('valid_accounts.txt', 'rb') as valid:
+        assert (master.read(), valid.read()) == expected
+    assert not os.path.exists('journal') and not os.path.exists('journal.done')
+
+    # An uninterrupted journaled run matches too
+    assert run_engine(capsys, master_accounts_list, rows, run=journaled)[:2] == expected
+
+    # So does resuming a binary summary file, which is resumed from a row index
+    def journaled_binary(master, merged):
+        app.convert_summary_file(merged, 'merged.bin')
+        journaled(master, 'merged.bin')
+
+    applied.clear()
+    crash_at[0] = 1234
+    monkeypatch.setattr(app, 'apply_row', crashing_apply_row)
+    with pytest.raises(KeyboardInterrupt):
+        run_engine(capsys, master_accounts_list, rows, run=journaled_binary)
+    assert 'snapshot_1000_1000.txt' in os.listdir('journal')
+    monkeypatch.setattr(app, 'apply_row', apply_row)
+    journaled('master_accounts.txt', 'merged.bin')
+    with open('master_accounts.txt', 'rb') as master, open('valid_accounts.txt', 'rb') as valid:
+        assert (master.read(), valid.read()) == expected
+
+
+def test_sparse_backend_matches_serial(capsys, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(13)
+    days = [random_day(rng, account_count, row_count) for account_count, row_count in ((60, 2000), (500, 40), (1, 5))]
+    days.append(([], ['NEW 1234567 000 0000000 a', 'NEW 7654321 000 0000000 b', 'EOS 0000000 000 0000000 ***']))
+    # Out of order, so the binary search misses 1234567 and the day is run again with parse_backend
+    days.append((['1234567 0 a', '7654321 0 b'],
+                 ['DEP 1234567 5 0000000 ***', 'WDR 0000000 9 1234567 ***', 'EOS 0000000 000 0000000 ***']))
+    for master_accounts_list, rows in days:
+        expected = run_engine(capsys, master_accounts_list, rows)
+        assert run_engine(capsys, master_accounts_list, rows, run=app.parse_backend_sparse) == expected
+    assert expected[0].startswith(b'7654321 0 b\n1234567 5 a') and expected[2].count('Error') == 1
+    assert not os.path.exists('master_accounts.txt.tmp') and not os.path.exists('valid_accounts.txt.tmp')
+
+
+def test_out_of_core_backend_matches_serial(capsys, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app, 'MERGE_FAN_IN', 3)
+    rng = random.Random(14)
+    days = [random_day(rng, account_count, row_count) for account_count, row_count in ((60, 2000), (500, 40), (1, 5))]
+    days.append(([], ['NEW 1234567 000 0000000 a', 'NEW 7654321 000 0000000 b', 'EOS 0000000 000 0000000 ***']))
+    for master_accounts_list, rows in days:
+        expected = run_engine(capsys, master_accounts_list, rows)
+        assert run_engine(capsys, master_accounts_list, rows,
+                          run=lambda master, merged: app.parse_backend_out_of_core(master, merged, 300 * 256)) == expected
+
+    # Too many transfer accounts for half the limit, so they are kept in SQLite; and few enough rows per run that the
+    # errors are spilled too
+    for master_accounts_list, rows in days:
+        expected = run_engine(capsys, master_accounts_list, rows)
+        assert run_engine(capsys, master_accounts_list, rows,
+                          run=lambda master, merged: app.parse_backend_out_of_core(master, merged, 20 * 256)) == expected
+    master_accounts_list, rows = days[0]
+    expected = run_engine(capsys, master_accounts_list, rows)
+    run_engine(capsys, master_accounts_list, rows, run=lambda master, merged: None)
+    sys.argv = ['backend.py', 'master_accounts.txt', 'merged.txt', '--memory-limit', str(20 * 256)]
+    app.main()
+    with open('master_accounts.txt', 'rb') as master, open('valid_accounts.txt', 'rb') as valid:
+        assert (master.read(), valid.read(), capsys.readouterr().out) == expected
+
+
+def test_sqlite_backend_matches_serial(capsys, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(app, 'SQLITE_BATCH', 100)
+    rng = random.Random(15)
+    for day, (account_count, row_count) in enumerate(((60, 2000), (500, 40), (1, 5))):
+        master_accounts_list, rows = random_day(rng, account_count, row_count)
+        expected = run_engine(capsys, master_accounts_list, rows)
+        assert run_engine(capsys, master_accounts_list, rows,
+                          run=lambda master, merged: app.parse_backend_sqlite('day' + str(day) + '.db', master,
+                                                                              merged)) == expected
+
+
+def test_sqlite_ledger_keeps_state_between_days(capsys, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first = ['DEP 1234567 100 0000000 ***', 'NEW 7654321 000 0000000 b', 'EOS 0000000 000 0000000 ***']
+    second = ['XFR 7654321 40 1234567 ***', 'EOS 0000000 000 0000000 ***']
+    run_engine(capsys, ['1234567 0 a'], first, run=lambda master, merged: app.parse_backend_sqlite('l.db', master, merged))
+    # The database is the ledger now; the master accounts file is only an export
+    master, valid, out = run_engine(capsys, ['1234567 0 stale'], second,
+                                    run=lambda master, merged: app.parse_backend_sqlite('l.db', master, merged))
+    assert master == b'7654321 40 b\n1234567 60 a\n'
+    assert valid == b'7654321\n1234567\n0000000\n'
+    connection = app.open_sqlite_ledger('l.db')
+    assert connection.execute('SELECT COUNT(*) FROM history').fetchone()[0] == 3
+    assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    connection.close()
+
+
+def test_serve_applies_dropped_files(capsys, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(16)
+    master_accounts_list, first = random_day(rng, 60, 500)
+    second = random_day(rng, 60, 500)[1]
+    expected = run_engine(capsys, master_accounts_list, first[:-1] + second)
+    with open('master_accounts.txt', 'w') as wf:
+        wf.write('\n'.join(master_accounts_list))
+    os.mkdir('drop')
+    for name, rows in (('day1.txt', first), ('day2.txt', second), ('.day3.txt', ['DEP 1234567 1 0000000 ***']),
+                       ('bad.txt', ['XYZ 1234567 1 0000000 ***']),
+                       ('bad_amount.txt', [first[0], 'DEP 1234567 abc 0000000 ***'])):
+        with open(os.path.join('drop', name), 'w') as wf:
+            wf.write('\n'.join(rows))
+    capsys.readouterr()
+    app.serve_backend('master_accounts.txt', 'drop', poll_interval=0, max_files=2)
+    with open('master_accounts.txt', 'rb') as master, open('valid_accounts.txt', 'rb') as valid:
+        assert (master.read(), valid.read()) == expected[:2]
+    assert sorted(os.listdir(os.path.join('drop', 'processed'))) == ['day1.txt', 'day2.txt']
+    assert sorted(os.listdir(os.path.join('drop', 'failed'))) == ['bad.txt', 'bad_amount.txt']
+    assert sorted(os.listdir('drop')) == ['.day3.txt', 'failed', 'processed']
+    out = capsys.readouterr().out.split('\n', 2)
+    assert out[0].startswith('Error: could not read ' + os.path.join('drop', 'bad.txt'))
+    assert out[1].startswith('Error: could not read ' + os.path.join('drop', 'bad_amount.txt'))
+    assert out[2] == expected[2]
+
+
+def test_serve_direct_engine_rejects_bad_numbers(capsys, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open('master_accounts.txt', 'w') as wf:
+        wf.write('7654321 0 b\n1234567 100 a\n')
+    os.mkdir('drop')
+    for name, rows in (('day1.txt', ['DEP 1234567 50 0000000 ***', 'NEW 0123456 000 0000000 c']),
+                       ('day2.txt', ['DEP 7654321 25 0000000 ***']),
+                       ('day3.txt', ['NEW 2222222 000 0000000 c', 'NEW 3333333 000 0000000 d',
+                                     'DEL 3333333 000 0000000 d'])):
+        with open(os.path.join('drop', name), 'w') as wf:
+            wf.write('\n'.join(rows))
+    spliced = []
+    splice_account_file = app.splice_account_file
+    monkeypatch.setattr(app, 'splice_account_file',
+                        lambda file, *args: spliced.append(file) or splice_account_file(file, *args))
+    app.serve_backend('master_accounts.txt', 'drop', engine='direct', poll_interval=0, max_files=2)
+    assert os.listdir(os.path.join('drop', 'failed')) == ['day1.txt']
+    assert capsys.readouterr().out.startswith('Error: could not read ' + os.path.join('drop', 'day1.txt'))
+    # day2.txt only has a deposit, so the valid accounts file is only republished for day3.txt
+    assert spliced == ['master_accounts.txt', 'master_accounts.txt', 'valid_accounts.txt']
+    with open('master_accounts.txt', 'rb') as master, open('valid_accounts.txt', 'rb') as valid:
+        assert (master.read(), valid.read()) == (b'7654321 25 b\n2222222 0 c\n1234567 100 a\n',
+                                                 b'7654321\n2222222\n1234567\n0000000\n')
+
+
+def test_daily_pipeline_in_memory(capsys, tmp_path, monkeypatch):
+    import daily
+    monkeypatch.chdir(tmp_path)
+
+    def start_of_day():
+        with open('master_accounts.txt', 'w') as wf:
+            wf.write('1234567 1000 acct one\n1111111 0 acct two\n')
+        with open('valid_accounts.txt', 'w') as wf:
+            wf.write('1234567\n1111111\n0000000\n')
+
+    start_of_day()
+    monkeypatch.setattr(sys, 'stdin', io.StringIO('\n'.join([
+        'login', 'agent', 'createacct', '2222222', 'acct three', 'deleteacct', '1111111', 'acct two', 'logout',
+        'login', 'machine', 'withdraw', '1234567', '400', 'quit',
+        'login', 'machine', 'transfer', '1234567', '1111111', '600', 'withdraw', '1234567', '500', 'logout'])))
+    daily.main(3, archive_file=os.path.join('archive', 'day.txt'))
+    with open('master_accounts.txt') as master, open('valid_accounts.txt') as valid:
+        result = master.read(), valid.read()
+    # 1111111 is deleted before the transfer to it, which the backend then skips
+    assert result == ('2222222 0 acct three\n1234567 500 acct one\n', '2222222\n1234567\n0000000\n')
+    with open(os.path.join('archive', 'day.txt')) as archive:
+        assert archive.read().splitlines() == ['NEW 2222222 000 0000000 acct three', 'DEL 1111111 000 0000000 acct two',
+                                               'XFR 1111111 600 1234567 ***', 'WDR 0000000 500 1234567 ***',
+                                               'EOS 0000000 000 0000000 ***']
+    # The archive gives the same result through the file based backend
+    start_of_day()
+    app.parse_backend('master_accounts.txt', os.path.join('archive', 'day.txt'))
+    with open('master_accounts.txt') as master, open('valid_accounts.txt') as valid:
+        assert (master.read(), valid.read()) == result
+
+
+def test_daily_parallel_and_pipelined_sessions_keep_script_order(capsys, tmp_path, monkeypatch):
+    import daily
+    import frontend
+    monkeypatch.chdir(tmp_path)
+    rng = random.Random(20)
+    numbers = [str(number) for number in range(1000001, 1000021)]
+    scripts = []
+    for _ in range(12):
+        script = ['login', 'machine']
+        for _ in range(rng.randint(1, 6)):
+            script += rng.choice([['deposit', rng.choice(numbers), str(rng.randint(1, 2000))],
+                                  ['withdraw', rng.choice(numbers), str(rng.randint(1, 2000))],
+                                  ['transfer', rng.choice(numbers), rng.choice(numbers), str(rng.randint(1, 2000))]])
+        scripts.append(script + ['logout'])
+
+    def start_of_day():
+        with open('master_accounts.txt', 'w') as wf:
+            wf.writelines(number + ' 1000 acct\n' for number in reversed(numbers))
+        with open('valid_accounts.txt', 'w') as wf:
+            wf.writelines(number + '\n' for number in numbers + ['0000000'])
+
+    start_of_day()
+    capsys.readouterr()
+    daily.run_day(scripts, workers=3, archive_file='parallel.txt')
+    out = capsys.readouterr().out
+    with open('master_accounts.txt') as master, open('valid_accounts.txt') as valid, open('parallel.txt') as archive:
+        result = master.read(), valid.read(), archive.read()
+
+    start_of_day()
+    expected_out = io.StringIO()
+    transactions = []
+    frontend.run_batch([line for script in scripts for line in script], 'valid_accounts.txt', output=expected_out,
+                       summary_sink=transactions)
+    daily.apply_day(transactions, archive_file='serial.txt')
+    with open('master_accounts.txt') as master, open('valid_accounts.txt') as valid, open('serial.txt') as archive:
+        assert result == (master.read(), valid.read(), archive.read())
+    assert out == expected_out.getvalue() + capsys.readouterr().out
+
+    # The pipelined day gives the same files, with the backend's errors after the script that caused them
+    start_of_day()
+    daily.run_day_pipelined(scripts, workers=3, archive_file='pipelined.txt', queue_size=2)
+    with open('master_accounts.txt') as master, open('valid_accounts.txt') as valid, open('pipelined.txt') as archive:
+        assert result == (master.read(), valid.read(), archive.read())
+    assert sorted(capsys.readouterr().out.splitlines()) == sorted(out.splitlines())
+
+    # No more than queue_size scripts are submitted past the first one that hasn't finished
+    submitted = []
+
+    class CheckedPool(ThreadPoolExecutor):
+        def submit(self, *args):
+            unfinished = next((number for number, future in enumerate(submitted) if not future.done()), len(submitted))
+            assert len(submitted) < unfinished + 2
+            submitted.append(super().submit(*args))
+            return submitted[-1]
+
+    start_of_day()
+    with monkeypatch.context() as patch:
+        patch.setattr(daily, 'ProcessPoolExecutor', CheckedPool)
+        daily.run_day_pipelined(scripts, workers=3, archive_file='pipelined.txt', queue_size=2)
+    assert len(submitted) == len(scripts)
+    with open('master_accounts.txt') as master, open('valid_accounts.txt') as valid, open('pipelined.txt') as archive:
+        assert result == (master.read(), valid.read(), archive.read())
+    capsys.readouterr()
+
+    # A script that fails leaves the day's files untouched, so the day can be run again
+    for run in (daily.run_day, daily.run_day_pipelined):
+        start_of_day()
+        with open('master_accounts.txt') as master, open('valid_accounts.txt') as valid:
+            start = master.read(), valid.read()
+        with pytest.raises(FileNotFoundError):
+            run(scripts[:5] + ['missing.txt'] + scripts[5:], workers=3, archive_file='failed.txt')
+        with open('master_accounts.txt') as master, open('valid_accounts.txt') as valid:
+            assert (master.read(), valid.read()) == start
+        assert not os.path.exists('failed.txt')
+
+
+def test_merge_summary_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sessions = {
+        'transaction_10.txt': 'DEP 1234567 10 0000000 ***\nEOS 0000000 000 0000000 ***',
+        'transaction_9.txt': 'NEW 1234567 000 0000000 acct nine\nXFR 1234567 9 7654321 ***\nEOS 0000000 000 0000000 ***',
+        'transaction_2.txt': 'EOS 0000000 000 0000000 ***',
+        'transaction_0.txt': 'WDR 0000000 1 1234567 ***\nEOS 0000000 000 0000000 ***\nDEP 1234567 1 0000000 ***',
+        'transaction_1.txt': 'DEP 7654321 5 0000000 ***',
+    }
+    for name, content in sessions.items():
+        with open(name, 'w') as wf:
+            wf.write(content)
+    summary = app.TransactionSummary('transaction_3.txt')
+    summary.add_row(app.TransactionSummaryKeys.deposit, to='7654321', cents='3')
+    summary.to_file(binary=True)
+    expected = ['WDR 0000000 1 1234567 ***', 'DEP 7654321 5 0000000 ***', 'DEP 7654321 3 0000000 ***',
+                'NEW 1234567 000 0000000 acct nine', 'XFR 1234567 9 7654321 ***', 'DEP 1234567 10 0000000 ***',
+                'EOS 0000000 000 0000000 ***']
+    files = sorted(list(sessions) + ['transaction_3.txt'])
+    for buffer_size in (app.MERGE_BUFFER_SIZE, 7, 2):
+        app.merge_summary_files(files, 'merged.txt', buffer_size)
+        with open('merged.txt') as merged:
+            assert merged.read().split('\n') == expected
+    sys.argv = ['backend.py', '--merge-summaries', 'merged_cli.txt'] + files[::-1]
+    app.main()
+    with open('merged.txt') as merged, open('merged_cli.txt') as merged_cli:
+        assert merged.read() == merged_cli.read()
+
+
+def test_workload_generator(capsys, tmp_path, monkeypatch):
+    import workload
+    monkeypatch.chdir(tmp_path)
+    for run in range(2):
+        numbers = workload.generate_master_accounts('master_' + str(run) + '.txt', 500, seed=23)
+        workload.generate_summary('merged_' + str(run) + '.txt', numbers, 2000, {'DEP': 1, 'XFR': 1},
+                                  hot_share=0.9, seed=23)
+    with open('master_0.txt') as first, open('master_1.txt') as second:
+        assert first.read() == second.read()
+    with open('merged_0.txt') as first, open('merged_1.txt') as second:
+        assert first.read() == second.read()
+    assert list(numbers) == sorted(numbers, reverse=True) == list(workload.load_account_numbers('master_0.txt'))
+    rows = list(app.iter_summary_file('merged_0.txt'))
+    assert len(rows) == 2000
+    assert {row.transaction_type for row in rows} == {app.TransactionSummaryKeys.deposit,
+                                                      app.TransactionSummaryKeys.transfer}
+    assert sum(row.to in set(map(str, numbers[:5])) for row in rows) > 1000  # the hot accounts
+    app.parse_backend('master_0.txt', 'merged_0.txt')
+
+
+def test_stats(capsys, tmp_path, monkeypatch):
+    import json
+    monkeypatch.chdir(tmp_path)
+    master_accounts_list, rows = random_day(random.Random(25), 60, 2000)
+    expected = run_engine(capsys, master_accounts_list, rows)
+    out = expected[2].splitlines()
+    engines = ['dict', 'direct'] + (['batch'] if app.numpy is not None else [])
+    for engine in engines:
+        stats = app.BackendStats()
+        assert run_engine(capsys, master_accounts_list, rows,
+                          run=lambda master, merged: app.parse_backend(master, merged, engine, stats=stats)) == expected
+        assert stats.rows == {code: sum(row.startswith(code) for row in rows[:-1])
+                              for code in ('DEP', 'WDR', 'XFR', 'NEW', 'DEL')}
+        assert stats.rejected == {app.OVERDRAFT: sum('negative balance' in line for line in out),
+                                  app.DUPLICATE_CREATE: sum('already exists' in line for line in out),
+                                  app.FAILED_DELETE: sum("delete" in line or "didn't match" in line for line in out)}
+        assert [name for name, start, seconds in stats.phases][0] == 'load master'
+        assert [name for name, start, seconds in stats.phases][-1] == 'write'
+
+    sys.argv = ['backend.py', 'master_accounts.txt', 'merged.txt', '--stats', 'stats.json', '--trace', 'trace.json']
+    app.main()
+    with open('stats.json') as stats_file, open('trace.json') as trace_file:
+        stats, trace = json.load(stats_file), json.load(trace_file)
+    assert set(stats['phases']) == {'load master', 'parse summary + apply', 'write'}
+    assert sum(stats['rows'].values()) == len(rows) - 1
+    assert [event['name'] for event in trace['traceEvents'] if event['ph'] == 'X'] == [
+        'load master', 'parse summary + apply', 'write']
+
+    # Other modes reject them instead of ignoring them
+    os.remove('stats.json')
+    for mode in (['--merge-summaries', 'merged_2.txt', 'merged.txt'], ['--convert-summary', 'merged.txt', 'merged.bin'],
+                 ['master_accounts.txt', '--serve', 'drop'], ['master_accounts.txt', 'merged.txt', '--sparse']):
+        sys.argv = ['backend.py'] + mode + ['--stats', 'stats.json']
+        with pytest.raises(SystemExit):
+            app.main()
+        assert '--stats and --trace can only be used' in capsys.readouterr().err
+    assert not os.path.exists('stats.json') and not os.path.exists('merged_2.txt') and not os.path.exists('merged.bin')
+
+
+def test_find_master_record():
+    mapped = b'9000000 5 a\n7000000 0 b c\n5000000 1 d\n'
+    assert app.find_master_record(mapped, b'7000000') == (12, 26)
+    assert app.find_master_record(mapped, b'9000000') == (0, 12)
+    assert app.find_master_record(mapped, b'5000000') == (26, 38)
+    assert app.find_master_record(mapped, b'9500000') == (0, None)
+    assert app.find_master_record(mapped, b'6000000') == (26, None)
+    assert app.find_master_record(mapped, b'1000000') == (38, None)
+    assert app.find_master_record(mapped[:-1], b'5000000') == (26, 37)
+
+
+def test_stream_stops_at_eos(capsys):
+    helper(capsys,
+           merged_transaction_summary=['DEP 1234567 100 0000000 ***', 'EOS 0000000 000 0000000 ***',
+                                       'DEP 1234567 100 0000000 ***'],
+           master_accounts_list=['1234567 0 nam'],
+           expected_output_master_accounts_file=['1234567 100 nam'],
+           expected_tail_of_terminal_output=[],
+           expected_valid_accounts_file=['1234567', '0000000']
+           )
+
+
+def test_iter_summary_file_is_lazy():
+    temp_fd, temp_file = tempfile.mkstemp()
+    with open(temp_file, 'w') as wf:
+        wf.write('DEP 1234567 100 0000000 ***\nXFR 1234567 5 7654321 ***\nEOS 0000000 000 0000000 ***')
+    rows = app.iter_summary_file(temp_file)
+    assert not isinstance(rows, list)
+    assert [str(row) for row in rows] == ['DEP 1234567 100 0000000 ***', 'XFR 1234567 5 7654321 ***']
+    os.close(temp_fd)
+    os.remove(temp_file)
+
+
+def test_parse_to_columnar_summary():
+    temp_fd, temp_file = tempfile.mkstemp()
+    with open(temp_file, 'w') as wf:
+        wf.write('NEW 1234567 000 0000000 Acct one\nDEP 1234567 100 0000000 ***\nXFR 1234567 5 7654321 ***\n'
+                 'WDR 0000000 20 1234567 ***\nDEL 1234567 000 0000000 Acct one\nEOS 0000000 000 0000000 ***')
+    rows = [str(row) for row in app.parse_to_summary_file(temp_file)]
+    columnar = app.parse_to_summary_file(temp_file, columnar=True)
+    assert len(columnar) == 5
+    assert [str(row) for row in columnar] == rows
+    os.close(temp_fd)
+    os.remove(temp_file)
+
+
 def helper(capsys,
            merged_transaction_summary,
            master_accounts_list,
            expected_output_master_accounts_file,
            expected_tail_of_terminal_output,
-           expected_valid_accounts_file
+           expected_valid_accounts_file,
+           extra_args=()
            ):
     """Helper function for testing
 
@@ -84,6 +766,7 @@ def helper(capsys,
         expected_tail_of_terminal_output list of expected string at the tail of terminal
         input_valid_accounts -- list of valid accounts in the valid_account_list_file
         expected_output_transactions -- list of expected output transactions
+        extra_args -- additional command line options for the backend
     """
 
     # cleanup package
@@ -103,7 +786,7 @@ def helper(capsys,
     sys.argv = [
         'backend.py',
         master_accounts_file,
-        merged_transaction_file]
+        merged_transaction_file] + list(extra_args)
     # run the program
     app.main()
 
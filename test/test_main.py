@@ -1,5 +1,6 @@
 import io
 import os
+import shutil
 import sys
 import tempfile
 from importlib import reload
@@ -733,6 +734,85 @@ def test_r17_t5(capsys):
     )
 
 
+def test_daily_totals_index():
+    # The running totals must agree with summing the summary rows, and be reset once written out
+    temp_fd, temp_file = tempfile.mkstemp()
+    summary = app.TransactionSummary(temp_file)
+    summary.add_row(app.TransactionSummaryKeys.deposit, to='1234567', cents='300000')
+    summary.add_row(app.TransactionSummaryKeys.withdraw, cents='100', from_act='1234567')
+    summary.add_row(app.TransactionSummaryKeys.transfer, '7654321', '250', '1234567')
+    summary.add_row(app.TransactionSummaryKeys.deposit, to='1234567', cents='150000')
+    assert summary.total_within_daily_limit(app.TransactionSummaryKeys.deposit, '1234567', 50000, 500000)
+    assert not summary.total_within_daily_limit(app.TransactionSummaryKeys.deposit, '1234567', 50001, 500000)
+    assert not summary.total_within_daily_limit(app.TransactionSummaryKeys.transfer, '1234567', 751, 1000)
+    assert summary.total_within_daily_limit(app.TransactionSummaryKeys.transfer, '7654321', 1000, 1000)
+    summary.to_file()
+    assert summary.total_within_daily_limit(app.TransactionSummaryKeys.deposit, '1234567', 500000, 500000)
+    os.close(temp_fd)
+    os.remove(temp_file)
+
+
+def test_binary_summary_file():
+    temp_dir = tempfile.mkdtemp()
+    summary_file = os.path.join(temp_dir, 'summary.bin')
+    summary = app.TransactionSummary(summary_file)
+    summary.add_row(app.TransactionSummaryKeys.createacct, to='1234567', name='Acct one')
+    summary.add_row(app.TransactionSummaryKeys.transfer, '7654321', '250', '1234567')
+    summary.to_file(binary=True)
+    assert len(summary) == 0
+    assert app.BinaryTransactionSummaryFormat.is_binary(summary_file)
+    assert [str(row) for row in app.BinaryTransactionSummaryFormat.iter_rows(summary_file)] == [
+        'NEW 1234567 000 0000000 Acct one', 'XFR 7654321 250 1234567 ***']
+    os.remove(summary_file)
+    os.rmdir(temp_dir)
+
+
+def test_batch_matches_interactive(capsys):
+    script = ['login', 'machine', 'deposit', '1234567', '300000', 'deposit', '1234567', '300000', 'q', 'logout',
+              'login', 'agent', 'createacct', '1234567', '7654321', 'Acct two', 'logout',
+              'bogus', 'quit',
+              'login', 'machine', 'withdraw', '1234567', '100']
+    temp_dir = tempfile.mkdtemp()
+    valid_accounts_file = os.path.join(temp_dir, 'valid_accounts.txt')
+    with open(valid_accounts_file, 'w') as wf:
+        wf.write('1234567\n0000000')
+
+    # Interactively, the way daily.py runs sessions
+    sys.stdin = io.StringIO('\n'.join(script))
+    expected_summaries = []
+    for session in range(4):
+        sys.argv = ['frontend.py', valid_accounts_file, os.path.join(temp_dir, 'expected_' + str(session) + '.txt')]
+        try:
+            app.main()
+        except EOFError:
+            pass
+        expected_summaries.append(os.path.join(temp_dir, 'expected_' + str(session) + '.txt'))
+    expected = [line for line in capsys.readouterr().out.splitlines() if not line.endswith(': ')]
+
+    script_file = os.path.join(temp_dir, 'script.txt')
+    with open(script_file, 'w') as wf:
+        wf.write('\n'.join(script))
+    sys.argv = ['frontend.py', valid_accounts_file, os.path.join(temp_dir, 'batch_{}.txt'), script_file]
+    app.main()
+    assert capsys.readouterr().out.splitlines() == expected
+    assert app.run_batch(script, valid_accounts_file, os.path.join(temp_dir, 'batch_{}.txt'), output=io.StringIO()) == 4
+    for session, expected_summary in enumerate(expected_summaries):
+        batch_summary = os.path.join(temp_dir, 'batch_' + str(session) + '.txt')
+        assert os.path.exists(batch_summary) == os.path.exists(expected_summary)
+        if os.path.exists(expected_summary):
+            with open(expected_summary) as expected_fp, open(batch_summary) as batch_fp:
+                assert batch_fp.read() == expected_fp.read()
+
+    # Without {} in the name every session still gets its own file
+    sys.argv = ['frontend.py', valid_accounts_file, os.path.join(temp_dir, 'plain.txt'), script_file]
+    app.main()
+    for session, name in enumerate(['plain.txt', 'plain_1.txt', 'plain_2.txt', 'plain_3.txt']):
+        assert os.path.exists(os.path.join(temp_dir, name)) == os.path.exists(expected_summaries[session])
+    with open(expected_summaries[1]) as expected_fp, open(os.path.join(temp_dir, 'plain_1.txt')) as batch_fp:
+        assert batch_fp.read() == expected_fp.read()
+    shutil.rmtree(temp_dir)
+
+
 def helper(
         capsys,
         terminal_input,
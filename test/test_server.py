@@ -0,0 +1,138 @@
+import asyncio
+import os
+import threading
+
+import server as app
+
+
+def start_server(tmp_path, max_sessions, loop):
+    """Makes the valid accounts file and a FrontEndServer for it"""
+    accounts_file = os.path.join(str(tmp_path), 'valid_accounts.txt')
+    with open(accounts_file, 'w') as wf:
+        wf.write('1234567\n7654321\n0000000\n')
+    return app.FrontEndServer(accounts_file, os.path.join(str(tmp_path), 'summaries'), max_sessions, loop)
+
+
+def run_sessions(tmp_path, scripts, unix=False):
+    """Serves the scripted sessions concurrently and returns each session's output"""
+    loop = asyncio.new_event_loop()
+    front_end_server = start_server(tmp_path, 4, loop)
+
+    async def client(script):
+        if unix:
+            reader, writer = await asyncio.open_unix_connection(os.path.join(str(tmp_path), 'socket'))
+        else:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(('\n'.join(script) + '\n').encode())
+        writer.write_eof()
+        output = await reader.read()
+        writer.close()
+        return output.decode()
+
+    async def serve():
+        server = await front_end_server.start('127.0.0.1', 0, os.path.join(str(tmp_path), 'socket') if unix else None)
+        nonlocal port
+        port = None if unix else server.sockets[0].getsockname()[1]
+        try:
+            return await asyncio.gather(*map(client, scripts))
+        finally:
+            server.close()
+            await server.wait_closed()
+            await front_end_server.stop()
+
+    port = None
+    try:
+        return loop.run_until_complete(serve())
+    finally:
+        loop.close()
+
+
+def test_concurrent_sessions(tmp_path):
+    outputs = run_sessions(tmp_path, [
+        ['login', 'machine', 'deposit', '1234567', '500', 'logout'],
+        ['login', 'agent', 'createacct', '1234567', '1111111', 'new acct', 'logout'],
+        ['login', 'machine', 'withdraw', '9999999', 'q', 'quit'],
+    ])
+    assert outputs[0].endswith('Deposit successful\nCommand: \nSuccessfully logged out\n')
+    assert 'Error: Account number already exists\n' in outputs[1]
+    assert outputs[2].startswith('Welcome to Quinterac banking, type login to begin\nCommand: \n')
+    assert 'Error: account number not found\n' in outputs[2]
+    summaries = []
+    for name in os.listdir(os.path.join(str(tmp_path), 'summaries')):
+        with open(os.path.join(str(tmp_path), 'summaries', name)) as fp:
+            summaries.append(fp.read())
+    # Sessions are numbered in connection order, which isn't fixed, so only the contents are checked
+    assert sorted(summaries) == ['DEP 1234567 500 0000000 ***\nEOS 0000000 000 0000000 ***',
+                                 'NEW 1111111 000 0000000 new acct\nEOS 0000000 000 0000000 ***']
+
+
+def test_disconnect_without_logout(tmp_path):
+    outputs = run_sessions(tmp_path, [['login', 'machine', 'deposit', '1234567', '500']], unix=True)
+    assert outputs[0].endswith('Deposit successful\nCommand: \n')
+    assert not os.path.exists(os.path.join(str(tmp_path), 'summaries'))
+
+
+def test_restart_keeps_earlier_summaries(tmp_path):
+    for deposit in ('500', '600'):
+        run_sessions(tmp_path, [['login', 'machine', 'deposit', '1234567', deposit, 'logout']])
+    summaries = os.path.join(str(tmp_path), 'summaries')
+    assert sorted(os.listdir(summaries)) == ['transaction_0.txt', 'transaction_1.txt']
+    with open(os.path.join(summaries, 'transaction_1.txt')) as fp:
+        assert fp.read().startswith('DEP 1234567 600 ')
+
+
+def test_waiting_connection_is_told(tmp_path):
+    loop = asyncio.new_event_loop()
+    front_end_server = start_server(tmp_path, 1, loop)
+
+    async def serve():
+        server = await front_end_server.start('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            first_reader, first_writer = await asyncio.open_connection('127.0.0.1', port)
+            assert (await first_reader.readline()).startswith(b'Welcome')
+            second_reader, second_writer = await asyncio.open_connection('127.0.0.1', port)
+            assert await second_reader.readline() == b'All terminals are busy, please wait\n'
+            first_writer.write_eof()  # the first session ends, so the second one starts
+            assert (await second_reader.readline()).startswith(b'Welcome')
+            second_writer.write_eof()
+            await second_reader.read()
+            first_writer.close()
+            second_writer.close()
+        finally:
+            server.close()
+            await server.wait_closed()
+            await front_end_server.stop()
+
+    try:
+        loop.run_until_complete(serve())
+    finally:
+        loop.close()
+
+
+def test_idle_sessions_hold_no_threads(tmp_path):
+    loop = asyncio.new_event_loop()
+    front_end_server = start_server(tmp_path, 100, loop)
+
+    async def serve():
+        server = await front_end_server.start('127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        threads = threading.active_count()
+        try:
+            connections = [await asyncio.open_connection('127.0.0.1', port) for _ in range(100)]
+            for reader, writer in connections:
+                assert (await reader.readline()).startswith(b'Welcome')
+            assert threading.active_count() == threads
+            for reader, writer in connections:
+                writer.write(b'quit\n')
+                await reader.read()
+                writer.close()
+        finally:
+            server.close()
+            await server.wait_closed()
+            await front_end_server.stop()
+
+    try:
+        loop.run_until_complete(serve())
+    finally:
+        loop.close()
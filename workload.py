@@ -0,0 +1,162 @@
+import argparse
+import random
+from array import array
+
+'''
+Seeded generator for synthetic master accounts files and merged transaction summary files, for benchmarking the
+back end at sizes well beyond the hand written days in weekly.py. The same arguments and seed always give the same files.
+'''
+
+FIRST_ACCOUNT = 1000000
+LAST_ACCOUNT = 9999999
+# Every valid account number is 7 digits without a leading 0, so there can't be more accounts than this
+MAX_ACCOUNTS = LAST_ACCOUNT - FIRST_ACCOUNT + 1
+DEFAULT_MIX = {'DEP': 35, 'WDR': 30, 'XFR': 25, 'NEW': 5, 'DEL': 5}
+
+
+def account_name(number: int) -> str:
+    """
+    Makes the name a generated account is created with
+    :param number: the account number
+    :return: a valid account name
+    """
+    return 'Acct ' + str(number)
+
+
+def generate_master_accounts(file: str, accounts: int, seed: int = 0) -> array:
+    """
+    Writes a master accounts file of randomly chosen account numbers, sorted the way the back end writes it. Large
+    files pick their numbers in one pass from the highest down (selection sampling) instead of sorting a sample.
+    About one account in ten has a zero balance, so some deletes can succeed.
+    :param file: the master accounts file to write
+    :param accounts: the number of accounts, at most MAX_ACCOUNTS
+    :param seed: seed for the random numbers
+    :return: the account numbers, highest first
+    """
+    if not 0 <= accounts <= MAX_ACCOUNTS:
+        raise ValueError('accounts must be between 0 and ' + str(MAX_ACCOUNTS))
+    rng = random.Random(seed)
+    sort_sample = accounts * 10 < MAX_ACCOUNTS  # few enough to sort, rather than walk through every possible number
+    if sort_sample:
+        candidates = sorted(rng.sample(range(FIRST_ACCOUNT, LAST_ACCOUNT + 1), accounts), reverse=True)
+    else:
+        candidates = range(LAST_ACCOUNT, FIRST_ACCOUNT - 1, -1)
+    numbers = array('l')
+    needed = accounts
+    with open(file, 'w', buffering=1024 * 1024) as fp:
+        for number in candidates:
+            if needed == 0:
+                break
+            if sort_sample or rng.random() * (number - FIRST_ACCOUNT + 1) < needed:
+                numbers.append(number)
+                needed -= 1
+                balance = 0 if rng.random() < 0.1 else rng.randint(1, 10000000)
+                fp.write(str(number) + ' ' + str(balance) + ' ' + account_name(number) + '\n')
+    return numbers
+
+
+def load_account_numbers(file: str) -> array:
+    """
+    Reads the account numbers back from a master accounts file
+    :param file: the master accounts file
+    :return: the account numbers, in file order
+    """
+    with open(file) as fp:
+        return array('l', (int(line.split(' ', 1)[0]) for line in fp if line.strip()))
+
+
+def generate_summary(file: str, numbers, rows: int, mix=None, hot_accounts: float = 0.01, hot_share: float = 0.0,
+                     seed: int = 0) -> None:
+    """
+    Writes a merged transaction summary file of random transactions against the given accounts, ending in EOS
+    :param file: the merged transaction summary file to write
+    :param numbers: the existing account numbers (see generate_master_accounts)
+    :param rows: the number of transactions
+    :param mix: relative weights of the transaction codes (DEP, WDR, XFR, NEW, DEL), DEFAULT_MIX if not given
+    :param hot_accounts: the fraction of the accounts that are hot
+    :param hot_share: the fraction of the transactions that go to the hot accounts (0 spreads them evenly)
+    :param seed: seed for the random numbers
+    """
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    codes = list(mix)
+    cumulative = []
+    total = 0
+    for code in codes:
+        total += mix[code]
+        cumulative.append(total)
+    hot = max(1, int(len(numbers) * hot_accounts))
+
+    def pick() -> str:
+        if not numbers:
+            return str(rng.randint(FIRST_ACCOUNT, LAST_ACCOUNT))
+        if rng.random() < hot_share:
+            return str(numbers[rng.randrange(hot)])
+        return str(numbers[rng.randrange(len(numbers))])
+
+    with open(file, 'w', buffering=1024 * 1024) as fp:
+        for code in (code for start in range(0, rows, 65536)
+                     for code in rng.choices(codes, cum_weights=cumulative, k=min(65536, rows - start))):
+            cents = str(rng.randint(1, 100000))
+            if code == 'DEP':
+                fp.write('DEP ' + pick() + ' ' + cents + ' 0000000 ***\n')
+            elif code == 'WDR':
+                fp.write('WDR 0000000 ' + cents + ' ' + pick() + ' ***\n')
+            elif code == 'XFR':
+                fp.write('XFR ' + pick() + ' ' + cents + ' ' + pick() + ' ***\n')
+            elif code == 'NEW':
+                number = rng.randint(FIRST_ACCOUNT, LAST_ACCOUNT)
+                fp.write('NEW ' + str(number) + ' 000 0000000 ' + account_name(number) + '\n')
+            elif code == 'DEL':
+                number = pick()
+                fp.write('DEL ' + number + ' 000 0000000 ' + account_name(int(number)) + '\n')
+            else:
+                raise ValueError('unknown transaction code: ' + code)
+        fp.write('EOS 0000000 000 0000000 ***')
+
+
+def parse_mix(mix: str):
+    """
+    Parses a transaction mix given on the command line
+    :param mix: comma separated CODE=WEIGHT pairs, e.g. DEP=50,WDR=50
+    :return: dictionary of transaction code to weight
+    """
+    try:
+        weights = {code.upper(): float(weight) for code, weight in (pair.split('=') for pair in mix.split(','))}
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid mix: ' + mix)
+    if not set(weights) <= set(DEFAULT_MIX) or sum(weights.values()) <= 0:
+        raise argparse.ArgumentTypeError('invalid mix: ' + mix)
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='workload', description='Generates a master accounts file and a merged '
+                                                                  'transaction summary file for benchmarking')
+    parser.add_argument('master_accounts_file')
+    parser.add_argument('merged_transaction_summary_file')
+    parser.add_argument('--accounts', type=int, default=1000, help='accounts in the master accounts file')
+    parser.add_argument('--rows', type=int, default=1000, help='transactions in the merged transaction summary')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='relative weights of the transaction codes, e.g. DEP=35,WDR=30,XFR=25,NEW=5,DEL=5')
+    parser.add_argument('--hot-accounts', type=float, default=0.01, help='fraction of the accounts that are hot')
+    parser.add_argument('--hot-share', type=float, default=0.0,
+                        help='fraction of the transactions that go to the hot accounts')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--existing-master', action='store_true',
+                        help="don't write the master accounts file, generate transactions for the one already there")
+    args = parser.parse_args()
+    if not 0 <= args.accounts <= MAX_ACCOUNTS:
+        parser.error('--accounts must be between 0 and ' + str(MAX_ACCOUNTS))
+    if args.rows < 0 or not 0 < args.hot_accounts <= 1 or not 0 <= args.hot_share <= 1:
+        parser.error('--rows must not be negative and --hot-accounts and --hot-share must be fractions')
+    if args.existing_master:
+        numbers = load_account_numbers(args.master_accounts_file)
+    else:
+        numbers = generate_master_accounts(args.master_accounts_file, args.accounts, args.seed)
+    generate_summary(args.merged_transaction_summary_file, numbers, args.rows, args.mix, args.hot_accounts,
+                     args.hot_share, args.seed)
+
+
+if __name__ == "__main__":
+    main()